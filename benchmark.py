@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from tabulate import tabulate
+
+import synthetic_data
+from mdp import MDP
+from mdp_handler import MDPInitializer
+
+# The phases timed for each cell of the grid, in the order they run
+PHASES = ('load', 'states', 'transitions', 'solve', 'recommend', 'recommend_many')
+
+
+def run_cell(path, k, top_n=10, solver='policy_iteration', sample=1000, seed=0, memory=False, implicit=False):
+    """
+    Function to run every phase of training and serving one model.
+    :param path: path to data
+    :param k: the number of items in each state
+    :param top_n: the number of recommendations kept for each state
+    :param solver: the name of the solver
+    :param sample: the number of users asked for recommendations
+    :param seed: the seed used to pick the users
+    :param memory: flag to measure the peak memory of each phase with tracemalloc instead of the time
+    :param implicit: flag to solve with the implicit transition operator
+    :return: { phase: seconds, ... } or { phase: peak bytes, ... }
+    """
+
+    results = {}
+
+    def measure(phase, run):
+        if memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        value = run()
+        elapsed = time.perf_counter() - start
+        if memory:
+            results[phase] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            results[phase] = elapsed
+        return value
+
+    mdp_i = measure('load', lambda: MDPInitializer(path, k, 1))
+    rs = MDP(path=path, k=k, verbose=False, top_n=top_n, mdp_i=mdp_i, implicit=implicit)
+    rs.A = rs.mdp_i.actions
+    rs.S, rs.V, rs.policy, rs.policy_list = measure('states', lambda: rs.mdp_i.generate_initial_states(top_n))
+    rs.T = measure('transitions', lambda: rs.mdp_i.generate_transitions(rs.S, rs.A, implicit=implicit))
+    measure('solve', lambda: rs.solve(solver, to_save=False))
+
+    # Serve the same users one at a time and in one batch
+    users = mdp_i.log.user_ids
+    users = [users[i] for i in np.random.default_rng(seed).choice(len(users), min(sample, len(users)), replace=False)]
+    rs.serving_model()
+    measure('recommend', lambda: [rs.recommend(user) for user in users])
+    measure('recommend_many', lambda: rs.recommend_many(users, top_n))
+    return results
+
+
+def run_grid(ks=(1, 2, 3), catalogs=(20, 200), num_of_users=20000, mean_history=2.5, distribution='geometric',
+             skew=1.0, data_dir=None, memory=True, seed=0, **options):
+    """
+    Function to generate a dataset for each catalog size and run every k on it.
+    :param ks: the numbers of items in each state
+    :param catalogs: the numbers of games
+    :param num_of_users: the number of users of each dataset
+    :param mean_history: the average number of games per user
+    :param distribution: the distribution of the history lengths
+    :param skew: the Zipf exponent of the popularity of the games
+    :param data_dir: the directory the datasets are kept in, reused when they exist (a temporary one if None)
+    :param memory: flag to also measure the peak memory of each phase, in a separate run
+    :param seed: the seed of the datasets
+    :param options: keyword arguments passed on to run_cell
+    :return: a list with a dict for each catalog size, k and phase
+    """
+
+    root = data_dir or tempfile.mkdtemp(prefix='mdp-benchmark-')
+    results = []
+    try:
+        for num_of_games in catalogs:
+            path = os.path.join(root, 'users=' + str(num_of_users) + '_games=' + str(num_of_games) + '_history=' +
+                                str(mean_history) + '-' + distribution + '_skew=' + str(skew) + '_seed=' + str(seed))
+            if not os.path.exists(os.path.join(path, 'games.csv')):
+                synthetic_data.generate(path, num_of_users, num_of_games, mean_history, distribution, skew, seed=seed)
+
+            for k in ks:
+                seconds = run_cell(path, k, seed=seed, **options)
+                peaks = run_cell(path, k, seed=seed, memory=True, **options) if memory else {}
+                for phase in PHASES:
+                    results.append({'games': num_of_games, 'users': num_of_users, 'k': k, 'phase': phase,
+                                    'seconds': seconds[phase], 'peak_bytes': peaks.get(phase)})
+                print("games=" + str(num_of_games) + " k=" + str(k) + ": " +
+                      ", ".join(phase + " %.3fs" % seconds[phase] for phase in PHASES))
+    finally:
+        if data_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold=0.25, min_seconds=0.05, min_bytes=1 << 20):
+    """
+    Function to find the phases that got slower or use more memory than in a baseline.
+    :param results: the results of run_grid
+    :param baseline: the results of an earlier run
+    :param threshold: the relative increase that counts as a regression
+    :param min_seconds: increases in time smaller than this are noise
+    :param min_bytes: increases in peak memory smaller than this are noise
+    :return: a list of (games, users, k, phase, measure, baseline, current) tuples
+    """
+
+    previous = {(r['games'], r['users'], r['k'], r['phase']): r for r in baseline}
+    regressions = []
+    for r in results:
+        key = (r['games'], r['users'], r['k'], r['phase'])
+        if key not in previous:
+            continue
+        for measure, floor in (('seconds', min_seconds), ('peak_bytes', min_bytes)):
+            old, new = previous[key].get(measure), r.get(measure)
+            if old is not None and new is not None and new > old * (1 + threshold) and new - old > floor:
+                regressions.append(key + (measure, old, new))
+    return regressions
+
+
+def environment():
+    """
+    Function to describe the machine the benchmark runs on.
+    :return: a dict
+    """
+
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time training and serving on synthetic data")
+    parser.add_argument('--ks', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--games', type=int, nargs='+', default=[20, 200])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--mean-history', type=float, default=2.5)
+    parser.add_argument('--distribution', choices=('geometric', 'lognormal', 'poisson'), default='geometric')
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--solver', default='policy_iteration')
+    parser.add_argument('--top-n', type=int, default=10)
+    parser.add_argument('--implicit', action='store_true', help="use the implicit transition operator")
+    parser.add_argument('--no-memory', action='store_true', help="skip the peak memory runs")
+    parser.add_argument('--data-dir', default=None, help="keep the generated datasets here")
+    parser.add_argument('--output', default='results/benchmark.json')
+    parser.add_argument('--baseline', default=None, help="a results file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.25)
+    args = parser.parse_args()
+
+    grid = run_grid(args.ks, args.games, args.users, args.mean_history, args.distribution, args.skew, args.data_dir,
+                    not args.no_memory, solver=args.solver, top_n=args.top_n, implicit=args.implicit)
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'options': vars(args), 'results': grid}, f, indent=1)
+    print("Results written to " + args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = compare(grid, json.load(f)['results'], args.threshold)
+        if found:
+            print(tabulate(found, ['Games', 'Users', 'k', 'Phase', 'Measure', 'Baseline', 'Current'], "psql"))
+            sys.exit(1)
+        print("No regressions against " + args.baseline)
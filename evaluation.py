@@ -0,0 +1,125 @@
+import multiprocessing
+
+import numpy as np
+
+# The data each evaluation worker reads, handed to the pool's initializer so forked workers share its pages
+_shared = {}
+
+
+def rank_histogram(mdp, processes=1, chunk_size=50000):
+    """
+    Function to find the rank of every held-out purchase and add them up into a weighted histogram.
+
+    Each user with at least two games is replayed once: for every prefix of the history the next game is held out
+    and its rank in the ranked list of the prefix's state is recorded. Each rank is weighted by 1 / (number of
+    held-out games of the user), so the histogram divided by the number of users gives the per-user averages used by
+    both scores. The model is not modified.
+    :param mdp: a trained MDP
+    :param processes: the number of worker processes (1 runs in this process)
+    :param chunk_size: the number of users given to a worker at once
+    :return: an array with the weight of each rank (index 0 is for games that are not ranked) and the number of
+    users evaluated
+    """
+
+    mdp_i = mdp.mdp_i
+    model = mdp.serving_model()
+    codes, starts, ends = mdp_i.encode_histories()
+
+    # Only users with at least two games have something to predict
+    evaluated = ends - starts - (mdp_i.k - 1) > 1
+    starts, ends = starts[evaluated], ends[evaluated]
+
+    _shared.update(codes=codes, model=model, k=mdp_i.k, num_of_actions=len(mdp_i.actions))
+    chunks = [(starts[i:i + chunk_size], ends[i:i + chunk_size]) for i in range(0, len(starts), chunk_size)]
+    if processes == 1 or len(chunks) <= 1:
+        partials = [_chunk_histogram(chunk) for chunk in chunks]
+    else:
+        # Forked explicitly, under spawn or forkserver the codes and model would be pickled into every worker
+        with multiprocessing.get_context('fork').Pool(processes, _init_worker, (dict(_shared),)) as pool:
+            partials = pool.map(_chunk_histogram, chunks)
+    _shared.clear()
+
+    histogram = np.zeros(model.ranked_actions.shape[1] + 1)
+    for partial in partials:
+        histogram += partial
+    return histogram, len(starts)
+
+
+def decay_score(histogram, num_of_users, alpha=10):
+    """
+    Function to compute the exponential decay score from a rank histogram.
+    :param histogram: the weight of each rank as returned by rank_histogram
+    :param num_of_users: the number of users evaluated
+    :param alpha: a parameter in exponential decay score
+    :return: the average score
+    """
+
+    m = np.arange(1, len(histogram))
+    return 100 * float(np.dot(histogram[1:], 2 ** ((1 - m) / (alpha - 1)))) / num_of_users
+
+
+def recommendation_scores(histogram, num_of_users, ms):
+    """
+    Function to compute the recommendation score for several list sizes from a rank histogram.
+    :param histogram: the weight of each rank as returned by rank_histogram
+    :param num_of_users: the number of users evaluated
+    :param ms: the list sizes
+    :return: a list with the average score for each m
+    """
+
+    within = np.concatenate([[0], np.cumsum(histogram[1:])])
+    return [100 * float(within[min(m, len(within) - 1)]) / num_of_users for m in ms]
+
+
+def evaluate(mdp, alpha=10, ms=(10,), processes=1):
+    """
+    Function to compute the exponential decay score and the recommendation scores in one pass over the users.
+    :param mdp: a trained MDP
+    :param alpha: a parameter in exponential decay score
+    :param ms: the list sizes for the recommendation score
+    :param processes: the number of worker processes
+    :return: the decay score and a list with the recommendation score for each m
+    """
+
+    histogram, num_of_users = rank_histogram(mdp, processes)
+    return decay_score(histogram, num_of_users, alpha), recommendation_scores(histogram, num_of_users, ms)
+
+
+def _init_worker(shared):
+    """
+    Function to give a worker process the shared evaluation data.
+    :param shared: the data
+    :return: None
+    """
+
+    _shared.update(shared)
+
+
+def _chunk_histogram(chunk):
+    """
+    Function to build the rank histogram of a chunk of users.
+    :param chunk: the start and end of each user's span in the shared codes
+    :return: an array with the weight of each rank
+    """
+
+    starts, ends = chunk
+    codes = _shared['codes']
+    model = _shared['model']
+    k = _shared['k']
+    num_of_actions = _shared['num_of_actions']
+
+    # The state before each held-out game, and the game itself
+    held_out = ends - starts - k
+    states = model.find(model.codec.windows(codes, starts, ends - 1))
+    positions = np.repeat(starts + k - np.cumsum(held_out) + held_out, held_out) + np.arange(held_out.sum())
+    actions = codes[positions].astype(np.int64) - 1
+    actions[actions >= num_of_actions] = -1
+
+    # Rank of the held-out game in its state's list, 0 if it is not there
+    found = states >= 0
+    ranked = model.ranked_actions[np.where(found, states, 0)]
+    hits = (ranked == actions[:, None]) & found[:, None] & (actions[:, None] >= 0)
+    ranks = np.where(hits.any(axis=1), np.argmax(hits, axis=1) + 1, 0)
+
+    weights = np.repeat(1 / held_out, held_out)
+    return np.bincount(ranks, weights, minlength=model.ranked_actions.shape[1] + 1)
@@ -16,15 +16,14 @@ def graph_recommendation_score(scale=4, m=10, with_comparison=False):
     k = [i+1 for i in range(1, scale)]
     x = [i + 1 for i in range(m)]
     for j in k:
-        y_recommendation = []
         y_recommendation_rand = []
         rs = MDP(path='data-mini', k=j)
         rs.load('mdp-model_k=' + str(j) + '.pkl')
-        for i in x:
-            if with_comparison:
-                rs.initialise_mdp()
-                y_recommendation_rand.append(rs.evaluate_recommendation_score(m=i))
-            y_recommendation.append(rs.evaluate_recommendation_score(m=i))
+        # Every m is computed from the same ranks of the held-out games
+        y_recommendation = rs.evaluate_recommendation_score(m=x)
+        if with_comparison:
+            rs.initialise_mdp()
+            y_recommendation_rand = rs.evaluate_recommendation_score(m=x)
 
         plt.plot(x, y_recommendation, color=(0.2 + (j-2)*0.4, 0.4, 0.6, 0.6), label="MC model " + str(j))
         plt.scatter(x, y_recommendation, color=(0.2 + (j-2)*0.4, 0.4, 0.6, 0.6))
@@ -0,0 +1,241 @@
+import csv
+import gzip
+import itertools
+import os
+from array import array
+from collections.abc import MutableMapping
+
+import numpy as np
+
+
+def open_data(path):
+    """
+    Function to open a data file for reading, gzip files are read transparently.
+    :param path: path to the file, path + ".gz" is used if only the compressed file exists
+    :return: a text file object
+    """
+
+    if not path.endswith('.gz') and not os.path.exists(path) and os.path.exists(path + '.gz'):
+        path = path + '.gz'
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', newline='')
+    return open(path, newline='')
+
+
+def read_rows(path, chunk_size=65536):
+    """
+    Generator to read a csv file in chunks of rows, skipping the header.
+    :param path: path to the file
+    :param chunk_size: the number of rows in each chunk
+    :return: yields lists of rows
+    """
+
+    with open_data(path) as f:
+        csv_f = csv.reader(f)
+        next(csv_f, None)
+        while True:
+            chunk = list(itertools.islice(csv_f, chunk_size))
+            if not chunk:
+                break
+            yield chunk
+
+
+class TransactionLog:
+    """
+    Class to hold the purchase history of every user as columnar arrays.
+
+    The games of user i are games[indptr[i]:indptr[i + 1]], in the order they were first seen and without
+    duplicates, as indices into game_ids.
+    """
+
+    def __init__(self, user_ids, game_ids, indptr, games, hours_sum, hours_count):
+        """
+        The constructor for the TransactionLog class.
+        :param user_ids: the list of user ids
+        :param game_ids: the list of game ids
+        :param indptr: the start of each user's history in games
+        :param games: the game index of each history entry
+        :param hours_sum: the sum of the values of the transactions of each game
+        :param hours_count: the number of transactions of each game
+        """
+
+        self.user_ids = user_ids
+        self.game_ids = game_ids
+        self.user_index = {user: ind for ind, user in enumerate(user_ids)}
+        self.game_index = {game: ind for ind, game in enumerate(game_ids)}
+        self.indptr = indptr
+        self.games = games
+        self.hours_sum = hours_sum
+        self.hours_count = hours_count
+
+    @property
+    def hours(self):
+        """
+        The average value of the transactions of each game.
+        :return: an array of averages
+        """
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.hours_sum / self.hours_count
+
+    @classmethod
+    def from_csv(cls, u_path, t_path, chunk_size=65536):
+        """
+        Method to read the users and transactions in one streaming pass.
+        :param u_path: path to the users file
+        :param t_path: path to the transactions file
+        :param chunk_size: the number of rows parsed at once
+        :return: a TransactionLog
+        """
+
+        # Every user gets a history, even without transactions
+        user_index = {}
+        for chunk in read_rows(u_path, chunk_size):
+            for row in chunk:
+                user_index.setdefault(row[0], len(user_index))
+
+        game_index = {}
+        users = array('q')
+        games = array('q')
+        hours_sum = np.zeros(0)
+        hours_count = np.zeros(0, dtype=np.int64)
+        for chunk in read_rows(t_path, chunk_size):
+            chunk_games = array('q', [game_index.setdefault(row[1], len(game_index)) for row in chunk])
+            users.extend(user_index.setdefault(row[0], len(user_index)) for row in chunk)
+            games.extend(chunk_games)
+
+            # Accumulate the hours of each game as the chunks go by
+            chunk_games = np.frombuffer(chunk_games, dtype=np.int64)
+            values = np.array([float(row[3]) for row in chunk])
+            hours_sum = _grow(hours_sum, len(game_index)) + np.bincount(chunk_games, values, len(game_index))
+            hours_count = _grow(hours_count, len(game_index)) + np.bincount(chunk_games, minlength=len(game_index))
+
+        users = np.frombuffer(users, dtype=np.int64) if users else np.zeros(0, dtype=np.int64)
+        games = np.frombuffer(games, dtype=np.int64) if games else np.zeros(0, dtype=np.int64)
+
+        # Keep the first time each user bought each game, then group by user keeping that order
+        num_of_games = max(len(game_index), 1)
+        _, first = np.unique(users * num_of_games + games, return_index=True)
+        first.sort()
+        first = first[np.argsort(users[first], kind='stable')]
+
+        indptr = np.zeros(len(user_index) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(users[first], minlength=len(user_index)), out=indptr[1:])
+        return cls(list(user_index), list(game_index), indptr, games[first].astype(np.int32), hours_sum, hours_count)
+
+    def extend(self, rows):
+        """
+        Method to append new transactions to the log.
+        :param rows: transaction rows as [ user_id, game_id, behaviour, value ]
+        :return: a list of (user index, previous history length) for the users that got new games
+        """
+
+        added = {}
+        for row in rows:
+            if row[1] not in self.game_index:
+                self.game_index[row[1]] = len(self.game_ids)
+                self.game_ids.append(row[1])
+                self.hours_sum = np.append(self.hours_sum, 0.0)
+                self.hours_count = np.append(self.hours_count, 0)
+            game = self.game_index[row[1]]
+            self.hours_sum[game] += float(row[3])
+            self.hours_count[game] += 1
+
+            if row[0] not in self.user_index:
+                self.user_index[row[0]] = len(self.user_ids)
+                self.user_ids.append(row[0])
+                self.indptr = np.append(self.indptr, self.indptr[-1])
+            user = self.user_index[row[0]]
+            if user not in added:
+                added[user] = (set(self.history(user).tolist()), [])
+            seen, new_games = added[user]
+            if game not in seen:
+                seen.add(game)
+                new_games.append(game)
+
+        # Insert the new games at the end of each user's history
+        added = [(user, new_games) for user, (_, new_games) in sorted(added.items()) if new_games]
+        if not added:
+            return []
+        old_lengths = [int(self.indptr[user + 1] - self.indptr[user]) for user, _ in added]
+        positions = np.concatenate([np.full(len(new_games), self.indptr[user + 1]) for user, new_games in added])
+        self.games = np.insert(self.games, positions, np.concatenate([new_games for _, new_games in added]))
+        counts = np.zeros(len(self.user_ids), dtype=np.int64)
+        for user, new_games in added:
+            counts[user] = len(new_games)
+        self.indptr = self.indptr + np.concatenate([[0], np.cumsum(counts)])
+        return [(user, old_length) for (user, _), old_length in zip(added, old_lengths)]
+
+    def history(self, user_ind):
+        """
+        Method to get the games of a user as indices.
+        :param user_ind: the index of the user
+        :return: an array of game indices
+        """
+
+        return self.games[self.indptr[user_ind]:self.indptr[user_ind + 1]]
+
+    def average_hours(self):
+        """
+        Method to get the average value of the transactions of each game.
+        :return: { game_id: average, ... }
+        """
+
+        return dict(zip(self.game_ids, self.hours.tolist()))
+
+
+class UserHistories(MutableMapping):
+    """
+    Dict-like view of a TransactionLog as { user_id: [ game_id, ... ], ... }.
+
+    Histories that are assigned are kept aside and take precedence over the log.
+    """
+
+    def __init__(self, log):
+        """
+        The constructor for the UserHistories class.
+        :param log: the TransactionLog
+        """
+
+        self.log = log
+        self.overrides = {}
+
+    def __getitem__(self, user):
+        if user in self.overrides:
+            return self.overrides[user]
+        game_ids = self.log.game_ids
+        return [game_ids[g] for g in self.log.history(self.log.user_index[user]).tolist()]
+
+    def __setitem__(self, user, games):
+        self.overrides[user] = list(games)
+
+    def __delitem__(self, user):
+        raise TypeError("Users cannot be removed from the transaction log")
+
+    def __iter__(self):
+        yield from self.log.user_ids
+        for user in self.overrides:
+            if user not in self.log.user_index:
+                yield user
+
+    def __len__(self):
+        return len(self.log.user_ids) + sum(1 for user in self.overrides if user not in self.log.user_index)
+
+    def __contains__(self, user):
+        return user in self.log.user_index or user in self.overrides
+
+    def copy(self):
+        return dict(self)
+
+
+def _grow(arr, size):
+    """
+    Function to pad an array with zeros up to a given size.
+    :param arr: the array
+    :param size: the size required
+    :return: the padded array
+    """
+
+    if len(arr) >= size:
+        return arr
+    return np.concatenate([arr, np.zeros(size - len(arr), dtype=arr.dtype)])
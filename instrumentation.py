@@ -0,0 +1,213 @@
+import cProfile
+import io
+import json
+import pstats
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss():
+    """
+    Function to get the peak resident set size of the process.
+    :return: the peak in bytes, None where it is not available
+    """
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Instrumentation:
+    """
+    Class to record timed spans, gauges and events of a run and export them.
+
+    A span times a phase such as reading the data or building the transition table. Gauges hold sizes like the number
+    of states or the non-zero transitions and events hold repeated records like the stats of each solver iteration.
+    With profile set to 'cprofile' or 'tracemalloc' every span also captures its hottest functions or its peak
+    traced memory and largest allocations.
+    """
+
+    def __init__(self, verbose=False, profile=None, prefix='mdp', top=20):
+        """
+        The constructor for the Instrumentation class.
+        :param verbose: flag to print each span and event as it happens
+        :param profile: None, 'cprofile' or 'tracemalloc'
+        :param prefix: the prefix of the Prometheus metric names
+        :param top: the number of functions or allocation sites kept for each profiled span
+        """
+
+        if profile not in (None, 'cprofile', 'tracemalloc'):
+            raise ValueError("Unknown profile mode " + str(profile) + ", expected cprofile or tracemalloc")
+        self.verbose = verbose
+        self.profile = profile
+        self.prefix = prefix
+        self.top = top
+        self.spans = []
+        self.gauges = {}
+        self.events = {}
+        self._open = []
+
+    def log(self, message):
+        """
+        Method to print a message when verbose.
+        :param message: the message
+        :return: None
+        """
+
+        if self.verbose:
+            print(message)
+
+    @contextmanager
+    def span(self, name, message=None):
+        """
+        Method to time a phase, spans opened inside it are nested under it.
+        :param name: the name of the phase
+        :param message: printed when the phase starts if verbose
+        :return: a context manager yielding the span record, extra fields can be added to it
+        """
+
+        if message:
+            self.log(message)
+        record = {'name': '.'.join([span['name'] for span in self._open] + [name]), 'start': time.time()}
+        self._open.append({'name': name})
+        profiler = None
+        # Only one profiler can run at a time, so nested spans are covered by the outermost one
+        if self.profile == 'cprofile' and len(self._open) == 1:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        elif self.profile == 'tracemalloc':
+            started = not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            record['peak_rss_bytes'] = peak_rss()
+            if profiler is not None:
+                profiler.disable()
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(self.top)
+                record['profile'] = out.getvalue()
+            elif self.profile == 'tracemalloc':
+                # Nested spans reset the peak, so theirs count towards this one
+                record['peak_traced_bytes'] = max(tracemalloc.get_traced_memory()[1],
+                                                  self._open[-1].get('child_peak', 0))
+                if len(self._open) > 1:
+                    self._open[-2]['child_peak'] = max(self._open[-2].get('child_peak', 0),
+                                                       record['peak_traced_bytes'])
+                record['allocations'] = [str(stat) for stat in
+                                         tracemalloc.take_snapshot().compare_to(before, 'lineno')[:self.top]]
+                if started:
+                    tracemalloc.stop()
+            self._open.pop()
+            self.spans.append(record)
+            self.log(record['name'] + " took " + "%.3f" % record['seconds'] + "s")
+
+    def gauge(self, name, value):
+        """
+        Method to record the latest value of a quantity.
+        :param name: the name of the quantity
+        :param value: the value
+        :return: None
+        """
+
+        self.gauges[name] = value
+
+    def event(self, name, message=None, **fields):
+        """
+        Method to record one occurrence of a repeated event.
+        :param name: the name of the event
+        :param message: printed if verbose
+        :param fields: the values recorded
+        :return: None
+        """
+
+        self.events.setdefault(name, []).append(fields)
+        if message:
+            self.log(message)
+
+    def summary(self):
+        """
+        Method to get the total time of each span name.
+        :return: { name: { 'count': n, 'seconds': total }, ... }
+        """
+
+        totals = {}
+        for record in self.spans:
+            total = totals.setdefault(record['name'], {'count': 0, 'seconds': 0.0})
+            total['count'] += 1
+            total['seconds'] += record['seconds']
+        return totals
+
+    def to_dict(self):
+        """
+        Method to get everything recorded.
+        :return: a dict with the spans, gauges, events and the peak resident set size
+        """
+
+        return {'spans': self.spans, 'gauges': self.gauges, 'events': self.events, 'peak_rss_bytes': peak_rss()}
+
+    def to_json(self):
+        """
+        Method to export everything recorded as JSON.
+        :return: a JSON string
+        """
+
+        return json.dumps(self.to_dict(), indent=1, default=str)
+
+    def to_prometheus(self):
+        """
+        Method to export the span totals, gauges and event counts in the Prometheus text format.
+        :return: a string
+        """
+
+        p = self.prefix
+        summary = self.summary()
+        lines = ['# TYPE ' + p + '_span_seconds_total counter']
+        lines.extend(p + '_span_seconds_total{span="' + name + '"} ' + repr(total['seconds'])
+                     for name, total in summary.items())
+        lines.append('# TYPE ' + p + '_span_count counter')
+        lines.extend(p + '_span_count{span="' + name + '"} ' + str(total['count']) for name, total in summary.items())
+        for name, value in self.gauges.items():
+            if isinstance(value, (int, float)):
+                lines.append('# TYPE ' + p + '_' + name + ' gauge')
+                lines.append(p + '_' + name + ' ' + repr(value))
+        lines.append('# TYPE ' + p + '_events_total counter')
+        for name, records in self.events.items():
+            lines.append(p + '_events_total{event="' + name + '"} ' + str(len(records)))
+        rss = peak_rss()
+        if rss is not None:
+            lines.append('# TYPE ' + p + '_peak_rss_bytes gauge')
+            lines.append(p + '_peak_rss_bytes ' + str(rss))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Method to write everything recorded to a file, in the Prometheus text format if it ends in .prom and as JSON
+        otherwise.
+        :param path: the file to write
+        :return: None
+        """
+
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus() if path.endswith('.prom') else self.to_json())
+
+    def __getstate__(self):
+        # Open spans are tied to the running process
+        state = dict(self.__dict__)
+        state['_open'] = []
+        return state
@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import quote
+
+import numpy as np
+
+from ingest import read_rows
+
+
+async def _client(host, port, requests, latencies, errors):
+    """
+    Function to send requests one after another over a single keep-alive connection.
+    :param host: the address of the server
+    :param port: the port of the server
+    :param requests: a list of (method, target, body) tuples
+    :param latencies: the list the latency of each request is appended to
+    :param errors: a dict counting the responses that were not 200 by status
+    :return: None
+    """
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for method, target, body in requests:
+            data = b'' if body is None else json.dumps(body).encode('utf-8')
+            start = time.perf_counter()
+            writer.write((method + ' ' + target + ' HTTP/1.1\r\nHost: ' + host + '\r\nContent-Length: ' +
+                          str(len(data)) + '\r\n\r\n').encode('latin-1') + data)
+            await writer.drain()
+
+            # Read the status line, the headers and the body
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors[status] = errors.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def run(host='127.0.0.1', port=8000, users=(), games=(), num_of_requests=10000, concurrency=500,
+              purchase_share=0.0, seed=0):
+    """
+    Function to send requests for random users from many connections at once.
+    :param host: the address of the server
+    :param port: the port of the server
+    :param users: the user ids to ask for
+    :param games: the game ids bought in purchase requests
+    :param num_of_requests: the total number of requests
+    :param concurrency: the number of connections sending requests at the same time
+    :param purchase_share: the share of requests that record a purchase instead of asking for recommendations
+    :param seed: the seed of the random choices
+    :return: a dict with the latency percentiles in milliseconds, the throughput and the errors
+    """
+
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(num_of_requests):
+        user = rng.choice(users)
+        if games and rng.random() < purchase_share:
+            requests.append(('POST', '/purchase', {'user': user, 'game': rng.choice(games)}))
+        else:
+            requests.append(('GET', '/recommend?user=' + quote(user), None))
+
+    latencies = []
+    errors = {}
+    start = time.perf_counter()
+    await asyncio.gather(*[_client(host, port, requests[i::concurrency], latencies, errors)
+                           for i in range(min(concurrency, num_of_requests))])
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {'requests': len(latencies), 'seconds': elapsed, 'throughput': len(latencies) / elapsed,
+            'p50': float(np.percentile(latencies, 50)), 'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()), 'errors': errors}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the latency of the recommendation server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--path', default='data-mini')
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=500)
+    parser.add_argument('--purchase-share', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    user_ids = [row[0] for chunk in read_rows(args.path + "/users.csv") for row in chunk]
+    game_ids = [row[0] for chunk in read_rows(args.path + "/games.csv") for row in chunk]
+    report = asyncio.run(run(args.host, args.port, user_ids, game_ids, args.requests, args.concurrency,
+                             args.purchase_share, args.seed))
+    print(str(report['requests']) + " requests in " + "%.2f" % report['seconds'] + "s (" +
+          "%.0f" % report['throughput'] + " requests/s)")
+    print("p50 " + "%.2f" % report['p50'] + "ms, p99 " + "%.2f" % report['p99'] + "ms, max " +
+          "%.2f" % report['max'] + "ms")
+    if report['errors']:
+        print("Errors: " + ", ".join(str(status) + " x" + str(count) for status, count in report['errors'].items()))
@@ -1,326 +1,623 @@
-import operator
-import pickle
-import os
-from tabulate import tabulate
-
-from mdp_handler import MDPInitializer
-
-
-class MDP:
-    """
-    Class to run the MDP.
-    """
-
-    def __init__(self, path='data', alpha=1, k=3, discount_factor=0.999, verbose=True, save_path="saved-models"):
-        """
-        The constructor for the MDP class.
-        :param path: path to data
-        :param alpha: the proportionality constant when considering transitions
-        :param k: the number of items in each state
-        :param discount_factor: the discount factor for the MDP
-        :param verbose: flag to show steps
-        :param save_path: the path to which models should be saved and loaded from
-        """
-
-        # Initialize the MDPInitializer
-        self.mdp_i = MDPInitializer(path, k, alpha)
-        self.df = discount_factor
-        self.verbose = verbose
-        self.save_path = save_path
-        # The set of states
-        self.S = {}
-        # The set of state values
-        self.V = {}
-        # The set of actions
-        self.A = []
-        # The set of transitions
-        self.T = {}
-        # The policy of the MDP
-        self.policy = {}
-        # A policy list
-        self.policy_list = {}
-
-    def print_progress(self, message):
-        if self.verbose:
-            print(message)
-
-    def initialise_mdp(self):
-        """
-        The method to initialise the MDP.
-        :return: None
-        """
-
-        # Initialising the actions
-        self.print_progress("Getting set of actions.")
-        self.A = self.mdp_i.actions
-        self.print_progress("Set of actions obtained.")
-
-        # Initialising the states, state values, policy
-        self.print_progress("Getting states, state-values, policy.")
-        self.S, self.V, self.policy, self.policy_list = self.mdp_i.generate_initial_states()
-        self.print_progress("States, state-values, policy obtained.")
-
-        # Initialise the transition table
-        self.print_progress("Getting transition table.")
-        self.T = self.mdp_i.generate_transitions(self.S, self.A)
-        self.print_progress("Transition table obtained.")
-
-    def one_step_lookahead(self, state):
-        """
-        Helper function to calculate state-value function.
-        :param state: state to consider
-        :return: action values for that state
-        """
-
-        # Initialise the action values and set to 0
-        action_values = {}
-        for action in self.A:
-            action_values[action] = 0
-
-        # Calculate the action values for each action
-        for action in self.A:
-            for next_state, P_and_R in self.T[state][action].items():
-                if next_state not in self.V:
-                    self.V[next_state] = 0
-                # action_value +=  probability * (reward + (discount * next_state_value))
-                action_values[action] += P_and_R[0] * (P_and_R[1] + (self.df * self.V[next_state]))
-
-        return action_values
-
-    def update_policy(self):
-        """
-        Helper function to update the policy based on the value function.
-        :return: None
-        """
-
-        for state in self.S:
-            action_values = self.one_step_lookahead(state)
-
-            # The action with the highest action value is chosen
-            self.policy[state] = max(action_values.items(), key=operator.itemgetter(1))[0]
-            self.policy_list[state] = sorted(action_values.items(), key=lambda kv: kv[1], reverse=True)
-
-    def policy_eval(self):
-        """
-        Helper function to evaluate a policy
-        :return: estimated value of each state following the policy and state-value
-        """
-
-        # Initialise the policy values
-        policy_value = {}
-        for state in self.policy:
-            policy_value[state] = 0
-
-        # Find the policy value for each state and its respective action dictated by the policy
-        for state, action in self.policy.items():
-            for next_state, P_and_R in self.T[state][action].items():
-                if next_state not in self.V:
-                    self.V[next_state] = 0
-                # policy_value +=  probability * (reward + (discount * next_state_value))
-                policy_value[state] += P_and_R[0] * (P_and_R[1] + (self.df * self.V[next_state]))
-
-        return policy_value
-
-    def compare_policy(self, policy_prev):
-        """
-        Helper function to compare the given policy with the current policy
-        :param policy_prev: the policy to compare with
-        :return: a boolean indicating if the policies are different or not
-        """
-
-        for state in policy_prev:
-            # If the policy does not match even once then return False
-            if policy_prev[state] != self.policy[state]:
-                return False
-        return True
-
-    def policy_iteration(self, max_iteration=1000, start_where_left_off=False, to_save=True):
-        """
-        Algorithm to solve the MDP
-        :param max_iteration: maximum number of iterations to run.
-        :param start_where_left_off: flag to load a previous model(set False if not and filename otherwise)
-        :param to_save: flag to save the current model
-        :return: None
-        """
-
-        # Load a previous model
-        if start_where_left_off:
-            self.load(start_where_left_off)
-
-        # Start the policy iteration
-        policy_prev = self.policy.copy()
-        for i in range(max_iteration):
-            self.print_progress("Iteration" + str(i) + ":")
-
-            # Evaluate given policy
-            self.V = self.policy_eval()
-
-            # Improve policy
-            self.update_policy()
-
-            # If the policy not changed over 10 iterations it converged
-            if i % 10 == 0:
-                if self.compare_policy(policy_prev):
-                    self.print_progress("Policy converged at iteration " + str(i+1))
-                    break
-                policy_prev = self.policy.copy()
-
-        # Save the model
-        if to_save:
-            self.save("mdp-model_k=" + str(self.mdp_i.k) + ".pkl")
-
-    def save(self, filename):
-        """
-        Method to save the trained model
-        :param filename: the filename it should be saved as
-        :return: None
-        """
-
-        self.print_progress("Saving model to " + filename)
-        os.makedirs(self.save_path, exist_ok=True)
-        with open(self.save_path + "/" + filename, 'wb') as f:
-            pickle.dump(self.__dict__, f, pickle.HIGHEST_PROTOCOL)
-
-    def load(self, filename):
-        """
-        Method to load a previous trained model
-        :param filename: the filename from which the model should be extracted
-        :return: None
-        """
-
-        self.print_progress("Loading model from " + filename)
-        try:
-            with open(self.save_path + "/" + filename, 'rb') as f:
-                tmp_dict = pickle.load(f)
-            self.__dict__.update(tmp_dict)
-        except Exception as e:
-            print(e)
-
-    def save_policy(self, filename):
-        """
-        Method to save the policy
-        :param filename: the filename it should be saved as
-        :return: None
-        """
-
-        self.print_progress("Saving model to " + filename)
-        os.makedirs(self.save_path, exist_ok=True)
-        with open(self.save_path + "/" + filename, 'wb') as f:
-            pickle.dump(self.policy_list, f, pickle.HIGHEST_PROTOCOL)
-
-    def load_policy(self, filename):
-        """
-        Method to load a previous policy
-        :param filename: the filename from which the model should be extracted
-        :return: None
-        """
-
-        self.print_progress("Loading model from " + filename)
-        try:
-            with open(self.save_path + "/" + filename, 'rb') as f:
-                self.policy_list = pickle.load(f)
-        except Exception as e:
-            print(e)
-
-    def recommend(self, user_id):
-        """
-        Method to provide recommendation to the user
-        :param user_id: the user_id of a given user
-        :return: the game that is recommended
-        """
-
-        # self.print_progress("Recommending for " + str(user_id))
-        pre = []
-        for i in range(self.mdp_i.k - 1):
-            pre.append(None)
-        games = pre + self.mdp_i.transactions[user_id]
-
-        # for g in games[self.mdp_i.k-1:]:
-        #     print(self.mdp_i.games[g], self.mdp_i.game_price[g])
-
-        user_state = ()
-        for i in range(len(games) - self.mdp_i.k, len(games)):
-            user_state = user_state + (games[i],)
-        # print(self.mdp_i.game_price[self.policy[user_state]])
-        # return self.mdp_i.games[self.policy[user_state]]
-
-        rec_list = []
-        for game_details in self.policy_list[user_state]:
-            rec_list.append((self.mdp_i.games[game_details[0]], game_details[1]))
-
-        return rec_list
-
-    def evaluate_decay_score(self, alpha=10):
-        """
-        Method to evaluate the given MDP using exponential decay score
-        :param alpha: a parameter in exponential decay score
-        :return: the average score
-        """
-
-        transactions = self.mdp_i.transactions.copy()
-
-        user_count = 0
-        total_score = 0
-        # Generating a testing for each test case
-        for user in transactions:
-            total_list = len(transactions[user])
-            if total_list == 1:
-                continue
-
-            score = 0
-            for i in range(1, total_list):
-                self.mdp_i.transactions[user] = transactions[user][:i]
-
-                rec_list = self.recommend(user)
-                rec_list = [rec[0] for rec in rec_list]
-                m = rec_list.index(self.mdp_i.games[transactions[user][i]]) + 1
-                score += 2 ** ((1 - m) / (alpha - 1))
-
-            score /= (total_list - 1)
-            total_score += 100 * score
-            user_count += 1
-
-        return total_score / user_count
-
-    def evaluate_recommendation_score(self, m=10):
-        """
-        Function to evaluate the given MDP using exponential decay score
-        :param m: a parameter in recommendation score score
-        :return: the average score
-        """
-
-        transactions = self.mdp_i.transactions.copy()
-
-        user_count = 0
-        total_score = 0
-        # Generating a testing for each test case
-        for user in transactions:
-            total_list = len(transactions[user])
-            if total_list == 1:
-                continue
-
-            item_count = 0
-            for i in range(1, total_list):
-                self.mdp_i.transactions[user] = transactions[user][:i]
-
-                rec_list = self.recommend(user)
-                rec_list = [rec[0] for rec in rec_list]
-                rank = rec_list.index(self.mdp_i.games[transactions[user][i]]) + 1
-                if rank <= m:
-                    item_count += 1
-
-            score = item_count / (total_list - 1)
-            total_score += 100 * score
-            user_count += 1
-
-        return total_score / user_count
-
-
-if __name__ == '__main__':
-    rs = MDP(path='data-mini')
-    rs.load('mdp-model_k=3.pkl')
-    headers = ['Rank', 'Game', 'Score']
-    while True:
-        u = input("Enter a user ID: ")
-        r_list = rs.recommend(u)
-        print(tabulate([[ind+1, r[0], r[1]] for ind, r in enumerate(r_list)], headers, "psql"))
+import contextlib
+import pickle
+import os
+import numpy as np
+
+import evaluation
+import ingest
+import mdp_solvers
+import model_format
+from instrumentation import Instrumentation
+from mdp_handler import MDPInitializer
+from mdp_parallel import ParallelTransitions
+from model_registry import ModelRegistry
+from user_index import UserIndex
+
+
+class MDP:
+    """
+    Class to run the MDP.
+    """
+
+    def __init__(self, path='data', alpha=1, k=3, discount_factor=0.999, verbose=True, save_path="saved-models",
+                 top_n=None, mdp_i=None, instrumentation=None, implicit=False, counts_dir=None,
+                 processes=1, candidates=None, registry=None):
+        """
+        The constructor for the MDP class.
+        :param path: path to data
+        :param alpha: the proportionality constant when considering transitions
+        :param k: the number of items in each state
+        :param discount_factor: the discount factor for the MDP
+        :param verbose: flag to show steps
+        :param save_path: the path to which models should be saved and loaded from
+        :param top_n: the number of recommendations kept for each state (all games if None)
+        :param mdp_i: an MDPInitializer whose parsed data should be reused instead of reading path again
+        :param instrumentation: the Instrumentation recording the phases of the MDP (a new one if None)
+        :param implicit: flag to compute backups from per-state counts instead of storing every transition, which
+        takes num_of_actions times less memory
+        :param counts_dir: a directory to count the states and sequences on disk in, which keeps the memory used for
+        counting bounded for large k and datasets (counted in memory if None)
+        :param processes: the number of worker processes building the transitions and running the solver sweeps, each
+        on a shard of the states (1 runs everything in this process)
+        :param candidates: the number of most popular and of nearest games kept as outcomes of each action besides
+        the continuations seen after the state, which makes the table grow with the data rather than with the square
+        of the catalog (every outcome is kept if None)
+        :param registry: the ModelRegistry that model files are served from, shared to keep the models of several
+        MDPs under one memory budget (one without a budget for this MDP if None)
+        """
+
+        # The timed phases, sizes and solver iterations, printed as they happen if verbose
+        self.metrics = instrumentation or Instrumentation(verbose)
+        # Initialize the MDPInitializer
+        self.mdp_i = MDPInitializer(path, k, alpha, self.metrics) if mdp_i is None else mdp_i.with_k(k, self.metrics)
+        self.df = discount_factor
+        self.verbose = verbose
+        self.save_path = save_path
+        self.top_n = top_n
+        self.implicit = implicit
+        self.counts_dir = counts_dir
+        self.processes = processes
+        self.candidates = candidates
+        # The set of states
+        self.S = {}
+        # The set of state values
+        self.V = {}
+        # The set of actions
+        self.A = []
+        # The set of transitions, a TransitionTable
+        self.T = {}
+        # The policy of the MDP
+        self.policy = {}
+        # A policy list
+        self.policy_list = {}
+        # Ranked lists for the suffixes of the states, as tuples of codes, used for states not in the policy list
+        self.backoff = {}
+        # The key in the registry of a model file served instead of the policy list
+        self.registry = ModelRegistry() if registry is None else registry
+        self.model_key = None
+        # The policy list as a model_format.Model, rebuilt when the policy list is replaced
+        self._policy_model = (None, None)
+        # The current state of every user as a UserIndex, built from the transactions on first use
+        self.users = None
+
+    def initialise_mdp(self):
+        """
+        The method to initialise the MDP.
+        :return: None
+        """
+
+        with self.metrics.span('initialise'):
+            # Initialising the actions
+            self.A = self.mdp_i.actions
+
+            # Initialising the states, state values, policy, which replace any loaded model file
+            with self.metrics.span('states', "Getting states, state-values, policy."):
+                self.model_key = None
+                self.users = None
+                self.S, self.V, self.policy, self.policy_list = self.mdp_i.generate_initial_states(self.top_n,
+                                                                                                 self.counts_dir)
+                self.backoff = {}
+
+            # Initialise the transition table
+            with self.metrics.span('transitions', "Getting transition table."):
+                self.T = self.mdp_i.generate_transitions(self.S, self.A, implicit=self.implicit,
+                                                         processes=self.processes, candidates=self.candidates)
+
+    def policy_arrays(self):
+        """
+        Method to get the state values and policy as arrays ordered like the transition table.
+        :return: the value of each state and the action index of each state
+        """
+
+        # States added since the last solve start at value 0 with the first action
+        action_index = self.T.action_index
+        values = np.array([self.V.get(state, 0) for state in self.T.states], dtype=np.float64)
+        policy = np.array([action_index.get(self.policy.get(state), 0) for state in self.T.states], dtype=np.int64)
+        return values, policy
+
+    def set_policy_arrays(self, values, policy, action_values):
+        """
+        Method to store a solution given as arrays into the state values, policy and policy list.
+        :param values: the value of each state
+        :param policy: the action index of each state
+        :param action_values: the action values of each state
+        :return: None
+        """
+
+        states = self.T.states
+        actions = self.T.actions
+        self.V = dict(zip(states, values.tolist()))
+        self.policy = {state: actions[a] for state, a in zip(states, policy.tolist())}
+
+        # Rank the actions of each state by action value, keeping only the best top_n
+        ranking, scores = mdp_solvers.rank_actions(action_values, self.top_n)
+        self.policy_list = {state: [(actions[a], v) for a, v in zip(ranked, ranked_scores)]
+                            for state, ranked, ranked_scores in zip(states, ranking.tolist(), scores.tolist())}
+        self.backoff = self.backoff_lists(action_values)
+
+    def backoff_lists(self, action_values):
+        """
+        Method to rank the actions of every suffix of the states, from the k-1 last games down to none. The score of
+        an action for a suffix is its action value averaged over the states that end with the suffix, weighted by
+        how often each state was seen.
+        :param action_values: the action values of each state
+        :return: { suffix: [ (action, score), ... ], ... } with each suffix as a tuple of codes
+        """
+
+        k = self.mdp_i.k
+        actions = self.T.actions
+        codes = self.mdp_i.codec.unpack(self.T.state_keys)
+        weights = np.array([self.S.get(state, 1) for state in self.T.states], dtype=np.float64)
+        weighted = action_values * weights[:, None]
+
+        backoff = {}
+        for length in range(k):
+            # Group the states by their last length games
+            suffixes, inverse = np.unique(codes[:, k - length:], axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            sums = np.zeros((len(suffixes), len(actions)))
+            np.add.at(sums, inverse, weighted)
+            scores = sums / np.bincount(inverse, weights, len(suffixes))[:, None]
+
+            ranking, ranked_scores = mdp_solvers.rank_actions(scores, self.top_n)
+            for suffix, ranked, ranked_score in zip(suffixes.tolist(), ranking.tolist(), ranked_scores.tolist()):
+                backoff[tuple(suffix)] = [(actions[a], v) for a, v in zip(ranked, ranked_score)]
+        return backoff
+
+    def warm_start(self, previous):
+        """
+        Method to seed the state values and policy from a model trained with shorter states, usually k-1. Each state
+        starts from the best action and its score in the ranking of its last games, or of the longest suffix of them
+        that the model ranks.
+        :param previous: a trained MDP or model_format.Model
+        :return: the number of states seeded
+        """
+
+        model = previous.serving_model() if isinstance(previous, MDP) else previous
+        length = model.codec.length
+        if length > self.mdp_i.k or list(model.actions) != list(self.A):
+            raise ValueError("A model with " + str(length) + " games per state over other actions cannot seed k=" +
+                             str(self.mdp_i.k))
+        if not model.ranked_actions.shape[1]:
+            return 0
+
+        # Map every state to its last `length` games
+        states = list(self.V)
+        rows = self.mdp_i.codec.unpack(self.mdp_i.codec.as_array(states))[:, self.mdp_i.k - length:]
+        ranked_actions, ranked_scores, found = model.lookup(rows)
+        for state, action, value, seeded in zip(states, ranked_actions[:, 0].tolist(), ranked_scores[:, 0].tolist(),
+                                                found.tolist()):
+            if seeded:
+                self.V[state] = value
+                self.policy[state] = self.A[action]
+        return int(found.sum())
+
+    def policy_iteration(self, max_iteration=1000, start_where_left_off=False, to_save=True, tol=1e-6):
+        """
+        Algorithm to solve the MDP
+        :param max_iteration: maximum number of iterations to run.
+        :param start_where_left_off: flag to load a previous model(set False if not and filename otherwise)
+        :param to_save: flag to save the current model
+        :param tol: the Bellman residual below which the MDP is converged
+        :return: a list with the stats of each iteration
+        """
+
+        return self.solve('policy_iteration', max_iteration=max_iteration, start_where_left_off=start_where_left_off,
+                          to_save=to_save, tol=tol)
+
+    def solve(self, method='policy_iteration', max_iteration=None, start_where_left_off=False, to_save=True, tol=1e-6,
+              **options):
+        """
+        Method to solve the MDP with any of the solvers in mdp_solvers.SOLVERS
+        :param method: the name of the solver (policy_iteration, value_iteration, modified_policy_iteration,
+        gauss_seidel or prioritized_sweeping)
+        :param max_iteration: maximum number of iterations to run (the solver's default if None, 1000 sweeps or, for
+        prioritized sweeping, batches until every state is settled)
+        :param start_where_left_off: flag to load a previous model(set False if not and filename otherwise)
+        :param to_save: flag to save the current model
+        :param tol: the Bellman residual below which the MDP is converged
+        :param options: solver specific keyword arguments such as eval_sweeps, block_size or batch_size
+        :return: a list with the stats of each iteration
+        """
+
+        # Load a previous model
+        if start_where_left_off:
+            self.load(start_where_left_off)
+
+        # Start the solver
+        with self.metrics.span('solve', "Solving with " + method + "."):
+            values, policy = self.policy_arrays()
+            # Sweeps run on a pool of workers, one shard of states per task, when there is more than one process
+            pool = ParallelTransitions(self.T, self.processes) if self.processes > 1 else contextlib.nullcontext(self.T)
+            with pool as table:
+                values, policy, action_values, stats = mdp_solvers.solve(
+                    method, table, self.df, values, policy, max_iteration=max_iteration, tol=tol,
+                    callback=self._report, **options)
+            self.set_policy_arrays(values, policy, action_values)
+        self.metrics.gauge('iterations', len(stats))
+        self._report_unsettled(stats)
+
+        # Save the model
+        if to_save:
+            self.save("mdp-model_k=" + str(self.mdp_i.k) + ".pkl")
+            self.save_model("mdp-model_k=" + str(self.mdp_i.k) + ".mdpm")
+            self.save_users("mdp-users_k=" + str(self.mdp_i.k))
+
+        return stats
+
+    def _report(self, iteration_stats):
+        """
+        Method to record the stats of a solver iteration
+        :param iteration_stats: the stats of the iteration
+        :return: None
+        """
+
+        self.metrics.event('iteration', "Iteration" + str(iteration_stats['iteration']) + ": residual " +
+                           str(iteration_stats['residual']) + ", " + str(iteration_stats['changed']) +
+                           " actions changed", **iteration_stats)
+
+    def _report_unsettled(self, stats):
+        """
+        Method to record that prioritized sweeping stopped on max_iteration before every state was settled
+        :param stats: the stats of each iteration of the solver
+        :return: None
+        """
+
+        pending = stats[-1].get('pending', 0) if stats else 0
+        if pending:
+            self.metrics.event('unsettled', "Stopped on max_iteration with " + str(pending) +
+                               " states still above tol", pending=pending, iterations=len(stats))
+
+    def update(self, transactions, to_save=True, tol=1e-6, chunk_size=65536, **options):
+        """
+        Method to add new transactions to a trained MDP without rebuilding it. Only the transition rows of the states
+        whose counts changed are rebuilt and the solution is repaired with prioritized sweeping seeded with those
+        states. The hours per price used to compare games are kept from the last full build.
+        :param transactions: a list of transaction rows [ user_id, game_id, behaviour, value ] or the path to a csv file
+        of them
+        :param to_save: flag to save the updated model
+        :param tol: the Bellman residual below which the MDP is converged
+        :param chunk_size: the number of rows read at once from a csv file
+        :param options: keyword arguments passed on to prioritized sweeping such as batch_size
+        :return: a list with the stats of each iteration
+        """
+
+        with self.metrics.span('update'):
+            with self.metrics.span('add_transactions'):
+                if isinstance(transactions, str):
+                    affected = []
+                    for chunk in ingest.read_rows(transactions, chunk_size):
+                        affected.extend(self.mdp_i.add_transactions(chunk, self.S))
+                else:
+                    affected = self.mdp_i.add_transactions(transactions, self.S)
+            self.users = None
+
+            # Rebuild the rows of the affected states and re-solve from the previous solution
+            with self.metrics.span('transitions'):
+                self.T, subset = self.mdp_i.update_transitions(self.T, self.S, affected, candidates=self.candidates)
+            self.metrics.gauge('rebuilt_states', len(subset))
+            with self.metrics.span('solve'):
+                values, policy = self.policy_arrays()
+                values, policy, action_values, stats = mdp_solvers.solve(
+                    'prioritized_sweeping', self.T, self.df, values, policy, tol=tol, seeds=subset,
+                    callback=self._report, **options)
+                self.set_policy_arrays(values, policy, action_values)
+            self.model_key = None
+        self.metrics.gauge('iterations', len(stats))
+        self._report_unsettled(stats)
+
+        # Save the model
+        if to_save:
+            self.save("mdp-model_k=" + str(self.mdp_i.k) + ".pkl")
+            self.save_model("mdp-model_k=" + str(self.mdp_i.k) + ".mdpm")
+            self.save_users("mdp-users_k=" + str(self.mdp_i.k))
+
+        return stats
+
+    def save(self, filename):
+        """
+        Method to save the trained model
+        :param filename: the filename it should be saved as
+        :return: None
+        """
+
+        with self.metrics.span('save', "Saving model to " + filename):
+            os.makedirs(self.save_path, exist_ok=True)
+            with open(self.save_path + "/" + filename, 'wb') as f:
+                pickle.dump({key: value for key, value in self.__dict__.items()
+                             if key not in ('registry', 'model_key', '_policy_model', 'users', 'metrics')}, f,
+                            pickle.HIGHEST_PROTOCOL)
+
+    def load(self, filename):
+        """
+        Method to load a previous trained model
+        :param filename: the filename from which the model should be extracted
+        :return: None
+        """
+
+        with self.metrics.span('load', "Loading model from " + filename):
+            with open(self.save_path + "/" + filename, 'rb') as f:
+                tmp_dict = pickle.load(f)
+            # A model saved before states were keyed by codes holds an initializer without a codec or a columnar log,
+            # so the one parsed for this MDP is kept and the transitions are rebuilt from it
+            legacy = not hasattr(tmp_dict['mdp_i'], 'codec')
+            if legacy:
+                lengths = {len(state) for state in tmp_dict['S']}
+                if lengths and lengths != {self.mdp_i.k}:
+                    raise ValueError("The model in " + filename + " has states of " + str(lengths.pop()) +
+                                     " games, this MDP has k=" + str(self.mdp_i.k))
+                tmp_dict['mdp_i'] = self.mdp_i
+            self.__dict__.update(tmp_dict)
+            self.users = None
+            # The loaded initializer reports to this MDP's instrumentation
+            self.mdp_i.metrics = self.metrics
+            for name in ('S', 'V', 'policy', 'policy_list'):
+                setattr(self, name, self.encode_state_keys(getattr(self, name)))
+
+            if legacy:
+                with self.metrics.span('transitions', "Rebuilding the transition table."):
+                    # Counts the sequences the transitions are built from
+                    self.mdp_i.generate_initial_states(self.top_n, self.counts_dir)
+                    self.A = self.mdp_i.actions
+                    self.T = self.mdp_i.generate_transitions(self.S, self.A, implicit=self.implicit,
+                                                             processes=self.processes, candidates=self.candidates)
+                    values, _ = self.policy_arrays()
+                    self.backoff = self.backoff_lists(self.T.backup(values, self.df))
+
+    def save_policy(self, filename):
+        """
+        Method to save the policy
+        :param filename: the filename it should be saved as
+        :return: None
+        """
+
+        self.metrics.log("Saving model to " + filename)
+        os.makedirs(self.save_path, exist_ok=True)
+        with open(self.save_path + "/" + filename, 'wb') as f:
+            pickle.dump(self.policy_list, f, pickle.HIGHEST_PROTOCOL)
+
+    def load_policy(self, filename):
+        """
+        Method to load a previous policy
+        :param filename: the filename from which the model should be extracted
+        :return: None
+        """
+
+        self.metrics.log("Loading model from " + filename)
+        try:
+            with open(self.save_path + "/" + filename, 'rb') as f:
+                self.policy_list = self.encode_state_keys(pickle.load(f))
+        except Exception as e:
+            print(e)
+
+    def save_model(self, filename):
+        """
+        Method to save the policy in the binary model format which can be served with load_model
+        :param filename: the filename it should be saved as
+        :return: None
+        """
+
+        with self.metrics.span('save_model', "Saving model to " + filename):
+            model = model_format.build_model(self.mdp_i.codec, self.mdp_i.actions, self.policy_list, self.policy,
+                                             self.V, {'k': self.mdp_i.k, 'alpha': self.mdp_i.alpha,
+                                                      'discount_factor': self.df,
+                                                      'dataset': os.path.dirname(self.mdp_i.u_path)}, self.backoff)
+            model_format.save_model(self.save_path + "/" + filename, model)
+
+    def load_model(self, filename):
+        """
+        Method to serve a model saved with save_model, only its header is read here and the registry opens it on first
+        use, with the arrays memory-mapped and not read up front
+        :param filename: the filename from which the model should be opened
+        :return: None
+        """
+
+        with self.metrics.span('load_model', "Loading model from " + filename):
+            self.model_key = self.registry.register_file(self.save_path + "/" + filename)
+
+    def save_users(self, filename):
+        """
+        Method to save the last games of every user as a UserIndex, which serve opens with a model file
+        :param filename: the path of the index, relative to save_path
+        :return: None
+        """
+
+        with self.metrics.span('save_users', "Saving user index to " + filename):
+            self.user_index().save(self.save_path + "/" + filename)
+
+    def user_index(self):
+        """
+        Method to get the current state of every user, built once from the transactions
+        :return: a UserIndex
+        """
+
+        if self.users is None:
+            self.users = self.mdp_i if isinstance(self.mdp_i, UserIndex) else UserIndex.build(self.mdp_i)
+        return self.users
+
+    def record_purchase(self, user_id, game):
+        """
+        Method to move a user to the state after buying a game, in O(k) and seen by the next recommendation. The
+        purchase is not added to the transactions, update does that
+        :param user_id: the user_id of a given user
+        :param game: the game bought
+        :return: the games of the user's new state, None for padding
+        """
+
+        row = self.user_index().record_purchase(user_id, game)
+        return [self.mdp_i.codec.decode_item(code) for code in row[len(row) - self.mdp_i.k:].tolist()]
+
+    @classmethod
+    def serve(cls, model_filename, users_filename, save_path="saved-models", registry=None, verbose=False):
+        """
+        Method to open an MDP that only serves a model file, with a UserIndex in place of the parsed data, so none of
+        the csv files are read. It can recommend but not be trained or updated
+        :param model_filename: the filename of the model saved with save_model
+        :param users_filename: the filename of the index saved with save_users
+        :param save_path: the path the files were saved to
+        :param registry: the ModelRegistry the model file is served from (one without a budget if None)
+        :param verbose: flag to show steps
+        :return: an MDP
+        """
+
+        registry = ModelRegistry() if registry is None else registry
+        model_key = registry.register_file(save_path + "/" + model_filename)
+        users = UserIndex.load(save_path + "/" + users_filename)
+        if model_format.read_header(save_path + "/" + model_filename)[0]['items'] != users.codec.items:
+            raise ValueError(users_filename + " indexes a different set of games than " + model_filename)
+        rs = cls(path=None, alpha=model_key[2], k=model_key[1], discount_factor=model_key[3], verbose=verbose,
+                 save_path=save_path, mdp_i=users, registry=registry)
+        rs.A = rs.mdp_i.actions
+        rs.model_key = model_key
+        return rs
+
+    @property
+    def model(self):
+        """
+        The model file served instead of the policy list, opened again by the registry if it was evicted
+        :return: a model_format.Model or None
+        """
+
+        return None if self.model_key is None else self.registry.get(self.model_key)
+
+    def encode_state_keys(self, table):
+        """
+        Method to convert a table saved with tuple states to one keyed by state codes
+        :param table: a dict keyed by states
+        :return: the dict keyed by state codes
+        """
+
+        if not any(isinstance(state, tuple) for state in table):
+            return table
+        return {self.mdp_i.codec.encode(state): value for state, value in table.items()}
+
+    def recommend(self, user_id):
+        """
+        Method to provide recommendation to the user
+        :param user_id: the user_id of a given user
+        :return: the game that is recommended
+        """
+
+        # self.metrics.log("Recommending for " + str(user_id))
+        # The codes of the user's last k games, kept up to date by record_purchase
+        row = self.user_index().state(user_id)
+        codes = row[len(row) - self.mdp_i.k:]
+        user_state = self.mdp_i.codec.pack(codes[None, :]).tolist()[0]
+
+        rec_list = []
+        model = self.model
+        if model is not None:
+            ranked = model.ranked(user_state)
+        elif user_state in self.policy_list:
+            ranked = self.policy_list[user_state]
+        else:
+            ranked = self.backoff_ranked(codes.tolist())
+        for game_details in ranked:
+            rec_list.append((self.mdp_i.games[game_details[0]], game_details[1]))
+
+        return rec_list
+
+    def backoff_ranked(self, codes):
+        """
+        Method to get the ranked list of the longest suffix of a state that is in the backoff lists
+        :param codes: the codes of the games of the state
+        :return: a list of (action, score) tuples
+        """
+
+        for length in range(len(codes) - 1, -1, -1):
+            suffix = tuple(codes[len(codes) - length:])
+            if suffix in self.backoff:
+                return self.backoff[suffix]
+        raise KeyError(tuple(codes))
+
+    def serving_model(self):
+        """
+        Method to get the rankings as flat arrays, either the loaded model file or the policy list converted once
+        :return: a model_format.Model
+        """
+
+        model = self.model
+        if model is not None:
+            return model
+        if self._policy_model[0] is not self.policy_list:
+            self._policy_model = (self.policy_list,
+                                  model_format.build_model(self.mdp_i.codec, self.mdp_i.actions, self.policy_list,
+                                                           self.policy, self.V, backoff=self.backoff))
+        return self._policy_model[1]
+
+    def recommend_many(self, user_ids, top_n=None, titles=False):
+        """
+        Method to provide recommendations to many users at once
+        :param user_ids: the user_ids of the users
+        :param top_n: the number of recommendations for each user (all ranked games if None)
+        :param titles: flag to return game titles instead of game ids
+        :return: an array of game ids (or titles) and an array of scores, both of shape (len(user_ids), top_n)
+        """
+
+        user_ids = list(user_ids)
+
+        # Resolve the current state of every user in one pass
+        names, scores, found = self.recommend_codes(self.user_index().recent_codes(user_ids, self.mdp_i.k), top_n,
+                                                    titles)
+        if not found.all():
+            raise KeyError(user_ids[int(np.argmin(found))])
+        return names, scores
+
+    def recommend_codes(self, rows, top_n=None, titles=False):
+        """
+        Method to provide recommendations for states given as the codes of their games
+        :param rows: an array of shape (n, k) with the codes of the last k games of each user, 0 for None
+        :param top_n: the number of recommendations for each state (all ranked games if None)
+        :param titles: flag to return game titles instead of game ids
+        :return: an array of game ids (or titles), an array of scores, both of shape (n, top_n), and whether each state
+        or one of its suffixes is in the model, the rows of states that are not are meaningless
+        """
+
+        model = self.serving_model()
+        ranked, scores, found = model.lookup(rows)
+        ranked, scores = ranked[:, :top_n], scores[:, :top_n]
+        if titles:
+            names = np.array([self.mdp_i.games[action] for action in model.actions] or [''], dtype=object)
+        else:
+            names = np.array(model.actions or [''], dtype=object)
+        return names[ranked], scores, found
+
+    def evaluate_decay_score(self, alpha=10, processes=1):
+        """
+        Method to evaluate the given MDP using exponential decay score
+        :param alpha: a parameter in exponential decay score
+        :param processes: the number of worker processes
+        :return: the average score
+        """
+
+        histogram, num_of_users = evaluation.rank_histogram(self, processes)
+        return evaluation.decay_score(histogram, num_of_users, alpha)
+
+    def evaluate_recommendation_score(self, m=10, processes=1):
+        """
+        Function to evaluate the given MDP using recommendation score
+        :param m: a parameter in recommendation score, an int or a list of them
+        :param processes: the number of worker processes
+        :return: the average score, or a list of scores if m is a list
+        """
+
+        histogram, num_of_users = evaluation.rank_histogram(self, processes)
+        if isinstance(m, int):
+            return evaluation.recommendation_scores(histogram, num_of_users, [m])[0]
+        return evaluation.recommendation_scores(histogram, num_of_users, m)
+
+
+if __name__ == '__main__':
+    from tabulate import tabulate
+
+    # Serve the model file when its user index was saved, without reading the data
+    if os.path.exists("saved-models/mdp-users_k=3.json") and os.path.exists("saved-models/mdp-model_k=3.mdpm"):
+        rs = MDP.serve('mdp-model_k=3.mdpm', 'mdp-users_k=3')
+    else:
+        rs = MDP(path='data-mini')
+        rs.load('mdp-model_k=3.pkl')
+    headers = ['Rank', 'Game', 'Score']
+    while True:
+        u = input("Enter a user ID: ")
+        r_list = rs.recommend(u)
+        print(tabulate([[ind+1, r[0], r[1]] for ind, r in enumerate(r_list)], headers, "psql"))
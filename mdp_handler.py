@@ -1,234 +1,765 @@
-import csv
-import random
-
-
-class MDPInitializer:
-    """
-    Class to generate state space.
-    """
-
-    def __init__(self, data_path, k, alpha):
-        """
-        The constructor for the MDPInitializer class.
-        Parameters:
-        :param data_path: path to data
-        :param k: the number of items in each state
-        :param alpha: the proportionality constant when considering transitions
-        """
-
-        self.u_path = data_path + "/users.csv"
-        self.t_path = data_path + "/transactions.csv"
-        self.g_path = data_path + "/games.csv"
-        self.k = k
-        self.alpha = alpha
-        self.total_sequences = {}
-
-        self.game_data = {}
-        self.transactions = {}
-        # Get user data and initialise transactions under each user
-        self.fill_user_data()
-        # Store transactions as { user_id : { game_title : [ play, purchase, play, ... ], ... }, ... }
-        self.fill_transaction_data()
-
-        self.actions, self.games, self.game_price = self.get_action_data()
-        self.num_of_actions = len(self.actions)
-
-    def fill_user_data(self):
-        """
-        The method to fill user data.
-        :return: None
-        """
-
-        with open(self.u_path) as f:
-            csv_f = csv.reader(f)
-            next(csv_f)
-            for row in csv_f:
-                self.transactions[row[0]] = []
-
-    def fill_transaction_data(self):
-        """
-        The method to fill the transactions for each user.
-        :return: None
-        """
-
-        with open(self.t_path) as f:
-            csv_f = csv.reader(f)
-            next(csv_f)
-            for row in csv_f:
-                if row[1] not in self.transactions[row[0]]:
-                    self.transactions[row[0]].append(row[1])
-                if row[1] not in self.game_data:
-                    self.game_data[row[1]] = [0, 0]
-                self.game_data[row[1]][0] += float(row[3])
-                self.game_data[row[1]][1] += 1
-
-        for game in self.game_data:
-            self.game_data[game] = self.game_data[game][0] / self.game_data[game][1]
-
-    def get_action_data(self):
-        """
-        The method to obtain all games which will be actions.
-        :return: list of the games/actions
-        """
-
-        actions = []
-        games = {}
-        game_price = {}
-        with open(self.g_path) as f:
-            csv_f = csv.reader(f)
-            next(csv_f)
-            for row in csv_f:
-                actions.append(row[0])
-                games[row[0]] = row[1]
-                game_price[row[0]] = int(row[2])
-        return actions, games, game_price
-
-    def generate_initial_states(self):
-        """
-        The method to generate an initial state space.
-        :return: states and the corresponding value vector
-        """
-
-        states = {}
-        state_value = {}
-        policy = {}
-        policy_list = {}
-
-        for user in self.transactions:
-            # Prepend Nones for first transactions
-            pre = []
-            for i in range(self.k - 1):
-                pre.append(None)
-            games = pre + self.transactions[user]
-
-            # Generate states of k items
-            for i in range(0, len(games) - self.k + 1):
-                temp_tup = ()
-                for j in range(self.k):
-                    temp_tup = temp_tup + (games[i + j],)
-
-                if temp_tup in states:
-                    states[temp_tup] = states[temp_tup] + 1
-                else:
-                    states[temp_tup] = 1
-                    state_value[temp_tup] = 0
-                    policy[temp_tup] = random.choice(self.actions)
-                    policy_list[temp_tup] = random.sample(self.actions, len(self.actions))
-                    for ind in range(len(policy_list[temp_tup])):
-                        policy_list[temp_tup][ind] = (policy_list[temp_tup][ind], 1)
-
-            # Generate states of k+1 items
-            for i in range(0, len(games) - self.k - 1):
-                temp_tup = ()
-                for j in range(self.k + 1):
-                    temp_tup = temp_tup + (games[i + j],)
-                if temp_tup in self.total_sequences:
-                    self.total_sequences[temp_tup] = self.total_sequences[temp_tup] + 1
-                else:
-                    self.total_sequences[temp_tup] = 1
-
-        return states, state_value, policy, policy_list
-
-    def generate_transitions(self, states, actions):
-        """
-        The method to generate the transition table.
-        :param states: the initial states
-        :param actions: the actions/items that can be chosen
-        :return: a dictionary with transition probabilities
-        """
-
-        # Initialize the transitions dict
-        transitions = {}
-
-        # Store transitions as { state: { action/item chosen: { next_state: (alpha * count, reward), ... }, ... }, ... }
-        for state, state_count in states.items():
-            for action in actions:
-                # Compute the new state
-                new_state = ()
-                for i in range(1, self.k):
-                    new_state = new_state + (state[i],)
-                new_state = new_state + (action,)
-
-                # Compute the complete sequence
-                total_sequence = state + (action,)
-                # Find number of times the total sequence occurs
-                if total_sequence not in self.total_sequences:
-                    total_sequence_count = 1
-                    self.total_sequences[total_sequence] = total_sequence_count
-                else:
-                    total_sequence_count = self.total_sequences[total_sequence]
-
-                # Fill the transition probabilities
-                if state not in transitions:
-                    transitions[state] = {}
-                if action not in transitions[state]:
-                    transitions[state][action] = {}
-                # Need to alpha * transition[state][action][n_state] as the action corresponds to the desired state
-                transitions[state][action][new_state] = (self.alpha * total_sequence_count / state_count,
-                                                         self.reward(new_state))
-
-        # Adding the other possibilities and their probabilities for a particular action
-        for state in transitions:
-            for action in transitions[state]:
-                for a in actions:
-                    # Compute the new state
-                    new_state = ()
-                    for i in range(1, self.k):
-                        new_state = new_state + (state[i],)
-                    new_state = new_state + (a,)
-
-                    # Need to beta * transition[state][a][n_state] as the action doesn't correspond to the desired state
-                    if new_state not in transitions[state][action]:
-                        transitions[state][action][new_state] = (self.beta(action, new_state)
-                                                                 * transitions[state][a][new_state][0],
-                                                                 self.reward(new_state))
-
-        # Normalizing the probabilities
-        for state in transitions:
-            for action in transitions[state]:
-                total = 0
-                for new_state in transitions[state][action]:
-                    total += transitions[state][action][new_state][0]
-                for new_state in transitions[state][action]:
-                    old_tup = transitions[state][action][new_state]
-                    transitions[state][action][new_state] = (old_tup[0] / total, old_tup[1])
-
-        return transitions
-
-    def beta(self, action, new_state):
-        """
-        Method to calculate the beta required
-        :param action: the action taken
-        :param new_state: the new state
-        :return: beta
-        """
-
-        # The difference in number of hours per unit currency
-        diff = abs((self.game_data[action] / self.game_price[action]) -
-                   (self.game_data[new_state[self.k - 1]] / self.game_price[new_state[self.k - 1]]))
-        return diff / 120
-
-    def reward(self, state):
-        """
-        Method to calculate the reward for each state
-        :param state: the state
-        :return: the reward for the given state
-        """
-
-        # spent = 0
-        # for i in range(len(state) - 1):
-        #     if state[i] is None:
-        #         spent += 0
-        #     else:
-        #         spent += self.game_price[state[i]]
-        # # The average amount spent before this purchase
-        # if not len(state) == 1:
-        #     spent /= (len(state) - 1)
-        # y = spent / self.game_price[state[self.k - 1]]
-        #
-        # if y > 1:
-        #     y = 1/y
-        #
-        # return (1 - y) * (self.game_data[state[self.k - 1]]) + y * (self.game_price[state[self.k - 1]])
-
-        return 1
+import copy
+import os
+import random
+from collections.abc import Mapping
+
+import numpy as np
+
+from ingest import TransactionLog, UserHistories, read_rows
+from instrumentation import Instrumentation
+from mdp_parallel import build_shards
+from mdp_transitions import ImplicitTransitions, TransitionTable
+from ngram_counts import CountTable, count_ngrams
+from state_codec import StateCodec
+
+
+class MDPInitializer:
+    """
+    Class to generate state space.
+    """
+
+    def __init__(self, data_path, k, alpha, metrics=None):
+        """
+        The constructor for the MDPInitializer class.
+        Parameters:
+        :param data_path: path to data
+        :param k: the number of items in each state
+        :param alpha: the proportionality constant when considering transitions
+        :param metrics: the Instrumentation recording the phases (a silent one if None)
+        """
+
+        self.metrics = metrics or Instrumentation()
+
+        self.u_path = data_path + "/users.csv"
+        self.t_path = data_path + "/transactions.csv"
+        self.g_path = data_path + "/games.csv"
+        self.k = k
+        self.alpha = alpha
+        self.total_sequences = {}
+
+        # Store transactions as { user_id : [ game_id, ... ], ... } backed by columnar arrays
+        self.log = None
+        self.transactions = {}
+        # Store the average hours of each game as { game_id : hours, ... }
+        self.game_data = {}
+        with self.metrics.span('read_transactions', "Reading transactions."):
+            self.fill_transaction_data()
+        self.metrics.gauge('users', len(self.log.user_ids))
+        self.metrics.gauge('history_entries', len(self.log.games))
+
+        with self.metrics.span('read_games', "Getting set of actions."):
+            self.actions, self.games, self.game_price = self.get_action_data()
+        self.metrics.gauge('actions', len(self.actions))
+        self.num_of_actions = len(self.actions)
+
+        # Encode states as compact keys, the games that are actions come first so their code is their index + 1
+        items = list(self.actions)
+        items.extend(sorted(set(self.log.game_ids) - set(items)))
+        self.codec = StateCodec(items, k)
+        self.sequence_codec = self.codec.with_length(k + 1)
+        # The code of every game in the transaction log
+        self.game_codes = np.array([self.codec.item_code[game] for game in self.log.game_ids], dtype=np.int32)
+
+    def with_k(self, k, metrics=None):
+        """
+        The method to get an initializer for another number of items per state that shares the parsed data.
+        :param k: the number of items in each state
+        :param metrics: the Instrumentation of the new initializer (this one's if None)
+        :return: an MDPInitializer
+        """
+
+        other = copy.copy(self)
+        other.k = k
+        other.metrics = metrics or self.metrics
+        other.total_sequences = {}
+        other.codec = self.codec.with_length(k)
+        other.sequence_codec = self.codec.with_length(k + 1)
+        return other
+
+    def fill_transaction_data(self, chunk_size=65536):
+        """
+        The method to read users and the transactions for each user in a single streaming pass.
+        :param chunk_size: the number of csv rows parsed at once
+        :return: None
+        """
+
+        self.log = TransactionLog.from_csv(self.u_path, self.t_path, chunk_size)
+        self.transactions = UserHistories(self.log)
+        self.game_data = self.log.average_hours()
+
+    def get_action_data(self):
+        """
+        The method to obtain all games which will be actions.
+        :return: list of the games/actions
+        """
+
+        actions = []
+        games = {}
+        game_price = {}
+        for chunk in read_rows(self.g_path):
+            for row in chunk:
+                actions.append(row[0])
+                games[row[0]] = row[1]
+                game_price[row[0]] = int(row[2])
+        return actions, games, game_price
+
+    def encode_histories(self):
+        """
+        The method to encode the history of every user as one array of codes.
+        :return: the codes, with k-1 paddings in front of each user, and the start and end of each user's span
+        """
+
+        if self.transactions.overrides:
+            return self._encode_history_lists()
+
+        # Leave k-1 paddings (code 0) in front of every user's games
+        log = self.log
+        counts = np.diff(log.indptr)
+        ends = np.cumsum(counts + self.k - 1)
+        starts = ends - counts - (self.k - 1)
+        codes = np.zeros(ends[-1] if len(ends) else 0, dtype=np.int32)
+        positions = np.repeat(ends - counts - log.indptr[:-1], counts) + np.arange(len(log.games))
+        codes[positions] = self.game_codes[log.games]
+        return codes, starts, ends
+
+    def recent_codes(self, user_ids, length):
+        """
+        The method to get the codes of the last games of many users.
+        :param user_ids: the users
+        :param length: the number of games to take from the end of each history
+        :return: an int32 array of shape (len(user_ids), length), padded in front with 0 (None)
+        """
+
+        log = self.log
+        user_ids = list(user_ids)
+        overridden = [ind for ind, user in enumerate(user_ids) if user in self.transactions.overrides]
+        user_ind = np.array([0 if user in self.transactions.overrides else log.user_index[user] for user in user_ids],
+                            dtype=np.int64)
+
+        # Take the positions ending at each user's last game, the ones before the user's first game are padding
+        starts = log.indptr[user_ind]
+        positions = log.indptr[user_ind + 1][:, None] - length + np.arange(length)[None, :]
+        valid = positions >= starts[:, None]
+        codes = self.game_codes[log.games[np.where(valid, positions, 0)]] if len(log.games) else \
+            np.zeros(positions.shape, dtype=np.int32)
+        rows = np.where(valid, codes, 0).astype(np.int32)
+
+        for ind in overridden:
+            history = [0] * length + [self.codec.item_code[game] for game in self.transactions[user_ids[ind]]]
+            rows[ind] = history[len(history) - length:]
+        return rows
+
+    def _encode_history_lists(self):
+        """
+        The method to encode the histories one user at a time, used when some histories were replaced.
+        :return: the codes, with k-1 paddings in front of each user, and the start and end of each user's span
+        """
+
+        pre = [0] * (self.k - 1)
+        codes = []
+        lengths = []
+        for user in self.transactions:
+            # Prepend Nones for first transactions
+            history = pre + [self.codec.item_code[game] for game in self.transactions[user]]
+            codes.extend(history)
+            lengths.append(len(history))
+
+        ends = np.cumsum(np.array(lengths, dtype=np.int64))
+        return np.array(codes, dtype=np.int32), ends - lengths, ends
+
+    def generate_initial_states(self, top_n=None, counts_dir=None, run_size=1 << 22):
+        """
+        The method to generate an initial state space.
+        :param top_n: the length of the random ranked list given to each state (all actions if None)
+        :param counts_dir: a directory to count the states and sequences on disk in, as memory-mapped tables in sorted
+        order, instead of in memory in the order they are first seen
+        :param run_size: the number of n-grams counted in memory at once when counting on disk
+        :return: states and the corresponding value vector
+        """
+
+        codes, starts, ends = self.encode_histories()
+
+        if counts_dir is not None:
+            # Generate states of k items and sequences of k+1 items, the last item of each user is not used
+            states = count_ngrams(self.codec, codes, starts, ends,
+                                  os.path.join(counts_dir, 'states-' + str(self.k)), run_size)
+            self.total_sequences = count_ngrams(self.sequence_codec, codes, starts, ends - 1,
+                                                os.path.join(counts_dir, 'sequences-' + str(self.k + 1)), run_size)
+        else:
+            # Generate states of k items and count them, keeping the order in which they are first seen
+            keys, first, counts = np.unique(self.codec.windows(codes, starts, ends), return_index=True,
+                                            return_counts=True)
+            order = np.argsort(first, kind='stable')
+            states = dict(zip(keys[order].tolist(), counts[order].tolist()))
+
+            # Generate states of k+1 items, the last item of each user is not used, replacing the counts of any
+            # earlier build
+            keys, counts = np.unique(self.sequence_codec.windows(codes, starts, ends - 1), return_counts=True)
+            self.total_sequences = dict(zip(keys.tolist(), counts.tolist()))
+
+        list_size = len(self.actions) if top_n is None else min(top_n, len(self.actions))
+        state_value = {}
+        policy = {}
+        for state in states:
+            state_value[state] = 0
+            policy[state] = random.choice(self.actions)
+        # The random ranked lists are drawn when they are read, a list of every action for every state is not held
+        policy_list = RandomRankings(states, self.actions, list_size)
+
+        self.metrics.gauge('states', len(states))
+        self.metrics.gauge('sequences', len(self.total_sequences))
+        return states, state_value, policy, policy_list
+
+    def generate_transitions(self, states, actions, as_dict=False, chunk_size=4096, implicit=False, processes=1,
+                             candidates=None):
+        """
+        The method to generate the transition table.
+        :param states: the initial states
+        :param actions: the actions/items that can be chosen
+        :param as_dict: flag to return the old nested dict view instead of the CSR table
+        :param chunk_size: the number of states whose rows are built at once
+        :param implicit: flag to return an ImplicitTransitions operator, which stores per-state counts instead of
+        every transition
+        :param processes: the number of worker processes building shards of the states (1 builds in this process)
+        :param candidates: the number of most popular and of nearest games kept as outcomes of each action besides
+        the observed continuations of the state, the rest of the outcomes are pruned (all are kept if None)
+        :return: a TransitionTable (or ImplicitTransitions) with transition probabilities
+        """
+
+        if implicit and candidates is not None:
+            raise ValueError("Only the stored transition table can be pruned")
+
+        state_list, state_keys, state_counts = _count_arrays(self.codec, states)
+        num_of_states = len(state_list)
+        num_of_actions = len(actions)
+
+        # Find states by binary search over the sorted keys
+        order = np.argsort(state_keys, kind='stable')
+
+        # The times each state is followed by each action are looked up for one chunk of states at a time
+        counts = self.sequence_table()
+        kept = None if candidates is None else self.candidate_actions(actions, candidates)
+
+        with self.metrics.span('rows'):
+            if processes > 1 and num_of_states:
+                shards = build_shards(self, state_keys, order, state_counts, actions, processes, chunk_size, implicit,
+                                      kept, counts)
+            else:
+                shards = [self.transition_chunks(state_keys, order, state_counts, np.arange(num_of_states), actions,
+                                                 chunk_size, implicit, kept, counts)]
+
+            # The shards are contiguous runs of states, in order
+            if implicit:
+                observed, weights, next_states, rewards = zip(*shards)
+                transitions = ImplicitTransitions(state_list, list(actions), _join(observed), weights[0],
+                                                  _join(next_states), _join(rewards), self.codec)
+            else:
+                row_lengths = _concat([lengths for lengths, _ in shards], np.int64)
+                entries = [_concat([entries[i] for _, entries in shards], dtype)
+                           for i, dtype in enumerate((np.int64, np.int32, np.float64, np.float64))]
+                indptr = np.zeros(num_of_states * num_of_actions + 1, dtype=np.int64)
+                np.cumsum(row_lengths, out=indptr[1:])
+                transitions = TransitionTable(state_list, list(actions), indptr, *entries, self.codec)
+        self.metrics.gauge('transitions_nnz', transitions.nnz)
+        self.metrics.gauge('transitions_bytes', transitions.nbytes)
+
+        if as_dict:
+            return transitions.to_dict()
+        return transitions
+
+    def sequence_table(self):
+        """
+        The method to get the counts of the sequences of k+1 items as a CountTable, which finds many keys at once.
+        :return: total_sequences if it is a CountTable, otherwise a CountTable of its sorted keys and counts
+        """
+
+        if isinstance(self.total_sequences, CountTable):
+            return self.total_sequences
+        _, keys, counts = _count_arrays(self.sequence_codec, self.total_sequences)
+        order = np.argsort(keys, kind='stable')
+        return CountTable(keys[order], counts[order].astype(np.int64))
+
+    def continuation_counts(self, state_keys, action_codes, counts=None):
+        """
+        The method to count the times some states were followed by each action.
+        :param state_keys: the keys of the states
+        :param action_codes: the code of every action
+        :param counts: the counts of the sequences of k+1 items, a dict or CountTable (total_sequences if None)
+        :return: an array of shape (len(state_keys), len(action_codes)) with the counts, an unseen sequence counts as
+        1, and a boolean array like it that is True where the sequence was seen
+        """
+
+        counts = self.total_sequences if counts is None else counts
+        items = self.codec.unpack(state_keys)
+        if isinstance(counts, CountTable) and not counts.overrides:
+            # The sequences that start with a state are a run of the sorted keys, only the seen ones are read
+            keys = counts.stored_keys
+            bounds = [self.sequence_codec.pack(np.concatenate([items, np.full((len(items), 1), code, dtype=np.int32)],
+                                                              axis=1)) for code in (0, len(self.codec.items))]
+            starts = np.searchsorted(keys, bounds[0])
+            lengths = np.searchsorted(keys, bounds[1], side='right') - starts
+            offsets = np.cumsum(lengths) - lengths
+            entries = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+            code_to_action = np.full(len(self.codec.items) + 1, -1, dtype=np.int64)
+            code_to_action[action_codes] = np.arange(len(action_codes))
+            state_ind = np.repeat(np.arange(len(items)), lengths)
+            action_ind = code_to_action[self.sequence_codec.unpack(keys[entries])[:, -1]]
+            found = action_ind >= 0
+            continuation = np.zeros((len(items), len(action_codes)))
+            continuation[state_ind[found], action_ind[found]] = counts.stored_counts[entries[found]]
+        else:
+            sequences = np.concatenate([np.repeat(items, len(action_codes), axis=0),
+                                        np.tile(action_codes, len(items))[:, None]], axis=1)
+            sequences = self.sequence_codec.pack(sequences)
+            if isinstance(counts, CountTable):
+                continuation = counts.lookup(sequences, 0).astype(np.float64)
+            else:
+                continuation = np.array([counts.get(key, 0) for key in sequences.tolist()], dtype=np.float64)
+            continuation = continuation.reshape(len(items), len(action_codes))
+        seen = continuation > 0
+        continuation[~seen] = 1
+        return continuation, seen
+
+    def transition_chunks(self, state_keys, order, state_counts, subset, actions, chunk_size=4096, implicit=False,
+                          kept=None, counts=None):
+        """
+        The method to build the transitions of some of the states one chunk of states at a time, counting the
+        continuations of each chunk as it is built, so that the memory used besides the result is bounded by the
+        chunk size.
+        :param state_keys: the key of every state
+        :param order: the permutation that sorts state_keys
+        :param state_counts: the number of times every state occurs
+        :param subset: the indices of the states
+        :param actions: the actions/items that can be chosen
+        :param chunk_size: the number of states built at once
+        :param implicit: flag to build the arrays of ImplicitTransitions instead of the rows of a TransitionTable
+        :param kept: when pruning, the candidate outcomes of each action as returned by candidate_actions
+        :param counts: the counts of the sequences of k+1 items, see continuation_counts
+        :return: the result of transition_arrays or transition_rows for the whole subset
+        """
+
+        action_codes = self.codec.encode_items(actions)
+        if implicit:
+            shape = (len(subset), len(actions))
+            observed, next_states, rewards = np.zeros(shape), np.zeros(shape, dtype=np.int64), np.zeros(shape)
+        else:
+            row_lengths = []
+            entries = []
+        for start in range(0, len(subset), chunk_size):
+            chunk = subset[start:start + chunk_size]
+            stop = start + len(chunk)
+            continuation, seen = self.continuation_counts(state_keys[chunk], action_codes, counts)
+            if implicit:
+                observed[start:stop], _, next_states[start:stop], rewards[start:stop] = self.transition_arrays(
+                    state_keys, order, state_counts, chunk, continuation, actions)
+            else:
+                lengths, chunk_entries = self.transition_rows(state_keys, order, state_counts, chunk, continuation,
+                                                              actions, chunk_size, seen, kept)
+                row_lengths.append(lengths)
+                entries.append(chunk_entries)
+
+        if implicit:
+            return observed, self.beta_matrix(actions), next_states, rewards
+        return _concat(row_lengths, np.int64), tuple(_concat([chunk_entries[i] for chunk_entries in entries], dtype)
+                                                     for i, dtype in enumerate((np.int64, np.int32, np.float64,
+                                                                                np.float64)))
+
+    def transition_arrays(self, state_keys, order, state_counts, subset, continuation, actions):
+        """
+        The method to get the quantities that determine the transitions of some of the states.
+        :param state_keys: the key of every state
+        :param order: the permutation that sorts state_keys
+        :param state_counts: the number of times every state occurs
+        :param subset: the indices of the states
+        :param continuation: the count of each action following each state of the subset
+        :param actions: the actions/items that can be chosen
+        :return: alpha * count(s + a') / count(s), the beta matrix, and the index and reward of the state completed by
+        each action, the index is len(state_keys) for states outside the state space
+        """
+
+        action_codes = self.codec.encode_items(actions)
+        # alpha * count for the state reached by the chosen action
+        observed = self.alpha * continuation / state_counts[subset, None]
+
+        # Weight of landing in the state of action a' when a is chosen, beta(a, a') off the diagonal
+        weights = self.beta_matrix(actions)
+
+        # The state reached by each action, num_of_states if it is outside the state space
+        next_keys = self.codec.shift(state_keys[subset, None], action_codes[None, :])
+        next_states = _lookup(state_keys, order, next_keys)
+        return observed, weights, next_states, self.reward_matrix(next_keys)
+
+    def transition_rows(self, state_keys, order, state_counts, subset, continuation, actions, chunk_size=4096,
+                        seen=None, kept=None):
+        """
+        The method to build the rows of the transition table for some of the states.
+        :param state_keys: the key of every state
+        :param order: the permutation that sorts state_keys
+        :param state_counts: the number of times every state occurs
+        :param subset: the indices of the states whose rows are built
+        :param continuation: the count of each action following each state of the subset
+        :param actions: the actions/items that can be chosen
+        :param chunk_size: the number of states whose rows are built at once
+        :param seen: when pruning, a boolean array like continuation that is True where the action was seen
+        :param kept: when pruning, the candidate outcomes of each action as returned by candidate_actions, the rows
+        keep these and the seen continuations of their state (every outcome is kept if None)
+        :return: the length of each row and the (next_state, next_action, prob, reward) entry arrays
+        """
+
+        observed, weights, next_states, rewards = self.transition_arrays(state_keys, order, state_counts, subset,
+                                                                         continuation, actions)
+        if kept is not None:
+            return self._pruned_rows(observed, weights, next_states, rewards, seen, kept, chunk_size)
+
+        row_lengths = []
+        next_state = []
+        next_action = []
+        prob = []
+        reward = []
+        for start in range(0, len(subset), chunk_size):
+            stop = min(start + chunk_size, len(subset))
+
+            # Store the weights as [ state, action chosen, action that completes next state ] and normalise
+            chunk = weights[None, :, :] * observed[start:stop, None, :]
+            chunk /= chunk.sum(axis=2, keepdims=True)
+
+            present = chunk > 0
+            s_ind, _, a_ind = np.nonzero(present)
+            s_ind += start
+            row_lengths.append(present.sum(axis=2).ravel())
+            next_state.append(next_states[s_ind, a_ind])
+            next_action.append(a_ind.astype(np.int32))
+            prob.append(chunk[present])
+            reward.append(rewards[s_ind, a_ind])
+
+        return _concat(row_lengths, np.int64), (_concat(next_state, np.int64), _concat(next_action, np.int32),
+                                                _concat(prob, np.float64), _concat(reward, np.float64))
+
+    def _pruned_rows(self, observed, weights, next_states, rewards, seen, kept, chunk_size=4096):
+        """
+        The method to build rows that only hold the seen continuations of their state and the candidates of their
+        action, renormalised over what is kept.
+        :param observed: alpha * count(s + a') / count(s) for each state of the subset
+        :param weights: the beta matrix
+        :param next_states: the index of the state completed by each action from each state of the subset
+        :param rewards: the reward of the state completed by each action from each state of the subset
+        :param seen: a boolean array like observed that is True where the action was seen after the state
+        :param kept: a boolean array with True at [a, a'] if a' is a candidate outcome of a
+        :param chunk_size: the number of states whose rows are built at once
+        :return: the length of each row and the (next_state, next_action, prob, reward) entry arrays
+        """
+
+        num_of_actions = weights.shape[0]
+        kept_action, kept_next = np.nonzero(kept)
+
+        row_lengths = []
+        next_state = []
+        next_action = []
+        prob = []
+        reward = []
+        for start in range(0, len(observed), chunk_size):
+            stop = min(start + chunk_size, len(observed))
+
+            # Every seen continuation is an outcome of every action chosen in the state
+            s_seen, a_seen = np.nonzero(seen[start:stop])
+            s_ind = [np.repeat(s_seen, num_of_actions)]
+            chosen = [np.tile(np.arange(num_of_actions), len(s_seen))]
+            outcome = [np.repeat(a_seen, num_of_actions)]
+
+            # So is every candidate of the action chosen that was not seen
+            s_kept = np.repeat(np.arange(stop - start), len(kept_action))
+            a_kept = np.tile(kept_action, stop - start)
+            n_kept = np.tile(kept_next, stop - start)
+            unseen = ~seen[start + s_kept, n_kept]
+            s_ind.append(s_kept[unseen])
+            chosen.append(a_kept[unseen])
+            outcome.append(n_kept[unseen])
+
+            # Sort the entries by row and outcome, and normalise each row over the entries it keeps
+            s_ind, chosen, outcome = np.concatenate(s_ind), np.concatenate(chosen), np.concatenate(outcome)
+            rows = s_ind * num_of_actions + chosen
+            entry_order = np.lexsort((outcome, rows))
+            s_ind, outcome, rows = s_ind[entry_order] + start, outcome[entry_order], rows[entry_order]
+            weight = weights[chosen[entry_order], outcome] * observed[s_ind, outcome]
+            present = weight > 0
+            totals = np.bincount(rows, weight, (stop - start) * num_of_actions)
+
+            row_lengths.append(np.bincount(rows[present], minlength=(stop - start) * num_of_actions))
+            next_state.append(next_states[s_ind[present], outcome[present]])
+            next_action.append(outcome[present].astype(np.int32))
+            prob.append(weight[present] / totals[rows[present]])
+            reward.append(rewards[s_ind[present], outcome[present]])
+
+        return _concat(row_lengths, np.int64), (_concat(next_state, np.int64), _concat(next_action, np.int32),
+                                                _concat(prob, np.float64), _concat(reward, np.float64))
+
+    def candidate_actions(self, actions, candidates):
+        """
+        The method to choose the outcomes kept for each action when pruning: the action itself, the most popular
+        games and the games nearest to the action in hours per unit currency, the measure beta is based on.
+        :param actions: the actions/items that can be chosen
+        :param candidates: the number of most popular and of nearest games kept
+        :return: a boolean array with True at [a, a'] if a' is kept as an outcome of a
+        """
+
+        num_of_actions = len(actions)
+        kept = np.eye(num_of_actions, dtype=bool)
+
+        # Popularity is the number of users who own the game
+        owners = np.bincount(self.game_codes[self.log.games], minlength=len(self.codec.items) + 1)
+        kept[:, np.argsort(-owners[self.codec.encode_items(actions)], kind='stable')[:candidates]] = True
+
+        hours_per_price = self.hours_per_price(actions)
+        distance = np.abs(hours_per_price[:, None] - hours_per_price[None, :])
+        nearest = np.argsort(distance, axis=1, kind='stable')[:, :candidates]
+        kept[np.arange(num_of_actions)[:, None], nearest] = True
+        return kept
+
+    def add_transactions(self, rows, states):
+        """
+        The method to add new transactions and update the n-gram counts of the users they belong to.
+        :param rows: transaction rows as [ user_id, game_id, behaviour, value ]
+        :param states: the states and their counts, updated in place
+        :return: the keys of the states whose counts or continuations changed, including new states
+        """
+
+        rows = list(rows)
+        for row in rows:
+            if row[1] not in self.codec.item_code:
+                raise ValueError("Game " + str(row[1]) + " was not known when the model was built, a full rebuild is "
+                                 "needed")
+        histories = self.log.extend(rows)
+        if len(self.game_codes) < len(self.log.game_ids):
+            self.game_codes = np.array([self.codec.item_code[game] for game in self.log.game_ids], dtype=np.int32)
+        if not histories:
+            return []
+
+        # Encode the affected histories, each padded with k-1 Nones
+        pre = [0] * (self.k - 1)
+        codes = []
+        starts = []
+        old_lengths = []
+        for user_ind, old_length in histories:
+            starts.append(len(codes))
+            old_lengths.append(old_length + self.k - 1)
+            codes.extend(pre + self.game_codes[self.log.history(user_ind)].tolist())
+        codes = np.array(codes, dtype=np.int32)
+        starts = np.array(starts, dtype=np.int64)
+        ends = np.append(starts[1:], len(codes))
+        old_ends = starts + np.array(old_lengths, dtype=np.int64)
+
+        # Only the k-grams and (k+1)-grams that end in a new game are new, the last game is not used in the latter
+        new_states = self.codec.windows(codes, np.maximum(old_ends - self.k + 1, starts), ends)
+        new_sequences = self.sequence_codec.windows(codes, np.maximum(old_ends - self.k - 1, starts), ends - 1)
+
+        keys, counts = np.unique(new_states, return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            states[key] = states.get(key, 0) + count
+        affected = keys.tolist()
+
+        keys, counts = np.unique(new_sequences, return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.total_sequences[key] = self.total_sequences.get(key, 0) + count
+        if len(keys):
+            affected.extend(self.codec.pack(self.sequence_codec.unpack(keys)[:, :-1]).tolist())
+        return affected
+
+    def update_transitions(self, transitions, states, affected, chunk_size=4096, candidates=None):
+        """
+        The method to rebuild only the rows of the transition table that are affected by new transactions.
+        :param transitions: the current TransitionTable
+        :param states: the states with their updated counts, new states come after the old ones
+        :param affected: the keys of the states whose counts or continuations changed
+        :param chunk_size: the number of states whose rows are built at once
+        :param candidates: the pruning the table was built with, see generate_transitions
+        :return: the updated TransitionTable and the indices of the states whose rows were rebuilt
+        """
+
+        state_list, state_keys, state_counts = _count_arrays(self.codec, states)
+        order = np.argsort(state_keys, kind='stable')
+        action_codes = self.codec.encode_items(transitions.actions)
+
+        # Besides the affected states, the states that can now reach a new state instead of the sink
+        new_states = np.arange(transitions.num_of_states, len(state_list))
+        subset = [_lookup(state_keys, order, self.codec.as_array(affected)), new_states]
+        if len(new_states) and self.k == 1:
+            subset.append(np.arange(len(state_list)))
+        elif len(new_states):
+            items = self.codec.unpack(state_keys)
+            overlap = self.codec.with_length(self.k - 1)
+            subset.append(np.flatnonzero(np.isin(overlap.pack(items[:, 1:]), overlap.pack(items[new_states, :-1]))))
+        subset = np.unique(np.concatenate(subset))
+        subset = subset[subset < len(state_list)]
+
+        # Count the times each of these states is followed by each action, an unseen sequence counts as 1
+        continuation, seen = self.continuation_counts(state_keys[subset], action_codes)
+
+        if isinstance(transitions, ImplicitTransitions):
+            observed, _, next_states, rewards = self.transition_arrays(state_keys, order, state_counts, subset,
+                                                                       continuation, transitions.actions)
+            return transitions.replace_states(state_list, subset, observed, next_states, rewards), subset
+        kept = None if candidates is None else self.candidate_actions(transitions.actions, candidates)
+        row_lengths, entries = self.transition_rows(state_keys, order, state_counts, subset, continuation,
+                                                    transitions.actions, chunk_size, seen, kept)
+        return transitions.replace_rows(state_list, subset, row_lengths, *entries), subset
+
+    def beta_matrix(self, actions):
+        """
+        Method to calculate beta between every pair of actions
+        :param actions: the actions/items that can be chosen
+        :return: an array with beta(a, a') at [a, a'] and 1 on the diagonal
+        """
+
+        hours_per_price = self.hours_per_price(actions)
+        weights = np.abs(hours_per_price[:, None] - hours_per_price[None, :]) / 120
+        np.fill_diagonal(weights, 1)
+        return weights
+
+    def hours_per_price(self, actions):
+        """
+        Method to get the number of hours per unit currency of each action
+        :param actions: the actions/items
+        :return: an array with the hours per price of each action
+        """
+
+        return np.array([self.game_data[action] / self.game_price[action] for action in actions])
+
+    def beta(self, action, new_state):
+        """
+        Method to calculate the beta required
+        :param action: the action taken
+        :param new_state: the new state
+        :return: beta
+        """
+
+        # The difference in number of hours per unit currency
+        diff = abs((self.game_data[action] / self.game_price[action]) -
+                   (self.game_data[new_state[self.k - 1]] / self.game_price[new_state[self.k - 1]]))
+        return diff / 120
+
+    def reward(self, state):
+        """
+        Method to calculate the reward for each state
+        :param state: the state
+        :return: the reward for the given state
+        """
+
+        # spent = 0
+        # for i in range(len(state) - 1):
+        #     if state[i] is None:
+        #         spent += 0
+        #     else:
+        #         spent += self.game_price[state[i]]
+        # # The average amount spent before this purchase
+        # if not len(state) == 1:
+        #     spent /= (len(state) - 1)
+        # y = spent / self.game_price[state[self.k - 1]]
+        #
+        # if y > 1:
+        #     y = 1/y
+        #
+        # return (1 - y) * (self.game_data[state[self.k - 1]]) + y * (self.game_price[state[self.k - 1]])
+
+        return 1
+
+    def reward_matrix(self, state_keys):
+        """
+        Method to calculate the reward of many states at once
+        :param state_keys: an array of state keys
+        :return: an array with the reward of each state
+        """
+
+        # Same as reward() for every state
+        return np.ones(np.shape(state_keys))
+
+
+class RandomRankings(Mapping):
+    """
+    Read-only { state: [ (action, 1), ... ] } of random ranked lists, the policy list of states that were not solved.
+
+    A list is drawn each time it is read, from a generator seeded with the state, so a state always gets the same
+    list but the lists of all the states are never held at once.
+    """
+
+    def __init__(self, states, actions, list_size):
+        """
+        The constructor for the RandomRankings class.
+        :param states: the states, a dict or CountTable
+        :param actions: the actions/items that can be chosen
+        :param list_size: the length of each ranked list
+        """
+
+        self.states = states
+        self.actions = list(actions)
+        self.list_size = list_size
+        self.seed = random.getrandbits(64)
+
+    def __getitem__(self, state):
+        if state not in self.states:
+            raise KeyError(state)
+        key = state if isinstance(state, int) else int.from_bytes(bytes(state), 'big')
+        return [(action, 1) for action in random.Random(self.seed ^ key).sample(self.actions, self.list_size)]
+
+    def __iter__(self):
+        return iter(self.states)
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, state):
+        return state in self.states
+
+
+def _concat(arrays, dtype):
+    """
+    Function to join the chunks of an entry array.
+    :param arrays: the chunks
+    :param dtype: the dtype of the result
+    :return: a single array
+    """
+
+    if not arrays:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(arrays).astype(dtype, copy=False)
+
+
+def _join(arrays):
+    """
+    Function to join the arrays of the shards of the states, a single shard is not copied.
+    :param arrays: the array of each shard
+    :return: a single array
+    """
+
+    return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+
+
+def _count_arrays(codec, counts):
+    """
+    Function to get the keys of a dict or CountTable of counts as a list and as an array, and the counts as floats.
+    :param codec: the StateCodec of the keys
+    :param counts: { key: count, ... }
+    :return: the list of keys, the array of keys and the float64 array of counts, in the order of iteration
+    """
+
+    keys = list(counts)
+    if isinstance(counts, CountTable):
+        key_array, count_array = counts.arrays()
+        return keys, np.asarray(key_array), np.asarray(count_array, dtype=np.float64)
+    return keys, codec.as_array(keys), np.fromiter(counts.values(), dtype=np.float64, count=len(keys))
+
+
+def _lookup(keys, order, queries):
+    """
+    Function to find the position of keys by binary search.
+    :param keys: the array of keys
+    :param order: the permutation that sorts keys
+    :param queries: the keys to find
+    :return: the position of each query in keys, len(keys) if it is not there
+    """
+
+    if not len(keys):
+        return np.zeros(np.shape(queries), dtype=np.int64)
+    sorted_keys = keys[order]
+    pos = np.minimum(np.searchsorted(sorted_keys, queries), len(keys) - 1)
+    return np.where(sorted_keys[pos] == queries, order[pos], len(keys))
@@ -0,0 +1,221 @@
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# The data each worker reads, handed to the pool's initializer so forked workers share its pages
+_shared = {}
+
+# Pools are always forked, under spawn or forkserver the table would be pickled into every worker
+_context = multiprocessing.get_context('fork')
+
+
+def shard_bounds(num_of_states, num_of_shards):
+    """
+    Function to split the states into contiguous shards of about the same size.
+    :param num_of_states: the number of states
+    :param num_of_shards: the number of shards
+    :return: an array with the first state of each shard followed by num_of_states
+    """
+
+    num_of_shards = max(1, min(num_of_shards, num_of_states))
+    return np.linspace(0, num_of_states, num_of_shards + 1).astype(np.int64)
+
+
+def build_shards(mdp_i, state_keys, order, state_counts, actions, processes, chunk_size=4096, implicit=False,
+                 kept=None, counts=None):
+    """
+    Function to build the transitions of every state on a pool of worker processes, one shard of states per task.
+    :param mdp_i: the MDPInitializer
+    :param state_keys: the key of every state
+    :param order: the permutation that sorts state_keys
+    :param state_counts: the number of times every state occurs
+    :param actions: the actions/items that can be chosen
+    :param processes: the number of worker processes
+    :param chunk_size: the number of states whose rows are built at once
+    :param implicit: flag to build the arrays of ImplicitTransitions instead of the rows of a TransitionTable
+    :param kept: when pruning, the candidate outcomes of each action
+    :param counts: the counts of the sequences of k+1 items the continuations are looked up in
+    :return: the result of transition_arrays or transition_rows for each shard, in order of state
+    """
+
+    bounds = shard_bounds(len(state_keys), 4 * processes)
+    shared = {'mdp_i': mdp_i, 'state_keys': state_keys, 'order': order, 'state_counts': state_counts,
+              'actions': actions, 'chunk_size': chunk_size, 'implicit': implicit, 'kept': kept, 'counts': counts}
+    tasks = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+    with _context.Pool(processes, _init_worker, (shared,)) as pool:
+        return pool.map(_build_shard, tasks)
+
+
+class ParallelTransitions:
+    """
+    Class to run the Bellman backups of a transition table on a pool of worker processes.
+
+    The states are split into contiguous shards and each task backs up one shard. Every worker holds the whole
+    table, shared with this process when workers are forked, so only the values, the policy and the results move
+    between sweeps, through shared memory. Anything else, like the states or predecessors, is read from the table.
+    Use it as a context manager, or call close, to stop the workers.
+    """
+
+    def __init__(self, table, processes=None, shards_per_process=4, min_states=4096):
+        """
+        The constructor for the ParallelTransitions class.
+        :param table: a TransitionTable or ImplicitTransitions
+        :param processes: the number of worker processes (the number of CPUs if None)
+        :param shards_per_process: the number of shards given to each process, more shards balance uneven rows
+        :param min_states: backups of fewer states than this run in this process
+        """
+
+        self.table = table
+        self.processes = processes or os.cpu_count()
+        self.min_states = min_states
+        num_of_states, num_of_actions = table.num_of_states, table.num_of_actions
+        self.bounds = shard_bounds(num_of_states, self.processes * shards_per_process)
+
+        # The values and policy written before each sweep, and the backed up values written by the workers
+        shapes = {'values': ((num_of_states,), np.float64), 'policy': ((num_of_states,), np.int64),
+                  'state_values': ((num_of_states,), np.float64),
+                  'action_values': ((num_of_states, num_of_actions), np.float64)}
+        self._memory = {}
+        self._arrays = {}
+        for name, (shape, dtype) in shapes.items():
+            size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            memory = shared_memory.SharedMemory(create=True, size=size)
+            self._memory[name] = memory
+            self._arrays[name] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+        shared = {'table': table, 'memory': {name: (memory.name, shapes[name]) for name, memory in
+                                             self._memory.items()}}
+        self.pool = _context.Pool(self.processes, _init_worker, (shared,))
+
+    def __getattr__(self, name):
+        if name == 'table':
+            raise AttributeError(name)
+        return getattr(self.table, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Method to stop the workers and free the shared memory.
+        :return: None
+        """
+
+        if self.pool is None:
+            return
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+        self._arrays = {}
+        for memory in self._memory.values():
+            memory.close()
+            memory.unlink()
+        self._memory = {}
+
+    def _sweep(self, tasks):
+        """
+        Method to run one task per shard.
+        :param tasks: the task of each shard
+        :return: None
+        """
+
+        self.pool.map(_backup_shard, tasks)
+
+    def backup(self, values, discount):
+        """
+        Method to compute the action values of every state, one shard per task.
+        :param values: the value of each state
+        :param discount: the discount factor
+        :return: an array of shape (num_of_states, num_of_actions) with the action values
+        """
+
+        if self.table.num_of_states < self.min_states:
+            return self.table.backup(values, discount)
+        self._arrays['values'][:] = values
+        self._sweep([(lo, hi, discount, 'backup', None) for lo, hi in zip(self.bounds[:-1], self.bounds[1:])])
+        return self._arrays['action_values'].copy()
+
+    def backup_policy(self, values, discount, policy, states=None):
+        """
+        Method to compute the value of following the given action in every state, one shard per task.
+        :param values: the value of each state
+        :param discount: the discount factor
+        :param policy: the index of the action chosen in each state
+        :param states: the indices of the states to compute (all if None), computed in this process
+        :return: an array with the value of each state
+        """
+
+        if states is not None or self.table.num_of_states < self.min_states:
+            return self.table.backup_policy(values, discount, policy, states)
+        self._arrays['values'][:] = values
+        self._arrays['policy'][:] = policy
+        self._sweep([(lo, hi, discount, 'policy', None) for lo, hi in zip(self.bounds[:-1], self.bounds[1:])])
+        return self._arrays['state_values'].copy()
+
+    def backup_states(self, values, discount, states):
+        """
+        Method to compute the action values of a subset of states, split across the workers when it is large.
+        :param values: the value of each state
+        :param discount: the discount factor
+        :param states: the indices of the states to back up
+        :return: an array of shape (len(states), num_of_actions) with the action values
+        """
+
+        states = np.asarray(states, dtype=np.int64)
+        if len(states) < self.min_states or len(states) > self.table.num_of_states:
+            return self.table.backup_states(values, discount, states)
+        self._arrays['values'][:] = values
+        bounds = shard_bounds(len(states), self.processes)
+        self._sweep([(lo, hi, discount, 'states', states[lo:hi]) for lo, hi in zip(bounds[:-1], bounds[1:])])
+        return self._arrays['action_values'][:len(states)].copy()
+
+
+def _init_worker(shared):
+    """
+    Function to give a worker process the shared data, attaching to the shared memory it names.
+    :param shared: the data
+    :return: None
+    """
+
+    _shared.update(shared)
+    for name, (memory_name, (shape, dtype)) in shared.get('memory', {}).items():
+        memory = shared_memory.SharedMemory(name=memory_name)
+        _shared[name + '_memory'] = memory
+        _shared[name] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+def _build_shard(task):
+    """
+    Function to build the transitions of one shard of states.
+    :param task: the first and last (exclusive) state of the shard
+    :return: the result of transition_arrays or transition_rows for the shard
+    """
+
+    lo, hi = task
+    return _shared['mdp_i'].transition_chunks(_shared['state_keys'], _shared['order'], _shared['state_counts'],
+                                              np.arange(lo, hi), _shared['actions'], _shared['chunk_size'],
+                                              _shared['implicit'], _shared['kept'], _shared['counts'])
+
+
+def _backup_shard(task):
+    """
+    Function to back up one shard of states into the shared results.
+    :param task: the first and last (exclusive) position of the shard in the results, the discount factor, the kind
+    of backup ('backup' for every action value, 'policy' to follow the shared policy or 'states' for the given
+    states) and the states for 'states'
+    :return: None
+    """
+
+    lo, hi, discount, kind, states = task
+    table = _shared['table']
+    values = _shared['values']
+    if kind == 'policy':
+        _shared['state_values'][lo:hi] = table.backup_policy(values, discount, _shared['policy'], np.arange(lo, hi))
+    else:
+        states = np.arange(lo, hi) if states is None else states
+        _shared['action_values'][lo:hi] = table.backup_states(values, discount, states)
@@ -0,0 +1,371 @@
+import time
+
+import numpy as np
+
+
+def evaluate_policy(table, discount, values, policy, tol=1e-6, max_sweeps=1000):
+    """
+    Function to evaluate a policy by solving v = r + discount * P v, the linear system of its transition rows, with
+    BiCGSTAB. Each step costs two backups of the policy rows, like two sweeps, and the error shrinks much faster than
+    with sweeps when the discount factor is close to 1.
+    :param table: the transition table
+    :param discount: the discount factor
+    :param values: the starting value of each state
+    :param policy: the index of the action chosen in each state
+    :param tol: stop once the values are a fixed point of the policy backup up to this
+    :param max_sweeps: maximum number of backups to run
+    :return: the value of each state, the number of backups run and the residual max |backup(v) - v| it stopped at
+    """
+
+    # A v = v - discount * P v, computed from backups as v + r - backup(v) with r the backup of zero values
+    rewards = table.backup_policy(np.zeros_like(values), discount, policy)
+
+    def product(v):
+        return v + rewards - table.backup_policy(v, discount, policy)
+
+    x = np.array(values, dtype=np.float64)
+    residual = table.backup_policy(x, discount, policy) - x
+    sweeps = 2
+    shadow = residual.copy()
+    rho = alpha = omega = 1.0
+    direction = np.zeros_like(x)
+    projected = np.zeros_like(x)
+    while np.abs(residual).max(initial=0) > tol and sweeps + 2 <= max_sweeps:
+        rho_next = shadow @ residual
+        if rho_next == 0:
+            break
+        direction = residual + (rho_next / rho) * (alpha / omega) * (direction - omega * projected)
+        rho = rho_next
+        projected = product(direction)
+        alpha = rho / (shadow @ projected)
+        half = residual - alpha * projected
+        corrected = product(half)
+        sweeps += 2
+        omega = (corrected @ half) / (corrected @ corrected) if corrected @ corrected else 0.0
+        x += alpha * direction + omega * half
+        residual = half - omega * corrected
+        if omega == 0:
+            break
+
+    # The recurrence drifts from the true residual, which is what the caller is told
+    residual = float(np.abs(table.backup_policy(x, discount, policy) - x).max(initial=0))
+    return x, sweeps + 1, residual
+
+
+def greedy_policy(action_values):
+    """
+    Function to find the best action of every state.
+    :param action_values: an array of shape (num_of_states, num_of_actions)
+    :return: the index of the best action of each state
+    """
+
+    # Ties go to the first action, as max() over the action dict did
+    return np.argmax(action_values, axis=1) if action_values.size else np.zeros(0, dtype=np.int64)
+
+
+def rank_actions(action_values, top_n=None):
+    """
+    Function to rank the actions of every state by action value.
+    :param action_values: an array of shape (num_of_states, num_of_actions)
+    :param top_n: the number of best actions to keep (all if None)
+    :return: the ranked action indices and their action values, both of shape (num_of_states, top_n)
+    """
+
+    num_of_states, num_of_actions = action_values.shape
+    if top_n is None or top_n >= num_of_actions:
+        # Ties keep the action order
+        ranking = np.argsort(-action_values, axis=1, kind='stable')
+    elif top_n <= 0:
+        ranking = np.zeros((num_of_states, 0), dtype=np.int64)
+    else:
+        # Select the best top_n without sorting the rest, ties at the cut go to the first actions
+        cut = -np.partition(-action_values, top_n - 1, axis=1)[:, top_n - 1:top_n]
+        above = action_values > cut
+        at_cut = action_values == cut
+        at_cut &= np.cumsum(at_cut, axis=1) <= top_n - above.sum(axis=1, keepdims=True)
+        ranking = np.nonzero(above | at_cut)[1].reshape(num_of_states, top_n)
+
+        # Order the selected actions by value, ties keep the action order
+        scores = np.take_along_axis(action_values, ranking, axis=1)
+        ranking = np.take_along_axis(ranking, np.argsort(-scores, axis=1, kind='stable'), axis=1)
+    return ranking, np.take_along_axis(action_values, ranking, axis=1)
+
+
+def policy_iteration(table, discount, values=None, policy=None, max_iteration=1000, tol=1e-6, max_eval_sweeps=1000,
+                     callback=None):
+    """
+    Function to solve the MDP with policy iteration in matrix form.
+    :param table: the transition table
+    :param discount: the discount factor
+    :param values: the starting value of each state (zeros if None)
+    :param policy: the starting action index of each state (first action if None)
+    :param max_iteration: maximum number of iterations to run
+    :param tol: the Bellman residual below which the values are converged
+    :param max_eval_sweeps: maximum number of backups when evaluating each policy, an evaluation cut short by it is
+    reported by eval_residual in the stats
+    :param callback: called with the stats of each iteration
+    :return: the values, the policy, the action values and a list with the stats of each iteration
+    """
+
+    values, policy = _initial(table, values, policy)
+
+    stats = []
+    action_values = table.backup(values, discount)
+    for i in range(max_iteration):
+        start = time.perf_counter()
+
+        # Evaluate given policy
+        values, sweeps, eval_residual = evaluate_policy(table, discount, values, policy, tol, max_eval_sweeps)
+
+        # Improve policy
+        action_values = table.backup(values, discount)
+        new_policy = greedy_policy(action_values)
+        changed = int(np.count_nonzero(new_policy != policy))
+        policy = new_policy
+
+        residual = float(np.abs(action_values.max(axis=1) - values).max(initial=0))
+        stats.append({'iteration': i + 1, 'residual': residual, 'changed': changed, 'updated': table.num_of_states,
+                      'eval_sweeps': sweeps, 'eval_residual': eval_residual, 'time': time.perf_counter() - start})
+        if callback is not None:
+            callback(stats[-1])
+
+        # The policy is stable or the values no longer move
+        if changed == 0 or residual <= tol:
+            break
+
+    return values, policy, action_values, stats
+
+
+def value_iteration(table, discount, values=None, policy=None, max_iteration=1000, tol=1e-6, callback=None):
+    """
+    Function to solve the MDP with value iteration.
+    :param table: the transition table
+    :param discount: the discount factor
+    :param values: the starting value of each state (zeros if None)
+    :param policy: unused, accepted so that every solver shares one interface
+    :param max_iteration: maximum number of sweeps to run
+    :param tol: the Bellman residual below which the values are converged
+    :param callback: called with the stats of each iteration
+    :return: the values, the policy, the action values and a list with the stats of each iteration
+    """
+
+    return modified_policy_iteration(table, discount, values, policy, max_iteration, tol, eval_sweeps=0,
+                                     callback=callback)
+
+
+def modified_policy_iteration(table, discount, values=None, policy=None, max_iteration=1000, tol=1e-6,
+                              eval_sweeps=5, callback=None):
+    """
+    Function to solve the MDP with modified policy iteration, a greedy sweep followed by a few evaluation sweeps.
+    :param table: the transition table
+    :param discount: the discount factor
+    :param values: the starting value of each state (zeros if None)
+    :param policy: the starting action index of each state (first action if None)
+    :param max_iteration: maximum number of iterations to run
+    :param tol: the Bellman residual below which the values are converged
+    :param eval_sweeps: the number of evaluation sweeps after each greedy sweep (0 is value iteration)
+    :param callback: called with the stats of each iteration
+    :return: the values, the policy, the action values and a list with the stats of each iteration
+    """
+
+    values, policy = _initial(table, values, policy)
+
+    stats = []
+    for i in range(max_iteration):
+        start = time.perf_counter()
+
+        # Greedy sweep
+        action_values = table.backup(values, discount)
+        new_policy = greedy_policy(action_values)
+        new_values = action_values.max(axis=1) if action_values.size else values
+        residual = float(np.abs(new_values - values).max(initial=0))
+        changed = int(np.count_nonzero(new_policy != policy))
+        values, policy = new_values, new_policy
+
+        # Partial evaluation of the greedy policy
+        for _ in range(eval_sweeps):
+            values = table.backup_policy(values, discount, policy)
+
+        stats.append({'iteration': i + 1, 'residual': residual, 'changed': changed, 'updated': table.num_of_states,
+                      'time': time.perf_counter() - start})
+        if callback is not None:
+            callback(stats[-1])
+
+        if residual <= tol:
+            break
+
+    return values, policy, table.backup(values, discount), stats
+
+
+def gauss_seidel(table, discount, values=None, policy=None, max_iteration=1000, tol=1e-6, block_size=256,
+                 callback=None):
+    """
+    Function to solve the MDP with in-place value iteration, each block of states sees the values already updated
+    in the same sweep.
+    :param table: the transition table
+    :param discount: the discount factor
+    :param values: the starting value of each state (zeros if None)
+    :param policy: the starting action index of each state (first action if None)
+    :param max_iteration: maximum number of sweeps to run
+    :param tol: the Bellman residual below which the values are converged
+    :param block_size: the number of states updated together
+    :param callback: called with the stats of each iteration
+    :return: the values, the policy, the action values and a list with the stats of each iteration
+    """
+
+    values, policy = _initial(table, values, policy)
+    values = values.copy()
+
+    stats = []
+    for i in range(max_iteration):
+        start = time.perf_counter()
+
+        residual = 0.0
+        changed = 0
+        for block_start in range(0, table.num_of_states, block_size):
+            block = np.arange(block_start, min(block_start + block_size, table.num_of_states))
+            action_values = table.backup_states(values, discount, block)
+            new_policy = greedy_policy(action_values)
+            new_values = action_values.max(axis=1)
+            residual = max(residual, float(np.abs(new_values - values[block]).max(initial=0)))
+            changed += int(np.count_nonzero(new_policy != policy[block]))
+            values[block] = new_values
+            policy[block] = new_policy
+
+        stats.append({'iteration': i + 1, 'residual': residual, 'changed': changed, 'updated': table.num_of_states,
+                      'time': time.perf_counter() - start})
+        if callback is not None:
+            callback(stats[-1])
+
+        if residual <= tol:
+            break
+
+    return values, policy, table.backup(values, discount), stats
+
+
+def prioritized_sweeping(table, discount, values=None, policy=None, max_iteration=None, tol=1e-6, batch_size=256,
+                         seeds=None, callback=None):
+    """
+    Function to solve the MDP with prioritized sweeping. States are backed up in order of a bound on their Bellman
+    residual and only the predecessors of states whose value moved are re-queued, so settled states are left alone.
+    :param table: the transition table
+    :param discount: the discount factor
+    :param values: the starting value of each state (zeros if None)
+    :param policy: the starting action index of each state (first action if None)
+    :param max_iteration: maximum number of batches to back up (until every state is settled if None), the states
+    still queued when it stops are reported by pending in the stats
+    :param tol: the residual bound below which a state is settled
+    :param batch_size: the number of states taken from the queue at once
+    :param seeds: the indices of the only states that can be out of date, e.g. after an incremental update of the
+    table (every state if None)
+    :param callback: called with the stats of each iteration
+    :return: the values, the policy, the action values and a list with the stats of each iteration
+    """
+
+    values, policy = _initial(table, values, policy)
+    values = values.copy()
+    pred_indptr, pred_indices = table.predecessors()
+
+    # The queue holds a bound on the Bellman residual of every state, starting from the exact residuals
+    if seeds is None:
+        action_values = table.backup(values, discount)
+        priority = np.abs(action_values.max(axis=1) - values) if action_values.size else np.zeros(0)
+    else:
+        seeds = np.asarray(seeds, dtype=np.int64)
+        priority = np.zeros(table.num_of_states)
+        if len(seeds):
+            priority[seeds] = np.abs(table.backup_states(values, discount, seeds).max(axis=1) - values[seeds])
+
+    stats = []
+    pending = np.flatnonzero(priority > tol)
+    while len(pending) and (max_iteration is None or len(stats) < max_iteration):
+        start = time.perf_counter()
+
+        # Take the batch of states with the largest residuals
+        if len(pending) > batch_size:
+            pending = pending[np.argpartition(-priority[pending], batch_size - 1)[:batch_size]]
+        batch = np.sort(pending)
+        priority[batch] = 0
+
+        # Back up the batch
+        batch_values = table.backup_states(values, discount, batch)
+        new_values = batch_values.max(axis=1)
+        delta = np.abs(new_values - values[batch])
+        values[batch] = new_values
+        policy[batch] = greedy_policy(batch_values)
+
+        # A predecessor's residual can grow by at most discount * delta of the state that moved
+        moved = delta > 0
+        touched, bound = _gather(pred_indptr, pred_indices, batch[moved], discount * delta[moved])
+        np.add.at(priority, touched, bound)
+        pending = np.flatnonzero(priority > tol)
+
+        stats.append({'iteration': len(stats) + 1, 'residual': float(delta.max()),
+                      'changed': int(np.count_nonzero(moved)), 'updated': len(batch), 'pending': len(pending),
+                      'time': time.perf_counter() - start})
+        if callback is not None:
+            callback(stats[-1])
+
+    action_values = table.backup(values, discount)
+    return values, greedy_policy(action_values), action_values, stats
+
+
+# The solvers that can be selected by name
+SOLVERS = {
+    'policy_iteration': policy_iteration,
+    'value_iteration': value_iteration,
+    'modified_policy_iteration': modified_policy_iteration,
+    'gauss_seidel': gauss_seidel,
+    'prioritized_sweeping': prioritized_sweeping,
+}
+
+
+def solve(method, table, discount, values=None, policy=None, **options):
+    """
+    Function to run a solver selected by name.
+    :param method: the name of the solver, one of SOLVERS
+    :param table: the transition table
+    :param discount: the discount factor
+    :param values: the starting value of each state
+    :param policy: the starting action index of each state
+    :param options: keyword arguments passed on to the solver, those that are None are left to its default
+    :return: the values, the policy, the action values and a list with the stats of each iteration
+    """
+
+    if method not in SOLVERS:
+        raise ValueError("Unknown solver " + str(method) + ", expected one of " + ", ".join(SOLVERS))
+    options = {name: value for name, value in options.items() if value is not None}
+    return SOLVERS[method](table, discount, values, policy, **options)
+
+
+def _initial(table, values, policy):
+    """
+    Function to fill in the default starting values and policy.
+    :param table: the transition table
+    :param values: the starting value of each state or None
+    :param policy: the starting action index of each state or None
+    :return: the values and a copy of the policy
+    """
+
+    if values is None:
+        values = np.zeros(table.num_of_states)
+    if policy is None:
+        policy = np.zeros(table.num_of_states, dtype=np.int64)
+    return values, np.array(policy, dtype=np.int64)
+
+
+def _gather(indptr, indices, rows, weights):
+    """
+    Function to collect the entries of several rows of a CSR index.
+    :param indptr: the start of each row
+    :param indices: the entries
+    :param rows: the rows to collect
+    :param weights: a weight for each row, repeated for each of its entries
+    :return: the entries and their weights
+    """
+
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    offsets = np.cumsum(lengths) - lengths
+    entries = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+    return indices[entries], np.repeat(weights, lengths)
@@ -0,0 +1,472 @@
+from collections.abc import Mapping
+
+import numpy as np
+
+
+class _Transitions(Mapping):
+    """
+    Base class of the transition tables, holding the states and actions and the read-only
+    { state: { action: { next_state: (prob, reward) } } } view built on row_dict.
+    """
+
+    def __init__(self, states, actions, codec):
+        """
+        The constructor for the _Transitions class.
+        :param states: the list of state keys, the position of a state is its index
+        :param actions: the list of actions, the position of an action is its index
+        :param codec: the StateCodec of the state keys
+        """
+
+        self.states = states
+        self.actions = actions
+        self.codec = codec
+        self.state_keys = codec.as_array(states)
+        self.action_codes = codec.encode_items(actions)
+        self.state_index = {state: ind for ind, state in enumerate(states)}
+        self.action_index = {action: ind for ind, action in enumerate(actions)}
+        self.num_of_states = len(states)
+        self.num_of_actions = len(actions)
+        self._predecessors = None
+
+    def next_state_of(self, state_idx, action_idx):
+        """
+        Method to get the state reached from a state after an action.
+        :param state_idx: the index of the state
+        :param action_idx: the index of the action
+        :return: the next state key
+        """
+
+        return self.codec.shift(self.state_keys[state_idx:state_idx + 1], self.action_codes[action_idx]).tolist()[0]
+
+    def row_dict(self, state_idx, action_idx):
+        """
+        Method to build the dict view of one row.
+        :param state_idx: the index of the state
+        :param action_idx: the index of the action
+        :return: { next_state: (prob, reward), ... }
+        """
+
+        raise NotImplementedError
+
+    def to_dict(self):
+        """
+        Method to materialise the whole table as nested dicts.
+        :return: { state: { action: { next_state: (prob, reward), ... }, ... }, ... }
+        """
+
+        return {state: dict(self[state].items()) for state in self.states}
+
+    def __getitem__(self, state):
+        return _StateView(self, self.state_index[state])
+
+    def __iter__(self):
+        return iter(self.states)
+
+    def __len__(self):
+        return self.num_of_states
+
+    def __contains__(self, state):
+        return state in self.state_index
+
+
+class TransitionTable(_Transitions):
+    """
+    Class to store the transition table as CSR arrays.
+
+    Every (state, action) pair is a row, row = state_idx * num_of_actions + action_idx. The entries of a row are the
+    next states that can be reached, stored as (next_state, next_action, prob, reward) in flat arrays delimited by
+    indptr. Next states which are not in the state space share the sink index num_of_states, whose value is always 0.
+
+    The table also behaves as a read-only { state: { action: { next_state: (prob, reward) } } } mapping so that code
+    written against the old nested dicts keeps working.
+    """
+
+    def __init__(self, states, actions, indptr, next_state, next_action, prob, reward, codec):
+        """
+        The constructor for the TransitionTable class.
+        :param states: the list of state keys, the position of a state is its index
+        :param actions: the list of actions, the position of an action is its index
+        :param indptr: the start of each row in the entry arrays (length num_of_states * num_of_actions + 1)
+        :param next_state: the index of the next state of each entry
+        :param next_action: the index of the action that completes the next state of each entry
+        :param prob: the transition probability of each entry
+        :param reward: the reward of each entry
+        :param codec: the StateCodec of the state keys
+        """
+
+        super().__init__(states, actions, codec)
+        self.indptr = indptr
+        self.next_state = next_state
+        self.next_action = next_action
+        self.prob = prob
+        self.reward = reward
+
+    @property
+    def nnz(self):
+        """
+        The number of stored transitions.
+        :return: number of entries
+        """
+
+        return len(self.prob)
+
+    @property
+    def nbytes(self):
+        """
+        The memory used by the entry arrays.
+        :return: number of bytes
+        """
+
+        return sum(arr.nbytes for arr in (self.indptr, self.next_state, self.next_action, self.prob, self.reward))
+
+    def backup(self, values, discount):
+        """
+        Method to compute the action values of every state in one vectorized pass.
+        :param values: the value of each state
+        :param discount: the discount factor
+        :return: an array of shape (num_of_states, num_of_actions) with the action values
+        """
+
+        # action_value = sum of probability * (reward + (discount * next_state_value))
+        targets = np.append(values, 0)[self.next_state]
+        action_values = self._row_sums(self.prob * (self.reward + discount * targets), self.indptr)
+        return action_values.reshape(self.num_of_states, self.num_of_actions)
+
+    def backup_policy(self, values, discount, policy, states=None):
+        """
+        Method to compute the value of following the given action in every state.
+        :param values: the value of each state
+        :param discount: the discount factor
+        :param policy: the index of the action chosen in each state
+        :param states: the indices of the states to compute (all if None)
+        :return: an array with the value of each state
+        """
+
+        if states is None:
+            rows = np.arange(self.num_of_states) * self.num_of_actions + policy
+        else:
+            states = np.asarray(states, dtype=np.int64)
+            rows = states * self.num_of_actions + np.asarray(policy)[states]
+        return self._backup_rows(values, discount, rows)
+
+    def backup_states(self, values, discount, states):
+        """
+        Method to compute the action values of a subset of states.
+        :param values: the value of each state
+        :param discount: the discount factor
+        :param states: the indices of the states to back up
+        :return: an array of shape (len(states), num_of_actions) with the action values
+        """
+
+        states = np.asarray(states, dtype=np.int64)
+        rows = (states[:, None] * self.num_of_actions + np.arange(self.num_of_actions)).ravel()
+        return self._backup_rows(values, discount, rows).reshape(len(states), self.num_of_actions)
+
+    def predecessors(self):
+        """
+        Method to get the states that can lead into each state, built once and cached.
+        :return: indptr and indices arrays, the predecessors of state s are indices[indptr[s]:indptr[s + 1]]
+        """
+
+        if self._predecessors is None:
+            source = np.repeat(np.arange(self.num_of_states * self.num_of_actions) // self.num_of_actions,
+                               np.diff(self.indptr))
+            self._predecessors = _predecessor_index(self.num_of_states, source, self.next_state)
+        return self._predecessors
+
+    def _backup_rows(self, values, discount, rows):
+        """
+        Method to compute the expected value of a set of rows.
+        :param values: the value of each state
+        :param discount: the discount factor
+        :param rows: the rows to compute
+        :return: an array with the value of each row
+        """
+
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+
+        # Gather the entries of the selected rows into one contiguous run
+        offsets = np.cumsum(lengths) - lengths
+        entries = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+        targets = np.append(values, 0)[self.next_state[entries]]
+        contrib = self.prob[entries] * (self.reward[entries] + discount * targets)
+        return self._row_sums(contrib, np.append(offsets, len(entries)))
+
+    @staticmethod
+    def _row_sums(contrib, indptr):
+        """
+        Method to add up the entries of each row, rows may be empty.
+        :param contrib: the value of each entry
+        :param indptr: the start of each row
+        :return: an array with the sum of each row
+        """
+
+        starts = indptr[:-1]
+        nonempty = starts < indptr[1:]
+        sums = np.zeros(len(starts))
+        if nonempty.any():
+            sums[nonempty] = np.add.reduceat(contrib, starts[nonempty])
+        return sums
+
+    def replace_rows(self, states, state_idx, row_lengths, next_state, next_action, prob, reward):
+        """
+        Method to get a table with the rows of some states rebuilt, keeping every other row.
+        :param states: the list of state keys, the old states first in the same order followed by any new states
+        :param state_idx: the indices of the states whose rows are given, sorted, including every new state
+        :param row_lengths: the length of each given row
+        :param next_state: the index of the next state of each given entry
+        :param next_action: the index of the action that completes the next state of each given entry
+        :param prob: the transition probability of each given entry
+        :param reward: the reward of each given entry
+        :return: a new TransitionTable
+        """
+
+        num_of_states = len(states)
+        num_of_rows = num_of_states * self.num_of_actions
+
+        # Find each row in the old entries or the given ones, which are placed after the old ones
+        lengths = np.zeros(num_of_rows, dtype=np.int64)
+        sources = np.zeros(num_of_rows, dtype=np.int64)
+        old_rows = self.num_of_states * self.num_of_actions
+        lengths[:old_rows] = np.diff(self.indptr)
+        sources[:old_rows] = self.indptr[:-1]
+        rows = (np.asarray(state_idx)[:, None] * self.num_of_actions + np.arange(self.num_of_actions)).ravel()
+        lengths[rows] = row_lengths
+        sources[rows] = self.nnz + np.cumsum(row_lengths) - row_lengths
+
+        indptr = np.zeros(num_of_rows + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        entries = np.repeat(sources - indptr[:-1], lengths) + np.arange(indptr[-1])
+
+        # The sink moves to the new number of states
+        old_next_state = np.where(self.next_state == self.num_of_states, num_of_states, self.next_state)
+        return TransitionTable(states, self.actions, indptr,
+                               np.concatenate([old_next_state, next_state])[entries],
+                               np.concatenate([self.next_action, next_action])[entries],
+                               np.concatenate([self.prob, prob])[entries],
+                               np.concatenate([self.reward, reward])[entries], self.codec)
+
+    def row(self, state_idx, action_idx):
+        """
+        Method to get the slice of entries for a given row.
+        :param state_idx: the index of the state
+        :param action_idx: the index of the action
+        :return: a slice into the entry arrays
+        """
+
+        r = state_idx * self.num_of_actions + action_idx
+        return slice(self.indptr[r], self.indptr[r + 1])
+
+    def row_dict(self, state_idx, action_idx):
+        """
+        Method to build the dict view of one row.
+        :param state_idx: the index of the state
+        :param action_idx: the index of the action
+        :return: { next_state: (prob, reward), ... }
+        """
+
+        entries = self.row(state_idx, action_idx)
+        next_keys = self.codec.shift(np.repeat(self.state_keys[state_idx], entries.stop - entries.start),
+                                     self.action_codes[self.next_action[entries]])
+        return {n: (p, r) for n, p, r in zip(next_keys.tolist(), self.prob[entries].tolist(),
+                                             self.reward[entries].tolist())}
+
+
+class ImplicitTransitions(_Transitions):
+    """
+    Class to compute Bellman backups without materialising the transition table.
+
+    Choosing action a in state s lands in the state completed by action a' with probability
+    beta[a, a'] * observed[s, a'] / sum_a'' beta[a, a''] * observed[s, a''], so every row of a state is the same
+    observed vector reweighted by a row of beta. The action values of all states are then
+    ((observed * (reward + discount * next_values)) @ beta.T) / (observed @ beta.T), which needs num_of_states *
+    num_of_actions numbers per array instead of num_of_states * num_of_actions ** 2 entries.
+    """
+
+    def __init__(self, states, actions, observed, beta, next_state, reward, codec):
+        """
+        The constructor for the ImplicitTransitions class.
+        :param states: the list of state keys, the position of a state is its index
+        :param actions: the list of actions, the position of an action is its index
+        :param observed: an array of shape (num_of_states, num_of_actions) with alpha * count(s + a') / count(s)
+        :param beta: an array of shape (num_of_actions, num_of_actions) with the weight of landing on a' after a
+        :param next_state: an array of shape (num_of_states, num_of_actions) with the index of the state completed by
+        each action, num_of_states for the sink
+        :param reward: an array of shape (num_of_states, num_of_actions) with the reward of the state completed by each
+        action
+        :param codec: the StateCodec of the state keys
+        """
+
+        super().__init__(states, actions, codec)
+        self.observed = observed
+        self.beta = beta
+        self.next_state = next_state
+        self.reward = reward
+        # The normalisation of every row, the same for every backup
+        self.norm = observed @ beta.T
+
+    @property
+    def nnz(self):
+        """
+        The number of transitions with a non-zero probability, none of which are stored.
+        :return: number of transitions
+        """
+
+        # Outcome a' is in the row of (s, a) when both observed[s, a'] and beta[a, a'] are positive
+        return int(np.dot(np.count_nonzero(self.observed > 0, axis=0), np.count_nonzero(self.beta > 0, axis=0)))
+
+    @property
+    def nbytes(self):
+        """
+        The memory used by the arrays.
+        :return: number of bytes
+        """
+
+        return sum(arr.nbytes for arr in (self.observed, self.beta, self.next_state, self.reward, self.norm))
+
+    def backup(self, values, discount):
+        """
+        Method to compute the action values of every state in one vectorized pass.
+        :param values: the value of each state
+        :param discount: the discount factor
+        :return: an array of shape (num_of_states, num_of_actions) with the action values
+        """
+
+        return (self._weighted_targets(values, discount) @ self.beta.T) / self.norm
+
+    def backup_policy(self, values, discount, policy, states=None):
+        """
+        Method to compute the value of following the given action in every state.
+        :param values: the value of each state
+        :param discount: the discount factor
+        :param policy: the index of the action chosen in each state
+        :param states: the indices of the states to compute (all if None)
+        :return: an array with the value of each state
+        """
+
+        if states is None:
+            states = np.arange(self.num_of_states)
+        else:
+            states = np.asarray(states, dtype=np.int64)
+        policy = np.asarray(policy)[states]
+        targets = self._weighted_targets(values, discount, states)
+        return np.einsum('ij,ij->i', targets, self.beta[policy]) / self.norm[states, policy]
+
+    def backup_states(self, values, discount, states):
+        """
+        Method to compute the action values of a subset of states.
+        :param values: the value of each state
+        :param discount: the discount factor
+        :param states: the indices of the states to back up
+        :return: an array of shape (len(states), num_of_actions) with the action values
+        """
+
+        states = np.asarray(states, dtype=np.int64)
+        return (self._weighted_targets(values, discount, states) @ self.beta.T) / self.norm[states]
+
+    def predecessors(self):
+        """
+        Method to get the states that can lead into each state, built once and cached.
+        :return: indptr and indices arrays, the predecessors of state s are indices[indptr[s]:indptr[s + 1]]
+        """
+
+        if self._predecessors is None:
+            # Every action is a possible outcome of every row of a state where it was observed
+            source, action = np.nonzero(self.observed > 0)
+            self._predecessors = _predecessor_index(self.num_of_states, source, self.next_state[source, action])
+        return self._predecessors
+
+    def _weighted_targets(self, values, discount, states=None):
+        """
+        Method to compute observed * (reward + discount * value of the next state) for every action.
+        :param values: the value of each state
+        :param discount: the discount factor
+        :param states: the indices of the states to compute (all if None)
+        :return: an array of shape (len(states), num_of_actions)
+        """
+
+        rows = slice(None) if states is None else states
+        targets = np.append(values, 0)[self.next_state[rows]]
+        return self.observed[rows] * (self.reward[rows] + discount * targets)
+
+    def replace_states(self, states, state_idx, observed, next_state, reward):
+        """
+        Method to get an operator with the arrays of some states rebuilt, keeping every other state.
+        :param states: the list of state keys, the old states first in the same order followed by any new states
+        :param state_idx: the indices of the states whose arrays are given, including every new state
+        :param observed: the observed continuations of the given states
+        :param next_state: the next state of each action from the given states
+        :param reward: the reward of each action from the given states
+        :return: a new ImplicitTransitions
+        """
+
+        num_of_states = len(states)
+        shape = (num_of_states, self.num_of_actions)
+        new_observed = np.zeros(shape)
+        new_next_state = np.full(shape, num_of_states, dtype=np.int64)
+        new_reward = np.zeros(shape)
+
+        # The sink moves to the new number of states
+        old = self.num_of_states
+        new_observed[:old] = self.observed
+        new_next_state[:old] = np.where(self.next_state == old, num_of_states, self.next_state)
+        new_reward[:old] = self.reward
+        new_observed[state_idx] = observed
+        new_next_state[state_idx] = next_state
+        new_reward[state_idx] = reward
+        return ImplicitTransitions(states, self.actions, new_observed, self.beta, new_next_state, new_reward,
+                                   self.codec)
+
+    def row_dict(self, state_idx, action_idx):
+        """
+        Method to build the dict view of one row.
+        :param state_idx: the index of the state
+        :param action_idx: the index of the action
+        :return: { next_state: (prob, reward), ... }
+        """
+
+        weights = self.beta[action_idx] * self.observed[state_idx]
+        present = np.flatnonzero(weights > 0)
+        next_keys = self.codec.shift(np.repeat(self.state_keys[state_idx], len(present)), self.action_codes[present])
+        return {n: (p, r) for n, p, r in zip(next_keys.tolist(), (weights[present] / weights.sum()).tolist(),
+                                             self.reward[state_idx, present].tolist())}
+
+
+class _StateView(Mapping):
+    """
+    Read-only { action: { next_state: (prob, reward) } } view of one state of a TransitionTable.
+    """
+
+    def __init__(self, table, state_idx):
+        self.table = table
+        self.state_idx = state_idx
+
+    def __getitem__(self, action):
+        return self.table.row_dict(self.state_idx, self.table.action_index[action])
+
+    def __iter__(self):
+        return iter(self.table.actions)
+
+    def __len__(self):
+        return self.table.num_of_actions
+
+    def __contains__(self, action):
+        return action in self.table.action_index
+
+
+def _predecessor_index(num_of_states, source, target):
+    """
+    Function to build the predecessors of every state from the transitions between states.
+    :param num_of_states: the number of states, the sink is num_of_states
+    :param source: the state of each transition
+    :param target: the next state of each transition
+    :return: indptr and indices arrays, the predecessors of state s are indices[indptr[s]:indptr[s + 1]]
+    """
+
+    # Unique (next state, state) pairs, sorted by next state, without the sink
+    pairs = np.unique(target * num_of_states + source)
+    pairs = pairs[pairs < num_of_states * num_of_states]
+    indptr = np.zeros(num_of_states + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pairs // num_of_states, minlength=num_of_states), out=indptr[1:])
+    return indptr, pairs % num_of_states
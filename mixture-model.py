@@ -1,75 +1,262 @@
-from mdp import MDP
-from tabulate import tabulate
-
-
-class MixtureModel:
-    """
-    Class to implement mixture models of multiple MDPs.
-    """
-
-    def __init__(self, path='data-mini', alpha=1, k=3, discount_factor=0.999, verbose=True, save_path="mixture-models"):
-        """
-        The constructor for the MixtureModel class.
-        :param path: path to data
-        :param alpha: the proportionality constant when considering transitions
-        :param k: the number of models
-        :param discount_factor: the discount factor for each MDP
-        :param verbose:flag to show steps
-        :param save_path: the path to which models should be saved and loaded from
-        """
-
-        self.k = k
-        self.df = discount_factor
-        self.alpha = alpha
-        self.path = path
-        self.verbose = verbose
-        self.save_path = save_path
-
-    def generate_model(self):
-        """
-        Method to generate and save the various models.
-        :return: None
-        """
-
-        # Generate models whose n-gram values change from 1...k
-        for i in range(1, self.k+1):
-            # Initialise the MDP
-            mm = MDP(path=self.path, alpha=self.alpha, k=i,
-                     discount_factor=self.df, verbose=self.verbose, save_path=self.save_path)
-            mm.initialise_mdp()
-            # Run the policy iteration and save the model
-            mm.policy_iteration(max_iteration=1000)
-
-    def predict(self, user_id):
-        """
-        Method  to provide recommendations.
-        :param user_id: the id of the user
-        :return: a list of tuples with the recommendations and their corresponding score
-        """
-
-        recommendations = {}
-        for i in range(1, self.k+1):
-            # Initialise each MDP
-            mm = MDP(path=self.path, alpha=self.alpha, k=i,
-                     discount_factor=self.df, verbose=self.verbose, save_path=self.save_path)
-            # Load its corresponding policy
-            mm.load_policy("mdp-model_k=" + str(i) + ".pkl")
-            # Append the recommendation into the list
-            rec_list = mm.recommend(user_id)
-            for rec in rec_list:
-                if rec[0] not in recommendations:
-                    recommendations[rec[0]] = 0
-                recommendations[rec[0]] += (1/self.k) * rec[1]
-
-        # Sort according to value for each recommendation
-        return sorted(recommendations.items(), key=lambda x: x[1], reverse=True)
-
-
-if __name__ == '__main__':
-    rs = MixtureModel(path='data-mini', k=3, verbose=False)
-    headers = ['Rank', 'Game', 'Score']
-    while True:
-        u = input("Enter a user ID: ")
-        r_list = rs.predict(u)
-        print(tabulate([[ind + 1, r[0], r[1]] for ind, r in enumerate(r_list)], headers, "psql"))
-
+import functools
+import multiprocessing
+import os
+import pickle
+import time
+
+import numpy as np
+
+import mdp_solvers
+import model_format
+from mdp import MDP
+from mdp_handler import MDPInitializer
+from model_registry import ModelRegistry
+
+
+class MixtureModel:
+    """
+    Class to implement mixture models of multiple MDPs.
+    """
+
+    def __init__(self, path='data-mini', alpha=1, k=3, discount_factor=0.999, verbose=True, save_path="mixture-models",
+                 registry=None):
+        """
+        The constructor for the MixtureModel class.
+        :param path: path to data
+        :param alpha: the proportionality constant when considering transitions
+        :param k: the number of models
+        :param discount_factor: the discount factor for each MDP
+        :param verbose:flag to show steps
+        :param save_path: the path to which models should be saved and loaded from
+        :param registry: the ModelRegistry the models are served from, shared to keep the models of several mixtures
+        under one memory budget (one without a budget for this mixture if None)
+        """
+
+        self.k = k
+        self.df = discount_factor
+        self.alpha = alpha
+        self.path = path
+        self.verbose = verbose
+        self.save_path = save_path
+
+        # The shared data and the key in the registry of the model of each n-gram size, loaded on first use
+        self.mdp_i = None
+        self.registry = ModelRegistry() if registry is None else registry
+        self.model_keys = []
+
+    def generate_model(self, workers=None, warm_start=False):
+        """
+        Method to generate and save the various models.
+        :param workers: the number of models trained at the same time (number of CPUs if None)
+        :param warm_start: flag to start each model from the values and policy of the one before it instead of a
+        random policy, the models are then trained one after another
+        :return: a dict with the stats of the policy iteration of each model
+        """
+
+        # Parse the data once, every model shares it
+        if self.mdp_i is None:
+            self.mdp_i = MDPInitializer(self.path, self.k, self.alpha)
+        workers = min(workers or os.cpu_count() or 1, self.k)
+
+        # Generate models whose n-gram values change from 1...k
+        results = {}
+        _shared['mixture'] = self
+        _shared['warm_start'] = warm_start
+        try:
+            if workers == 1 or warm_start:
+                finished = map(_train_model, range(1, self.k + 1))
+                results = self._collect(finished)
+            else:
+                # Forked workers see the parsed data without copying it, which other start methods would pickle
+                with multiprocessing.get_context('fork').Pool(workers, _init_worker, (self,)) as pool:
+                    results = self._collect(pool.imap_unordered(_train_model, range(1, self.k + 1)))
+        finally:
+            _shared.clear()
+        return results
+
+    def _collect(self, finished):
+        """
+        Method to report each model as it finishes training.
+        :param finished: an iterator of (n-gram size, stats, seconds) tuples
+        :return: a dict with the stats of each model
+        """
+
+        results = {}
+        for i, stats, seconds in finished:
+            results[i] = stats
+            if self.verbose:
+                print("Model k=" + str(i) + " trained in " + "%.2f" % seconds + "s, " + str(len(stats)) +
+                      " iterations (" + str(len(results)) + "/" + str(self.k) + " done)")
+        return results
+
+    def load(self):
+        """
+        Method to load the data and register the model of each n-gram size, which the registry loads on first use.
+        :return: None
+        """
+
+        if self.mdp_i is None:
+            if self.verbose:
+                print("Loading data from " + self.path)
+            self.mdp_i = MDPInitializer(self.path, self.k, self.alpha)
+        self.model_keys = [self.registry.register(self.model_key(i), functools.partial(self.load_model, i))
+                           for i in range(1, self.k + 1)]
+
+    def model_key(self, i):
+        """
+        Method to get the key in the registry of the model with n-gram size i, versioned by the time its file was saved.
+        :param i: the n-gram size
+        :return: a (dataset, k, alpha, discount factor, version) tuple
+        """
+
+        filename = self.save_path + "/mdp-model_k=" + str(i)
+        filename += ".mdpm" if os.path.exists(filename + ".mdpm") else ".pkl"
+        return self.path, i, self.alpha, self.df, os.stat(filename).st_mtime_ns
+
+    @property
+    def models(self):
+        """
+        The model of each n-gram size, through the registry.
+        :return: a list of model_format.Model
+        """
+
+        return [self.registry.get(key) for key in self.model_keys]
+
+    def load_model(self, i):
+        """
+        Method to load the model with n-gram size i, preferring the binary model file over the pickled policy.
+        :param i: the n-gram size
+        :return: a model_format.Model
+        """
+
+        filename = self.save_path + "/mdp-model_k=" + str(i)
+        if os.path.exists(filename + ".mdpm"):
+            if self.verbose:
+                print("Loading model from " + filename + ".mdpm")
+            model = model_format.load_model(filename + ".mdpm")
+            if model.codec.items != self.mdp_i.codec.items or model.actions != self.mdp_i.actions:
+                raise ValueError(filename + ".mdpm was trained on a different set of games")
+            return model
+
+        if self.verbose:
+            print("Loading model from " + filename + ".pkl")
+        codec = self.mdp_i.codec.with_length(i)
+        with open(filename + ".pkl", 'rb') as f:
+            policy_list = pickle.load(f)
+        # A pickle of a whole MDP holds the policy list among its attributes
+        if 'policy_list' in policy_list and isinstance(policy_list['policy_list'], dict):
+            policy_list = policy_list['policy_list']
+        policy_list = {codec.encode(state) if isinstance(state, tuple) else state: ranked
+                       for state, ranked in policy_list.items()}
+        return model_format.build_model(codec, self.mdp_i.actions, policy_list)
+
+    def predict(self, user_id):
+        """
+        Method  to provide recommendations.
+        :param user_id: the id of the user
+        :return: a list of tuples with the recommendations and their corresponding score
+        """
+
+        return self.predict_many([user_id])[0]
+
+    def predict_many(self, user_ids, top_n=None):
+        """
+        Method to provide recommendations to many users at once.
+        :param user_ids: the ids of the users
+        :param top_n: the number of recommendations for each user (all if None)
+        :return: a list with a list of (game, score) tuples for each user
+        """
+
+        if not self.model_keys:
+            self.load()
+
+        user_ids = list(user_ids)
+        recommendations, found = self.predict_codes(self.mdp_i.recent_codes(user_ids, self.k), top_n)
+        if not found.all():
+            raise KeyError(user_ids[int(np.argmin(found))])
+        return recommendations
+
+    def predict_codes(self, rows, top_n=None):
+        """
+        Method to provide recommendations for users given by the codes of their last games.
+        :param rows: an array of shape (n, k) with the codes of the last k games of each user, 0 for None
+        :param top_n: the number of recommendations for each user (all if None)
+        :return: a list with a list of (game, score) tuples for each user and whether each user's state, or a suffix of
+        it, is in every model, the recommendations of users whose state is not are meaningless
+        """
+
+        if not self.model_keys:
+            self.load()
+
+        rows = np.asarray(rows).reshape(-1, self.k)
+        num_of_actions = len(self.mdp_i.actions)
+        scores = np.zeros((len(rows), num_of_actions))
+        present = np.zeros((len(rows), num_of_actions), dtype=bool)
+        found = np.ones(len(rows), dtype=bool)
+        users = np.arange(len(rows))[:, None]
+        for i, key in enumerate(self.model_keys, 1):
+            # Find the current state of each user in the model, or the longest suffix of it the model has
+            model = self.registry.get(key)
+            ranked, ranked_scores, in_model = model.lookup(rows[:, self.k - i:])
+            found &= in_model
+
+            # Add the model's share of each ranked action's score
+            scores[users, ranked] += (1 / self.k) * ranked_scores
+            present[users, ranked] = True
+
+        # Sort according to value for each recommendation
+        ranking, ranked_scores = mdp_solvers.rank_actions(np.where(present, scores, -np.inf), top_n)
+        recommendations = []
+        for user, (ranked, ranked_score) in enumerate(zip(ranking.tolist(), ranked_scores.tolist())):
+            recommendations.append([(self.mdp_i.games[self.mdp_i.actions[a]], v)
+                                    for a, v in zip(ranked, ranked_score) if present[user, a]])
+        return recommendations, found
+
+
+# The mixture model whose parsed data the training workers share
+_shared = {}
+
+
+def _init_worker(mixture):
+    """
+    Function to give a training worker the mixture model and its parsed data.
+    :param mixture: the MixtureModel
+    :return: None
+    """
+
+    _shared['mixture'] = mixture
+
+
+def _train_model(i):
+    """
+    Function to train and save the model with n-gram size i.
+    :param i: the n-gram size
+    :return: the n-gram size, the stats of the policy iteration and the seconds taken
+    """
+
+    start = time.perf_counter()
+    mixture = _shared['mixture']
+    # Initialise the MDP
+    mm = MDP(path=mixture.path, alpha=mixture.alpha, k=i, discount_factor=mixture.df, verbose=False,
+             save_path=mixture.save_path, mdp_i=mixture.mdp_i)
+    mm.initialise_mdp()
+    # Start from the model with one game less, mapping each state to its suffix
+    if _shared.get('previous') is not None:
+        mm.warm_start(_shared['previous'])
+    # Run the policy iteration and save the model
+    stats = mm.policy_iteration(max_iteration=1000)
+    if _shared.get('warm_start'):
+        _shared['previous'] = mm.serving_model()
+    return i, stats, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    from tabulate import tabulate
+
+    rs = MixtureModel(path='data-mini', k=3, verbose=False)
+    headers = ['Rank', 'Game', 'Score']
+    while True:
+        u = input("Enter a user ID: ")
+        r_list = rs.predict(u)
+        print(tabulate([[ind + 1, r[0], r[1]] for ind, r in enumerate(r_list)], headers, "psql"))
+
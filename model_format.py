@@ -0,0 +1,294 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+from state_codec import StateCodec
+
+MAGIC = b'MDPMODEL'
+FORMAT_VERSION = 2
+# Version 1 files have no backoff rankings
+SUPPORTED_VERSIONS = (1, 2)
+# Every array starts on a multiple of this many bytes
+ALIGNMENT = 64
+_PREFIX = struct.Struct('<8sII')
+# The arrays of a model in the order they are stored
+ARRAYS = ('state_keys', 'values', 'policy', 'ranked_actions', 'ranked_scores')
+
+
+class Model:
+    """
+    Class to hold a trained model as flat arrays with the states sorted by key.
+    """
+
+    def __init__(self, codec, actions, state_keys, values, policy, ranked_actions, ranked_scores, meta=None,
+                 backoff=None):
+        """
+        The constructor for the Model class.
+        :param codec: the StateCodec of the state keys
+        :param actions: the list of actions
+        :param state_keys: the key of each state, sorted
+        :param values: the value of each state
+        :param policy: the action index chosen in each state
+        :param ranked_actions: an array of shape (num_of_states, top_n) with the best action indices of each state
+        :param ranked_scores: an array of shape (num_of_states, top_n) with the scores of ranked_actions
+        :param meta: a dict of extra information (k, alpha, discount factor, ...)
+        :param backoff: a list with the rankings of the suffixes of each length below the state length, as
+        (sorted keys, ranked_actions, ranked_scores) tuples, the keys of length 0 are ignored (no backoff if None)
+        """
+
+        self.codec = codec
+        self.actions = actions
+        self.state_keys = state_keys
+        self.values = values
+        self.policy = policy
+        self.ranked_actions = ranked_actions
+        self.ranked_scores = ranked_scores
+        self.meta = meta or {}
+        self.num_of_states = len(state_keys)
+        self.backoff = backoff or []
+        self.backoff_codecs = [codec.with_length(length) if length else None for length in range(len(self.backoff))]
+
+    def arrays(self):
+        """
+        Method to list the arrays of the model in the order they are stored.
+        :return: a list of (name, array) tuples
+        """
+
+        arrays = [(name, getattr(self, name)) for name in ARRAYS]
+        for length, (keys, ranked_actions, ranked_scores) in enumerate(self.backoff):
+            if length:
+                arrays.append(('backoff_keys_' + str(length), keys))
+            arrays.append(('backoff_actions_' + str(length), ranked_actions))
+            arrays.append(('backoff_scores_' + str(length), ranked_scores))
+        return arrays
+
+    def find(self, keys):
+        """
+        Method to find states by key.
+        :param keys: an array of state keys
+        :return: the index of each state, -1 if it is not in the model
+        """
+
+        return _search(self.state_keys, self.codec.as_array(keys))
+
+    def lookup(self, rows):
+        """
+        Method to get the ranked actions of states given as codes, backing off to the longest suffix of each state
+        that has a ranking when the state is not in the model.
+        :param rows: an array of shape (n, length) with the codes of the games of each state
+        :return: the ranked actions and their scores, both of shape (n, top_n), and whether each state got a ranking
+        """
+
+        rows = np.asarray(rows, dtype=np.int32).reshape(-1, self.codec.length)
+        states = self.find(self.codec.pack(rows))
+        found = states >= 0
+        top_n = self.ranked_actions.shape[1]
+        if self.num_of_states:
+            ranked_actions = self.ranked_actions[np.where(found, states, 0)]
+            ranked_scores = self.ranked_scores[np.where(found, states, 0)]
+        else:
+            ranked_actions = np.zeros((len(rows), top_n), dtype=np.int32)
+            ranked_scores = np.zeros((len(rows), top_n))
+
+        # Try the suffixes of the missing states from the longest to the empty one
+        for length in range(len(self.backoff) - 1, -1, -1):
+            missing = np.flatnonzero(~found)
+            if not len(missing):
+                break
+            keys, backoff_actions, backoff_scores = self.backoff[length]
+            if not len(backoff_actions):
+                continue
+            if length:
+                ind = _search(keys, self.backoff_codecs[length].pack(rows[missing, rows.shape[1] - length:]))
+            else:
+                ind = np.zeros(len(missing), dtype=np.int64)
+            hit = ind >= 0
+            ranked_actions[missing[hit]] = backoff_actions[ind[hit], :top_n]
+            ranked_scores[missing[hit]] = backoff_scores[ind[hit], :top_n]
+            found[missing[hit]] = True
+        return ranked_actions, ranked_scores, found
+
+    def ranked(self, state):
+        """
+        Method to get the ranked actions of a state, or of its longest suffix with a ranking if it is not in the model.
+        :param state: the state key
+        :return: a list of (action, score) tuples, best first
+        """
+
+        ranked_actions, ranked_scores, found = self.lookup(self.codec.unpack([state]))
+        if not found[0]:
+            raise KeyError(state)
+        return [(self.actions[a], s) for a, s in zip(ranked_actions[0].tolist(), ranked_scores[0].tolist())]
+
+    def __contains__(self, state):
+        return self.find([state])[0] >= 0
+
+    def __getitem__(self, state):
+        return self.ranked(state)
+
+    def __len__(self):
+        return self.num_of_states
+
+
+class ModelFile(Model):
+    """
+    Class to serve a model written by save_model straight from memory-mapped arrays.
+    """
+
+    def __init__(self, path):
+        """
+        The constructor for the ModelFile class.
+        :param path: the file to read
+        """
+
+        self.path = path
+        header, data_start = read_header(path)
+
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            shape = tuple(spec['shape'])
+            if np.prod(shape) == 0:
+                arrays[name] = np.zeros(shape, dtype=np.dtype(spec['dtype']))
+            else:
+                arrays[name] = np.memmap(path, dtype=np.dtype(spec['dtype']), mode='r',
+                                         offset=data_start + spec['offset'], shape=shape)
+
+        # The backoff arrays are numbered by suffix length
+        codec = StateCodec(header['items'], header['length'])
+        backoff = []
+        while 'backoff_actions_' + str(len(backoff)) in arrays:
+            length = str(len(backoff))
+            backoff.append((arrays.pop('backoff_keys_' + length, None), arrays.pop('backoff_actions_' + length),
+                            arrays.pop('backoff_scores_' + length)))
+        super().__init__(codec, header['actions'], meta=header['meta'], backoff=backoff, **arrays)
+
+
+def build_model(codec, actions, policy_list, policy=None, values=None, meta=None, backoff=None):
+    """
+    Function to build a model from a policy list.
+    :param codec: the StateCodec of the state keys
+    :param actions: the list of actions
+    :param policy_list: { state: [ (action, score), ... ], ... }
+    :param policy: { state: action, ... }, the first ranked action is used for missing states
+    :param values: { state: value, ... }, 0 is used for missing states
+    :param meta: a dict of extra information (k, alpha, discount factor, ...)
+    :param backoff: { suffix: [ (action, score), ... ], ... } with suffixes as tuples of codes shorter than the states
+    :return: a Model
+    """
+
+    action_index = {action: ind for ind, action in enumerate(actions)}
+    states = list(policy_list)
+    top_n = min((len(ranked) for ranked in policy_list.values()), default=0)
+
+    ranked_actions = np.array([[action_index[a] for a, _ in policy_list[state][:top_n]] for state in states],
+                              dtype=np.int32).reshape(len(states), top_n)
+    ranked_scores = np.array([[v for _, v in policy_list[state][:top_n]] for state in states],
+                             dtype=np.float64).reshape(len(states), top_n)
+    policy = policy or {}
+    chosen = np.array([action_index[policy[state]] if state in policy else ranked_actions[ind, 0]
+                       for ind, state in enumerate(states)], dtype=np.int32)
+    values = values or {}
+    state_values = np.array([values.get(state, 0) for state in states], dtype=np.float64)
+
+    # The states are stored sorted by key so that they can be found by binary search
+    state_keys = codec.as_array(states)
+    order = np.argsort(state_keys, kind='stable')
+
+    # The suffixes of each length are stored sorted by key like the states
+    levels = []
+    backoff = backoff or {}
+    for length in range(codec.length if backoff else 0):
+        suffixes = [suffix for suffix in backoff if len(suffix) == length]
+        rows = np.array(suffixes, dtype=np.int32).reshape(len(suffixes), length)
+        keys = codec.with_length(length).pack(rows) if length else np.zeros(len(suffixes), dtype=np.int64)
+        suffix_order = np.argsort(keys, kind='stable')
+        levels.append((keys[suffix_order],
+                       np.array([[action_index[a] for a, _ in backoff[suffixes[i]][:top_n]] for i in suffix_order],
+                                dtype=np.int32).reshape(len(suffixes), top_n),
+                       np.array([[v for _, v in backoff[suffixes[i]][:top_n]] for i in suffix_order],
+                                dtype=np.float64).reshape(len(suffixes), top_n)))
+    return Model(codec, list(actions), state_keys[order], state_values[order], chosen[order], ranked_actions[order],
+                 ranked_scores[order], meta, levels)
+
+
+def save_model(path, model):
+    """
+    Function to write a model as a header followed by flat arrays.
+    :param path: the file to write, replaced atomically
+    :param model: the Model
+    :return: None
+    """
+
+    layout = {}
+    offset = 0
+    for name, arr in model.arrays():
+        layout[name] = {'offset': offset, 'dtype': arr.dtype.str, 'shape': list(arr.shape)}
+        offset = _align(offset + arr.nbytes)
+    header = json.dumps({'items': model.codec.items, 'length': model.codec.length, 'actions': list(model.actions),
+                         'arrays': layout, 'meta': model.meta}).encode('utf-8')
+    data_start = _align(_PREFIX.size + len(header))
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        for name, arr in model.arrays():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(np.ascontiguousarray(arr).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    """
+    Function to read the header of a model file without mapping its arrays.
+    :param path: the file to read
+    :return: the header as a dict and the offset of the arrays
+    """
+
+    with open(path, 'rb') as f:
+        magic, version, header_len = _PREFIX.unpack(f.read(_PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError(path + " is not a model file")
+        if version not in SUPPORTED_VERSIONS:
+            raise ValueError(path + " has format version " + str(version) + ", expected one of " +
+                             ", ".join(str(v) for v in SUPPORTED_VERSIONS))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    return header, _align(_PREFIX.size + header_len)
+
+
+def load_model(path):
+    """
+    Function to open a model written by save_model.
+    :param path: the file to read
+    :return: a ModelFile
+    """
+
+    return ModelFile(path)
+
+
+def _search(sorted_keys, keys):
+    """
+    Function to find keys in a sorted array of keys.
+    :param sorted_keys: the sorted keys
+    :param keys: the keys to find
+    :return: the position of each key, -1 if it is not there
+    """
+
+    if not len(sorted_keys):
+        return np.full(len(keys), -1, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return np.where(sorted_keys[pos] == keys, pos, -1)
+
+
+def _align(offset):
+    """
+    Function to round an offset up to the array alignment.
+    :param offset: the offset in bytes
+    :return: the aligned offset
+    """
+
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
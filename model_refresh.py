@@ -0,0 +1,208 @@
+import mmap
+import multiprocessing
+import os
+import queue
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from mdp import MDP
+
+# A model published by the retrainer: its files are written once and never changed, seq is the last purchase it saw
+Snapshot = namedtuple('Snapshot', ['version', 'model_filename', 'users_filename', 'seq'])
+
+
+class Retrainer:
+    """
+    Class to retrain an MDP in a background process and publish every new model as a Snapshot.
+
+    The worker process holds the whole MDP, with its transitions, so training never competes with serving for the
+    interpreter. New transactions are sent to it as they happen and on each refresh, when triggered or every interval
+    seconds, it either re-solves the MDP with the transactions since the last refresh (MDP.update) or rebuilds it
+    from scratch. Each new model is saved under its own version as a model file and a user index, which a serving
+    process opens in milliseconds and swaps in once ready. The serving process removes the files of a snapshot once
+    it no longer maps them.
+    """
+
+    def __init__(self, path='data-mini', k=3, save_path="saved-models", interval=None, full=False):
+        """
+        The constructor for the Retrainer class.
+        :param path: path to data
+        :param k: the number of items in each state
+        :param save_path: the path the trained MDP is loaded from and the snapshots are saved to
+        :param interval: the number of seconds between scheduled refreshes (only triggered ones if None)
+        :param full: flag to rebuild the MDP on scheduled refreshes instead of re-solving it with the new transactions
+        """
+
+        self.path = path
+        self.k = k
+        self.save_path = save_path
+        self.interval = interval
+        self.full = full
+        self.commands = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.process = None
+
+    def start(self):
+        """
+        Method to start the worker process, before any event loop or thread is started in this one.
+        :return: None
+        """
+
+        self.process = multiprocessing.Process(target=_retrain_loop, args=(self, ), daemon=True)
+        self.process.start()
+
+    def stop(self):
+        """
+        Method to stop the worker process once the refresh it runs is done.
+        :return: None
+        """
+
+        if self.process is None:
+            return
+        self.commands.put(('stop', ))
+        self.process.join()
+        self.process = None
+
+    def add(self, rows, seq):
+        """
+        Method to send new transactions to the worker, they are used by the next refresh.
+        :param rows: transaction rows as [ user_id, game_id, behaviour, value ]
+        :param seq: the number of the last purchase among the rows, reported back with the snapshot that uses them
+        :return: None
+        """
+
+        self.commands.put(('rows', list(rows), seq))
+
+    def trigger(self, full=None):
+        """
+        Method to ask for a refresh now.
+        :param full: flag to rebuild the MDP instead of re-solving it (the scheduled kind if None)
+        :return: None
+        """
+
+        self.commands.put(('refresh', self.full if full is None else full))
+
+    def poll(self):
+        """
+        Method to get the newest snapshot published since the last call, without waiting. The older ones are never
+        opened, so their files are removed.
+        :return: a Snapshot or None
+        """
+
+        snapshot = None
+        while True:
+            try:
+                newer = self.results.get_nowait()
+            except queue.Empty:
+                return snapshot
+            if snapshot is not None:
+                self.release(snapshot)
+            snapshot = newer
+
+    def open(self, snapshot, registry=None):
+        """
+        Method to open a snapshot for serving and read its pages in, which can run outside the event loop.
+        :param snapshot: the Snapshot
+        :param registry: the ModelRegistry the model file is served from (one without a budget if None)
+        :return: a serve-only MDP
+        """
+
+        rs = MDP.serve(snapshot.model_filename, snapshot.users_filename, self.save_path, registry)
+        for _, arr in list(rs.model.arrays()) + [('rows', rs.mdp_i.rows)]:
+            if arr is not None and arr.nbytes:
+                np.frombuffer(arr, dtype=np.uint8)[::mmap.PAGESIZE].sum()
+        return rs
+
+    def release(self, snapshot):
+        """
+        Method to remove the files of a snapshot, once nothing maps them.
+        :param snapshot: the Snapshot
+        :return: None
+        """
+
+        for name in (snapshot.model_filename, snapshot.users_filename + '.json', snapshot.users_filename + '.users',
+                     snapshot.users_filename + '.rows'):
+            try:
+                os.remove(self.save_path + "/" + name)
+            except OSError:
+                pass
+
+
+def _retrain_loop(retrainer):
+    """
+    Function run by the worker process, refreshing the MDP until it is stopped.
+    :param retrainer: the Retrainer
+    :return: None
+    """
+
+    rs = MDP(path=retrainer.path, k=retrainer.k, verbose=False, save_path=retrainer.save_path)
+    filename = "mdp-model_k=" + str(retrainer.k)
+    if os.path.exists(retrainer.save_path + "/" + filename + ".pkl"):
+        rs.load(filename + ".pkl")
+        # The pickle holds the save path it was trained with
+        rs.save_path = retrainer.save_path
+    else:
+        rs.initialise_mdp()
+        rs.solve(to_save=False)
+
+    pending = []
+    seq = 0
+    version = 0
+    # Set when a refresh failed after the log took its transactions, only a rebuild brings the model in line again
+    stale = False
+    parent = multiprocessing.parent_process()
+    next_refresh = None if retrainer.interval is None else time.monotonic() + retrainer.interval
+    # Stop with the serving process, even when it is killed before it can stop the worker
+    while parent.is_alive():
+        wait = 1.0 if next_refresh is None else min(1.0, max(0.0, next_refresh - time.monotonic()))
+        try:
+            command = retrainer.commands.get(timeout=wait)
+        except queue.Empty:
+            if next_refresh is None or time.monotonic() < next_refresh:
+                continue
+            command = ('refresh', retrainer.full)
+        if command[0] == 'stop':
+            break
+        if command[0] == 'rows':
+            pending.extend(command[1])
+            seq = command[2]
+            continue
+        if retrainer.interval is not None:
+            next_refresh = time.monotonic() + retrainer.interval
+
+        # Refresh with the transactions received so far, a re-solve without any has nothing to do
+        full = command[1] or stale
+        if not full and not pending:
+            continue
+        # Every transaction the log takes is counted, even when its game or user is already known
+        received = int(rs.mdp_i.log.hours_count.sum())
+        try:
+            if full:
+                if pending:
+                    rs.mdp_i.add_transactions(pending, rs.S)
+                    pending = []
+                stale = True
+                # The games are compared by their hours per price, which the new transactions change
+                rs.mdp_i.game_data = rs.mdp_i.log.average_hours()
+                rs.initialise_mdp()
+                rs.solve(to_save=False)
+            else:
+                rs.update(pending, to_save=False)
+            pending = []
+            stale = False
+        except Exception as e:
+            # The model being served stays in place, transactions the log did not take wait for the next refresh
+            print(e)
+            if int(rs.mdp_i.log.hours_count.sum()) != received:
+                pending = []
+                stale = True
+            continue
+
+        version += 1
+        snapshot = Snapshot(version, filename + ".v" + str(version) + ".mdpm",
+                            "mdp-users_k=" + str(retrainer.k) + ".v" + str(version), seq)
+        rs.save_model(snapshot.model_filename)
+        rs.save_users(snapshot.users_filename)
+        retrainer.results.put(snapshot)
@@ -0,0 +1,154 @@
+import os
+from collections import OrderedDict
+
+import model_format
+
+
+class ModelRegistry:
+    """
+    Class to serve many trained models from one process.
+
+    Models are keyed by (dataset, k, alpha, discount factor, version) and registered with the file or the function
+    they are loaded from, which costs nothing until they are first asked for. The size of the arrays of each loaded
+    model is tracked and the least recently used models are dropped when together they take more than max_bytes.
+    A dropped model is loaded again the next time it is asked for.
+    """
+
+    def __init__(self, max_bytes=None):
+        """
+        The constructor for the ModelRegistry class.
+        :param max_bytes: the memory the loaded models may take (no limit if None), the model in use is always kept
+        """
+
+        self.max_bytes = max_bytes
+        self.loaders = {}
+        self.loaded = OrderedDict()
+        self.resident_bytes = 0
+        self.stats = {'hits': 0, 'loads': 0, 'evictions': 0}
+
+    def register(self, key, loader):
+        """
+        Method to register how a model is loaded, replacing any model loaded under the same key.
+        :param key: a (dataset, k, alpha, discount factor, version) tuple
+        :param loader: called with no arguments to load the model, returning a model_format.Model
+        :return: the key
+        """
+
+        self.drop(key)
+        self.loaders[key] = loader
+        return key
+
+    def register_file(self, path, dataset=None, version=None):
+        """
+        Method to register a model file written by model_format.save_model, only its header is read.
+        :param path: the file
+        :param dataset: the dataset the model was trained on (the one recorded in the file if None)
+        :param version: the version of the model (the modification time of the file if None)
+        :return: the key of the model
+        """
+
+        header, _ = model_format.read_header(path)
+        meta = header['meta']
+        key = (dataset if dataset is not None else meta.get('dataset'), header['length'], meta.get('alpha'),
+               meta.get('discount_factor'), version if version is not None else os.stat(path).st_mtime_ns)
+        return self.register(key, lambda: model_format.load_model(path))
+
+    def scan(self, directory):
+        """
+        Method to register every model file in a directory.
+        :param directory: the directory
+        :return: the keys of the models
+        """
+
+        return [self.register_file(os.path.join(directory, name)) for name in sorted(os.listdir(directory))
+                if name.endswith('.mdpm')]
+
+    def find(self, dataset=None, k=None, alpha=None, discount_factor=None):
+        """
+        Method to find the latest version of a model, the fields that are None match anything.
+        :param dataset: the dataset
+        :param k: the number of items in each state
+        :param alpha: the proportionality constant of the transitions
+        :param discount_factor: the discount factor
+        :return: the key of the matching model with the highest version
+        """
+
+        wanted = (dataset, k, alpha, discount_factor)
+        matches = [key for key in self.loaders if all(w is None or w == v for w, v in zip(wanted, key))]
+        if not matches:
+            raise KeyError(wanted)
+        return max(matches, key=lambda key: key[4])
+
+    def get(self, key, loader=None):
+        """
+        Method to get a model, loading it on first use and evicting the least recently used models beyond the memory
+        budget.
+        :param key: the key of the model
+        :param loader: registered for the key if it is not registered yet
+        :return: a model_format.Model
+        """
+
+        if key in self.loaded:
+            self.stats['hits'] += 1
+            self.loaded.move_to_end(key)
+            return self.loaded[key][0]
+        if key not in self.loaders:
+            if loader is None:
+                raise KeyError(key)
+            self.loaders[key] = loader
+
+        model = self.loaders[key]()
+        size = model_bytes(model)
+        self.loaded[key] = (model, size)
+        self.resident_bytes += size
+        self.stats['loads'] += 1
+        while self.max_bytes is not None and self.resident_bytes > self.max_bytes and len(self.loaded) > 1:
+            _, (_, evicted) = self.loaded.popitem(last=False)
+            self.resident_bytes -= evicted
+            self.stats['evictions'] += 1
+        return model
+
+    def drop(self, key):
+        """
+        Method to unload a model, it stays registered.
+        :param key: the key of the model
+        :return: None
+        """
+
+        if key in self.loaded:
+            self.resident_bytes -= self.loaded.pop(key)[1]
+
+    def unregister(self, key):
+        """
+        Method to unload a model and forget how it is loaded, for a model that will not be asked for again.
+        :param key: the key of the model
+        :return: None
+        """
+
+        self.drop(key)
+        self.loaders.pop(key, None)
+
+    def describe(self):
+        """
+        Method to get the counters of the registry.
+        :return: a dict of counters
+        """
+
+        return dict(self.stats, registered=len(self.loaders), loaded=len(self.loaded),
+                    resident_bytes=self.resident_bytes, max_bytes=self.max_bytes)
+
+    def __contains__(self, key):
+        return key in self.loaders
+
+    def __len__(self):
+        return len(self.loaders)
+
+
+def model_bytes(model):
+    """
+    Function to get the memory taken by the arrays of a model, memory-mapped arrays count in full.
+    :param model: a model_format.Model
+    :return: number of bytes
+    """
+
+    return sum(arr.nbytes for _, arr in model.arrays() if arr is not None)
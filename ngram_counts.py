@@ -0,0 +1,241 @@
+import json
+import os
+import shutil
+import tempfile
+from collections.abc import MutableMapping
+
+import numpy as np
+
+
+class CountTable(MutableMapping):
+    """
+    Dict-like table of n-gram counts as { key: count, ... } backed by sorted key and count arrays.
+
+    The arrays are normally memory-mapped from the files written by count_ngrams, so a table of any size costs little
+    memory until it is read. Keys are found by binary search and iterate in sorted order. Counts that are assigned are
+    kept aside and take precedence over the arrays, new keys come after the stored ones.
+    """
+
+    def __init__(self, keys, counts, path=None):
+        """
+        The constructor for the CountTable class.
+        :param keys: the sorted array of keys, without duplicates
+        :param counts: the count of each key
+        :param path: the path the arrays were loaded from, if any
+        """
+
+        self.stored_keys = keys
+        self.stored_counts = counts
+        self.path = path
+        self.overrides = {}
+        self.added = []
+
+    @classmethod
+    def load(cls, path):
+        """
+        Method to memory-map a table written by count_ngrams.
+        :param path: the path given to count_ngrams
+        :return: a CountTable
+        """
+
+        with open(path + '.json') as f:
+            header = json.load(f)
+        dtype = np.dtype(header['dtype'])
+        if not header['length']:
+            return cls(np.empty(0, dtype=dtype), np.empty(0, dtype=np.int64), path)
+        return cls(np.memmap(path + '.keys', dtype=dtype, mode='r', shape=(header['length'],)),
+                   np.memmap(path + '.counts', dtype=np.int64, mode='r', shape=(header['length'],)), path)
+
+    def _find(self, keys):
+        """
+        Method to find keys among the stored ones.
+        :param keys: an array of keys
+        :return: the position of each key and a mask of the keys that are stored
+        """
+
+        if not len(self.stored_keys):
+            return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.stored_keys, keys), len(self.stored_keys) - 1)
+        return pos, self.stored_keys[pos] == keys
+
+    def lookup(self, keys, default=0):
+        """
+        Method to get the counts of many keys at once.
+        :param keys: an array of keys
+        :param default: the count of the keys that are not in the table
+        :return: an int64 array
+        """
+
+        keys = np.asarray(keys, dtype=self.stored_keys.dtype).ravel()
+        pos, found = self._find(keys)
+        counts = np.full(len(keys), default, dtype=np.int64)
+        counts[found] = self.stored_counts[pos[found]]
+        if self.overrides:
+            assigned = np.asarray(list(self.overrides), dtype=self.stored_keys.dtype)
+            values = np.fromiter(self.overrides.values(), dtype=np.int64, count=len(assigned))
+            order = np.argsort(assigned, kind='stable')
+            pos = np.minimum(np.searchsorted(assigned[order], keys), len(assigned) - 1)
+            found = assigned[order][pos] == keys
+            counts[found] = values[order][pos[found]]
+        return counts
+
+    def arrays(self):
+        """
+        Method to get every key and count, in the order of iteration.
+        :return: the array of keys and the int64 array of counts
+        """
+
+        if not self.overrides:
+            return self.stored_keys, self.stored_counts
+        keys = np.concatenate([self.stored_keys, np.asarray(self.added, dtype=self.stored_keys.dtype)])
+        return keys, self.lookup(keys)
+
+    def chunks(self, chunk_size=1 << 20):
+        """
+        Method to read the table a block of keys at a time.
+        :param chunk_size: the number of keys in each block
+        :return: a generator of (keys, counts) array pairs
+        """
+
+        keys, counts = self.arrays()
+        for start in range(0, len(keys), chunk_size):
+            yield np.asarray(keys[start:start + chunk_size]), np.asarray(counts[start:start + chunk_size])
+
+    def __getitem__(self, key):
+        if key in self.overrides:
+            return self.overrides[key]
+        pos, found = self._find(np.asarray([key], dtype=self.stored_keys.dtype))
+        if not found[0]:
+            raise KeyError(key)
+        return int(self.stored_counts[pos[0]])
+
+    def __setitem__(self, key, count):
+        if key not in self.overrides and not self._find(np.asarray([key], dtype=self.stored_keys.dtype))[1][0]:
+            self.added.append(key)
+        self.overrides[key] = count
+
+    def __delitem__(self, key):
+        raise TypeError("Keys cannot be removed from a count table")
+
+    def __iter__(self):
+        for start in range(0, len(self.stored_keys), 1 << 16):
+            yield from self.stored_keys[start:start + (1 << 16)].tolist()
+        yield from self.added
+
+    def __len__(self):
+        return len(self.stored_keys) + len(self.added)
+
+    def __contains__(self, key):
+        return key in self.overrides or bool(self._find(np.asarray([key], dtype=self.stored_keys.dtype))[1][0])
+
+    def __getstate__(self):
+        # Tables written to disk are mapped again instead of copied into the pickle
+        state = dict(self.__dict__)
+        if self.path is not None and os.path.exists(self.path + '.json'):
+            state['stored_keys'] = state['stored_counts'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.stored_keys is None:
+            stored = CountTable.load(self.path)
+            self.stored_keys, self.stored_counts = stored.stored_keys, stored.stored_counts
+
+
+def count_ngrams(codec, codes, starts, ends, path, run_size=1 << 22):
+    """
+    Function to count every n-gram of a set of code sequences on disk.
+
+    The sequences are cut into chunks of at most run_size n-grams (one user is never split), the n-grams of each chunk
+    are counted into a sorted run on disk and the runs are merged into one table, so memory stays proportional to
+    run_size whatever the number of distinct n-grams.
+    :param codec: the StateCodec of the n-grams
+    :param codes: an array of codes
+    :param starts: the start of each sequence
+    :param ends: the end of each sequence (exclusive)
+    :param path: the path of the table, the files path.json, path.keys and path.counts are written
+    :param run_size: the number of n-grams counted in memory at once
+    :return: a memory-mapped CountTable
+    """
+
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    run_dir = tempfile.mkdtemp(prefix='runs-', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        # Split the sequences where the running number of n-grams crosses a multiple of run_size
+        sizes = np.maximum(ends - starts - codec.length + 1, 0)
+        bounds = np.searchsorted(np.cumsum(sizes), np.arange(run_size, sizes.sum() + run_size, run_size), 'left')
+        bounds = np.unique(np.concatenate([[0], np.minimum(bounds + 1, len(sizes)), [len(sizes)]]))
+
+        runs = []
+        for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            keys, counts = np.unique(codec.windows(codes, starts[lo:hi], ends[lo:hi]), return_counts=True)
+            if len(keys):
+                run = os.path.join(run_dir, str(len(runs)))
+                _write_table(run, keys, counts.astype(np.int64))
+                runs.append(run)
+        merge_runs(runs, path, codec.dtype, max(1, run_size // max(len(runs), 1)))
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return CountTable.load(path)
+
+
+def merge_runs(runs, path, dtype, block_size=1 << 20):
+    """
+    Function to merge sorted count tables into one, adding up the counts of the keys they share.
+    :param runs: the paths of the tables
+    :param path: the path of the merged table
+    :param dtype: the dtype of the keys
+    :param block_size: the number of keys read from each table at once
+    :return: the number of keys in the merged table
+    """
+
+    tables = [CountTable.load(run) for run in runs]
+    positions = [0] * len(tables)
+    length = 0
+    with open(path + '.keys', 'wb') as key_file, open(path + '.counts', 'wb') as count_file:
+        while any(pos < len(table) for pos, table in zip(positions, tables)):
+            # Every key up to the smallest last key of the blocks that do not end their table is complete
+            limits = [table.stored_keys[pos + block_size - 1:pos + block_size] for pos, table in zip(positions, tables)
+                      if pos + block_size < len(table)]
+            cutoff = np.sort(np.concatenate(limits))[0] if limits else None
+            keys = []
+            counts = []
+            for ind, table in enumerate(tables):
+                if positions[ind] >= len(table):
+                    continue
+                block = table.stored_keys[positions[ind]:positions[ind] + block_size]
+                take = len(block) if cutoff is None else int(np.searchsorted(block, cutoff, 'right'))
+                keys.append(np.asarray(block[:take]))
+                counts.append(np.asarray(table.stored_counts[positions[ind]:positions[ind] + take]))
+                positions[ind] += take
+
+            # Sort the taken keys and add up the counts of equal ones
+            keys = np.concatenate(keys)
+            counts = np.concatenate(counts)
+            order = np.argsort(keys, kind='stable')
+            keys = keys[order]
+            first = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+            keys[first].tofile(key_file)
+            np.add.reduceat(counts[order], first).astype(np.int64).tofile(count_file)
+            length += len(first)
+
+    with open(path + '.json', 'w') as f:
+        json.dump({'dtype': np.dtype(dtype).str, 'length': length}, f)
+    return length
+
+
+def _write_table(path, keys, counts):
+    """
+    Function to write sorted keys and their counts as a table that CountTable.load can map.
+    :param path: the path of the table
+    :param keys: the sorted array of keys
+    :param counts: the int64 count of each key
+    :return: None
+    """
+
+    keys.tofile(path + '.keys')
+    counts.tofile(path + '.counts')
+    with open(path + '.json', 'w') as f:
+        json.dump({'dtype': keys.dtype.str, 'length': len(keys)}, f)
@@ -0,0 +1,628 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+from collections import OrderedDict, deque
+from urllib.parse import parse_qs, urlsplit
+
+from mdp import MDP
+from model_refresh import Retrainer
+from model_registry import ModelRegistry
+from user_index import UserIndex
+
+# Reasons sent with each status code
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class LRUCache:
+    """
+    Class to hold at most max_size entries, dropping the least recently used one when full.
+    """
+
+    def __init__(self, max_size):
+        """
+        The constructor for the LRUCache class.
+        :param max_size: the maximum number of entries kept
+        """
+
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        Method to get an entry and mark it as recently used.
+        :param key: the key
+        :param default: returned if the key is not cached
+        :return: the value or default
+        """
+
+        value = self.entries.get(key, self)
+        if value is self:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """
+        Method to add or replace an entry, evicting the least recently used entries beyond max_size.
+        :param key: the key
+        :param value: the value
+        :return: None
+        """
+
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        """
+        Method to remove an entry if it is cached.
+        :param key: the key
+        :return: the value or None
+        """
+
+        return self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class MDPBackend:
+    """
+    Class to rank the games of states with a single trained MDP.
+    """
+
+    def __init__(self, mdp):
+        """
+        The constructor for the MDPBackend class.
+        :param mdp: the trained MDP
+        """
+
+        self.mdp = mdp
+        self.mdp_i = mdp.mdp_i
+        self.length = mdp.mdp_i.k
+        self.users = mdp.user_index()
+
+    def rank(self, rows, top_n):
+        """
+        Method to rank the games of many states.
+        :param rows: an array of shape (n, length) with the codes of the games of each state
+        :param top_n: the number of games to rank
+        :return: a list with a list of (game, score) tuples for each state, None if the state is not in the model
+        """
+
+        names, scores, found = self.mdp.recommend_codes(rows, top_n, titles=True)
+        return [list(zip(ranked, ranked_scores)) if present else None
+                for ranked, ranked_scores, present in zip(names.tolist(), scores.tolist(), found.tolist())]
+
+
+class MixtureBackend:
+    """
+    Class to rank the games of states with a mixture of MDPs.
+    """
+
+    def __init__(self, mixture):
+        """
+        The constructor for the MixtureBackend class.
+        :param mixture: the MixtureModel, loaded if it was not yet
+        """
+
+        if not mixture.model_keys:
+            mixture.load()
+        self.mixture = mixture
+        self.mdp_i = mixture.mdp_i
+        self.length = mixture.k
+        self.users = UserIndex.build(mixture.mdp_i, mixture.k)
+
+    def rank(self, rows, top_n):
+        """
+        Method to rank the games of many states.
+        :param rows: an array of shape (n, length) with the codes of the games of each state
+        :param top_n: the number of games to rank
+        :return: a list with a list of (game, score) tuples for each state, None if the state is not in every model
+        """
+
+        recommendations, found = self.mixture.predict_codes(rows, top_n)
+        return [ranked if present else None for ranked, present in zip(recommendations, found.tolist())]
+
+
+class RecommendationService:
+    """
+    Class to answer recommendation requests in batches.
+
+    Requests that arrive within max_delay of each other are answered together: the states of the users that are not
+    cached are resolved in one pass over the user index and the states whose rankings are not cached are ranked
+    in one call to the backend. A user's state is the codes of their last games, so recording a purchase only shifts
+    the cached state.
+
+    With a Retrainer, purchases are also sent to it and each model it publishes is opened off the event loop, then
+    swapped in between two batches: the backend and the user index are replaced together on the loop's thread, so
+    requests never wait on a lock and never see half of a model.
+    """
+
+    def __init__(self, backend, top_n=10, batch_size=256, max_delay=0.002, user_cache_size=100000,
+                 result_cache_size=10000, retrainer=None):
+        """
+        The constructor for the RecommendationService class.
+        :param backend: an MDPBackend or a MixtureBackend
+        :param top_n: the largest number of recommendations that can be asked for
+        :param batch_size: the number of pending requests that triggers a batch at once
+        :param max_delay: the number of seconds the first request of a batch waits for others
+        :param user_cache_size: the number of user states cached
+        :param result_cache_size: the number of state rankings cached
+        :param retrainer: a started Retrainer of the MDP of an MDPBackend, whose models are swapped in (none if None)
+        """
+
+        self.backend = backend
+        self.mdp_i = backend.mdp_i
+        self.users = backend.users
+        self.retrainer = retrainer
+        # The purchases sent to the retrainer as (seq, user, game) that the serving model has not seen
+        self.purchases = deque()
+        self.seq = 0
+        self.version = 0
+        self.top_n = top_n
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.user_states = LRUCache(user_cache_size)
+        self.results = LRUCache(result_cache_size)
+        self.pending = []
+        self.timer = None
+        self.stats = {'requests': 0, 'batches': 0, 'purchases': 0, 'swaps': 0}
+
+    async def recommend(self, user, n=None):
+        """
+        Method to get the recommendations of a user, answered with the next batch.
+        :param user: the user id
+        :param n: the number of recommendations (top_n if None)
+        :return: a list of (game, score) tuples
+        """
+
+        self.stats['requests'] += 1
+        n = self.top_n if n is None else min(n, self.top_n)
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((user, future))
+
+        # Answer at once when the batch is full, otherwise wait a little for more requests
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_delay, self.flush)
+        return (await future)[:n]
+
+    def flush(self):
+        """
+        Method to answer every pending request.
+        :return: None
+        """
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        self.stats['batches'] += 1
+        try:
+            self._answer(pending)
+        except Exception as e:
+            # Run from a timer nobody awaits, so the error goes to the requests of the batch
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _answer(self, pending):
+        """
+        Method to answer a batch of requests.
+        :param pending: a list of (user, future) tuples
+        :return: None
+        """
+
+        # Resolve the states of the users that are not cached
+        states = {}
+        missing = []
+        for user, future in pending:
+            state = self.user_states.get(user)
+            if state is not None:
+                states[user] = state
+            elif user in self.users:
+                missing.append(user)
+        missing = list(dict.fromkeys(missing))
+        if missing:
+            for user, row in zip(missing, self.users.recent_codes(missing, self.backend.length).tolist()):
+                states[user] = tuple(row)
+                self.user_states.put(user, tuple(row))
+
+        # Rank the states whose rankings are not cached
+        ranked = {}
+        unranked = []
+        for state in set(states.values()):
+            result = self.results.get(state)
+            if result is not None:
+                ranked[state] = result
+            else:
+                unranked.append(state)
+        if unranked:
+            for state, result in zip(unranked, self.backend.rank(unranked, self.top_n)):
+                ranked[state] = result
+                if result is not None:
+                    self.results.put(state, result)
+
+        for user, future in pending:
+            if future.done():
+                continue
+            if user not in states:
+                future.set_exception(KeyError("Unknown user " + str(user)))
+            elif ranked[states[user]] is None:
+                future.set_exception(KeyError("No recommendations for the current state of user " + str(user)))
+            else:
+                future.set_result(ranked[states[user]])
+
+    def record_purchase(self, user, game):
+        """
+        Method to record that a user bought a game, which moves the user to a new state.
+        :param user: the user id
+        :param game: the game id
+        :return: the games of the user's new state, None for padding
+        """
+
+        codec = self.users.codec
+        if game not in codec.item_code:
+            raise ValueError("Unknown game " + str(game))
+        self.stats['purchases'] += 1
+
+        # Shift the user's row of the index in place and the cached state with it
+        row = self.users.record_purchase(user, game)
+        state = tuple(row[len(row) - self.backend.length:].tolist())
+        self.user_states.put(user, state)
+        if self.retrainer is not None:
+            self.seq += 1
+            self.purchases.append((self.seq, user, game))
+            self.retrainer.add([[user, game, 'purchase', '1.0']], self.seq)
+        return [codec.decode_item(code) for code in state]
+
+    async def watch(self, interval=1.0):
+        """
+        Method to swap in every model the retrainer publishes, until cancelled.
+        :param interval: the number of seconds between checks for a new model
+        :return: None
+        """
+
+        loop = asyncio.get_running_loop()
+        # The snapshot being served, the model the service started with is not one
+        serving = None
+        while True:
+            await asyncio.sleep(interval)
+            snapshot = self.retrainer.poll()
+            if snapshot is None:
+                continue
+            # Open the model and read its pages in on another thread, the swap itself is instant
+            try:
+                rs = await loop.run_in_executor(None, self.retrainer.open, snapshot, self.backend.mdp.registry)
+            except Exception as e:
+                # Keep serving the current model
+                print(e)
+                continue
+            self.swap(MDPBackend(rs), snapshot.version, snapshot.seq)
+
+            # Nothing maps the files of the previous snapshot any more
+            if serving is not None:
+                self.retrainer.release(serving)
+            serving = snapshot
+
+    def swap(self, backend, version, seq=0):
+        """
+        Method to serve a new model, the purchases it has not seen are replayed onto its user index first. The model
+        file of the previous MDP is unloaded and unregistered, so the registry does not grow with every swap.
+        :param backend: the MDPBackend of the new model
+        :param version: the version of the new model
+        :param seq: the number of the last purchase the new model saw
+        :return: None
+        """
+
+        while self.purchases and self.purchases[0][0] <= seq:
+            self.purchases.popleft()
+        for _, user, game in self.purchases:
+            backend.users.record_purchase(user, game)
+
+        old = self.backend
+        self.backend = backend
+        self.mdp_i = backend.mdp_i
+        self.users = backend.users
+        self.version = version
+        if isinstance(old, MDPBackend) and old.mdp.model_key is not None and old.mdp.model_key != backend.mdp.model_key:
+            old.mdp.registry.unregister(old.mdp.model_key)
+        self.user_states.clear()
+        self.results.clear()
+        self.stats['swaps'] += 1
+
+    def describe(self):
+        """
+        Method to get the counters of the service.
+        :return: a dict of counters
+        """
+
+        return dict(self.stats, version=self.version,
+                    user_cache={'size': len(self.user_states), 'hits': self.user_states.hits,
+                                'misses': self.user_states.misses},
+                    result_cache={'size': len(self.results), 'hits': self.results.hits,
+                                  'misses': self.results.misses})
+
+
+class RecommendationServer:
+    """
+    Class to serve a RecommendationService as JSON over HTTP/1.1 with keep-alive connections.
+
+    GET /recommend?user=<id>&n=<n>          the recommendations of a user
+    POST /recommend {"users": [...], "n": n}  the recommendations of several users
+    POST /purchase {"user": id, "game": id}  record a purchase and return the user's new state
+    GET /stats                               the counters of the service
+    POST /refresh {"full": false}            retrain in the background, the new model is swapped in when ready
+    """
+
+    def __init__(self, service):
+        """
+        The constructor for the RecommendationServer class.
+        :param service: the RecommendationService
+        """
+
+        self.service = service
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        """
+        Method to accept connections until cancelled.
+        :param host: the address to listen on
+        :param port: the port to listen on
+        :return: None
+        """
+
+        server = await asyncio.start_server(self.handle, host, port, backlog=4096)
+        watcher = asyncio.create_task(self.service.watch()) if self.service.retrainer is not None else None
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+
+    async def handle(self, reader, writer):
+        """
+        Method to answer the requests of one connection.
+        :param reader: the stream of the connection
+        :param writer: the writer of the connection
+        :return: None
+        """
+
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, target, version, headers, body = request
+                status, payload = await self.dispatch(method, target, body)
+
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                data = json.dumps(payload).encode('utf-8')
+                writer.write(('HTTP/1.1 ' + str(status) + ' ' + _REASONS[status] + '\r\n' +
+                              'Content-Type: application/json\r\nContent-Length: ' + str(len(data)) + '\r\n' +
+                              ('' if keep_alive else 'Connection: close\r\n') + '\r\n').encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, target, body):
+        """
+        Method to answer a single request.
+        :param method: the HTTP method
+        :param target: the request target
+        :param body: the request body
+        :return: the status code and the JSON payload
+        """
+
+        url = urlsplit(target)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == '/recommend' and method == 'GET':
+                if 'user' not in query:
+                    return 400, {'error': "Missing user"}
+                # A value that is not a number is left as a string, which _count rejects
+                n = query.get('n')
+                n = _count(int(n) if n is not None and n.lstrip('-').isdigit() else n)
+                return 200, _recommendations(query['user'], await self.service.recommend(query['user'], n))
+            if url.path == '/recommend' and method == 'POST':
+                request = _json_object(body)
+                if not isinstance(request.get('users', []), list):
+                    return 400, {'error': "users must be a list"}
+                users = [str(user) for user in request.get('users', [])]
+                n = _count(request.get('n'))
+                results = await asyncio.gather(*[self.service.recommend(user, n) for user in users],
+                                               return_exceptions=True)
+                return 200, {'results': [{'user': user, 'error': _message(result)} if isinstance(result, Exception)
+                                         else _recommendations(user, result) for user, result in zip(users, results)]}
+            if url.path == '/purchase' and method == 'POST':
+                request = _json_object(body)
+                if 'user' not in request or 'game' not in request:
+                    return 400, {'error': "Missing user or game"}
+                user, game = str(request['user']), str(request['game'])
+                return 200, {'user': user, 'state': self.service.record_purchase(user, game)}
+            if url.path == '/stats' and method == 'GET':
+                return 200, self.service.describe()
+            if url.path == '/refresh' and method == 'POST':
+                if self.service.retrainer is None:
+                    return 400, {'error': "The server was started without retraining"}
+                request = _json_object(body)
+                self.service.retrainer.trigger(request.get('full'))
+                return 200, {'version': self.service.version}
+            if url.path in ('/recommend', '/purchase', '/stats', '/refresh'):
+                return 405, {'error': "Method " + method + " is not allowed on " + url.path}
+            return 404, {'error': "Unknown path " + url.path}
+        except KeyError as e:
+            return 404, {'error': _message(e)}
+        except ValueError as e:
+            return 400, {'error': _message(e)}
+        except Exception as e:
+            return 500, {'error': _message(e)}
+
+
+async def _read_request(reader):
+    """
+    Function to read one HTTP request.
+    :param reader: the stream of the connection
+    :return: the method, target, version, headers and body, or None if the connection was closed
+    """
+
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    method, target, version = line.decode('latin-1').split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    body = await reader.readexactly(length) if length else b''
+    return method, target, version, headers, body
+
+
+def _recommendations(user, ranked):
+    """
+    Function to build the payload of a user's recommendations.
+    :param user: the user id
+    :param ranked: a list of (game, score) tuples
+    :return: a dict
+    """
+
+    return {'user': user, 'recommendations': [[game, score] for game, score in ranked]}
+
+
+def _json_object(body):
+    """
+    Function to parse the JSON object of a request body.
+    :param body: the request body, an empty body is an empty object
+    :return: a dict
+    """
+
+    request = json.loads(body or b'{}')
+    if not isinstance(request, dict):
+        raise ValueError("The body must be a JSON object")
+    return request
+
+
+def _count(n):
+    """
+    Function to check the number of recommendations asked for.
+    :param n: the number or None
+    :return: n
+    """
+
+    if n is not None and (isinstance(n, bool) or not isinstance(n, int) or n <= 0):
+        raise ValueError("n must be a positive integer")
+    return n
+
+
+def _message(error):
+    """
+    Function to get the message of an exception, KeyError quotes its argument otherwise.
+    :param error: the exception
+    :return: the message
+    """
+
+    return str(error.args[0]) if error.args else type(error).__name__
+
+
+def load_backend(model='mdp', path='data-mini', k=3, save_path=None, registry=None):
+    """
+    Function to load a trained model for serving.
+    :param model: 'mdp' for a single MDP or 'mixture' for a mixture of MDPs
+    :param path: path to data
+    :param k: the number of items in each state, or the number of models of the mixture
+    :param save_path: the path the models were saved to (saved-models or mixture-models if None)
+    :param registry: the ModelRegistry the model files are served from (one without a budget if None)
+    :return: an MDPBackend or a MixtureBackend
+    """
+
+    if model == 'mixture':
+        spec = importlib.util.spec_from_file_location(
+            'mixture_model', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mixture-model.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return MixtureBackend(module.MixtureModel(path=path, k=k, verbose=False,
+                                                  save_path=save_path or "mixture-models", registry=registry))
+
+    # Serve the model file with the saved user index when there is one, without reading the data
+    save_path = save_path or "saved-models"
+    filename = "mdp-model_k=" + str(k)
+    users = "mdp-users_k=" + str(k)
+    if os.path.exists(save_path + "/" + filename + ".mdpm") and os.path.exists(save_path + "/" + users + ".json"):
+        return MDPBackend(MDP.serve(filename + ".mdpm", users, save_path, registry))
+
+    rs = MDP(path=path, k=k, verbose=False, save_path=save_path, registry=registry)
+    if os.path.exists(rs.save_path + "/" + filename + ".mdpm"):
+        rs.load_model(filename + ".mdpm")
+    else:
+        rs.load(filename + ".pkl")
+    return MDPBackend(rs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve recommendations as JSON over HTTP")
+    parser.add_argument('--model', choices=('mdp', 'mixture'), default='mdp')
+    parser.add_argument('--path', default='data-mini')
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--save-path', default=None)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--top-n', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--max-delay', type=float, default=0.002)
+    parser.add_argument('--user-cache-size', type=int, default=100000)
+    parser.add_argument('--result-cache-size', type=int, default=10000)
+    parser.add_argument('--max-model-bytes', type=int, default=None,
+                        help="the memory the loaded models may take before the least recently used are dropped")
+    parser.add_argument('--retrain', action='store_true',
+                        help="retrain in a background process on POST /refresh and swap the new models in")
+    parser.add_argument('--retrain-interval', type=float, default=None,
+                        help="also retrain every this many seconds")
+    parser.add_argument('--full-retrain', action='store_true',
+                        help="rebuild the MDP on scheduled refreshes instead of re-solving it with the new purchases")
+    args = parser.parse_args()
+
+    # The retrainer is forked before the event loop starts
+    retrainer = None
+    if args.retrain or args.retrain_interval is not None:
+        if args.model != 'mdp':
+            parser.error("only an MDP can be retrained")
+        retrainer = Retrainer(args.path, args.k, args.save_path or "saved-models", args.retrain_interval,
+                              args.full_retrain)
+        retrainer.start()
+
+    backend = load_backend(args.model, args.path, args.k, args.save_path, ModelRegistry(args.max_model_bytes))
+    service = RecommendationService(backend, args.top_n, args.batch_size, args.max_delay, args.user_cache_size,
+                                    args.result_cache_size, retrainer)
+    print("Serving on http://" + args.host + ":" + str(args.port))
+    try:
+        asyncio.run(RecommendationServer(service).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if retrainer is not None:
+            retrainer.stop()
@@ -0,0 +1,138 @@
+import numpy as np
+
+
+class StateCodec:
+    """
+    Class to encode states of a fixed number of games as compact keys.
+
+    Every game gets a small integer code, 0 is reserved for the None padding. A state of `length` codes is packed into
+    a single int64 when length * bits_per_item fits in 63 bits, otherwise it is stored as a fixed-width byte string
+    of big-endian int32 codes. Either way keys are hashable, sortable and can be handled as NumPy arrays.
+    """
+
+    def __init__(self, items, length):
+        """
+        The constructor for the StateCodec class.
+        :param items: the list of games, the code of a game is its position + 1
+        :param length: the number of games in each state
+        """
+
+        self.items = list(items)
+        self.length = length
+        self.item_code = {item: ind + 1 for ind, item in enumerate(self.items)}
+        self.bits_per_item = max(1, len(self.items).bit_length())
+        self.packed = self.bits_per_item * length <= 63
+        self.dtype = np.dtype(np.int64) if self.packed else np.dtype('V' + str(4 * length))
+
+    def with_length(self, length):
+        """
+        Method to get a codec over the same games for states of another length.
+        :param length: the number of games in each state
+        :return: a StateCodec
+        """
+
+        return StateCodec(self.items, length)
+
+    def encode_items(self, items):
+        """
+        Method to get the codes of a sequence of games.
+        :param items: the games, None is the padding
+        :return: an int32 array of codes
+        """
+
+        return np.array([0 if item is None else self.item_code[item] for item in items], dtype=np.int32)
+
+    def decode_item(self, code):
+        """
+        Method to get the game of a code.
+        :param code: the code
+        :return: the game or None for the padding
+        """
+
+        return None if code == 0 else self.items[code - 1]
+
+    def pack(self, rows):
+        """
+        Method to pack rows of codes into keys.
+        :param rows: an array of shape (n, length) of codes
+        :return: an array of n keys
+        """
+
+        rows = np.asarray(rows).reshape(-1, self.length)
+        if self.packed:
+            keys = np.zeros(len(rows), dtype=np.int64)
+            for j in range(self.length):
+                keys = (keys << self.bits_per_item) | rows[:, j].astype(np.int64)
+            return keys
+        return np.ascontiguousarray(rows.astype('>i4')).view(self.dtype).ravel()
+
+    def unpack(self, keys):
+        """
+        Method to unpack keys into rows of codes.
+        :param keys: an array of keys
+        :return: an int32 array of shape (n, length) of codes
+        """
+
+        keys = self.as_array(keys)
+        if self.packed:
+            mask = (1 << self.bits_per_item) - 1
+            shifts = self.bits_per_item * np.arange(self.length - 1, -1, -1)
+            return ((keys[:, None] >> shifts[None, :]) & mask).astype(np.int32)
+        return keys.view('>i4').reshape(len(keys), self.length).astype(np.int32)
+
+    def as_array(self, keys):
+        """
+        Method to turn a list of keys into an array of keys.
+        :param keys: keys as returned by encode or pack
+        :return: an array of keys
+        """
+
+        return np.asarray(keys, dtype=self.dtype).ravel()
+
+    def encode(self, state):
+        """
+        Method to get the key of a single state.
+        :param state: a tuple of games, None is the padding
+        :return: the key as an int or bytes
+        """
+
+        return self.pack(self.encode_items(state)).tolist()[0]
+
+    def decode(self, key):
+        """
+        Method to get the state of a single key.
+        :param key: the key
+        :return: a tuple of games, None is the padding
+        """
+
+        return tuple(self.decode_item(code) for code in self.unpack([key])[0].tolist())
+
+    def shift(self, keys, codes):
+        """
+        Method to drop the first game of each state and append a game.
+        :param keys: an array of keys
+        :param codes: the code appended to each state, broadcast against keys
+        :return: an array of keys of the next states
+        """
+
+        keys, codes = np.broadcast_arrays(self.as_array(keys).reshape(np.shape(keys)), np.asarray(codes))
+        if self.packed:
+            mask = (1 << (self.bits_per_item * (self.length - 1))) - 1
+            return ((keys & mask) << self.bits_per_item) | codes.astype(np.int64)
+        rows = self.unpack(keys.ravel())
+        rows = np.concatenate([rows[:, 1:], codes.reshape(-1, 1).astype(np.int32)], axis=1)
+        return self.pack(rows).reshape(keys.shape)
+
+    def windows(self, sequence, starts, ends):
+        """
+        Method to get the keys of every run of `length` consecutive codes that lies within one of the given spans.
+        :param sequence: an array of codes
+        :param starts: the start of each span
+        :param ends: the end of each span (exclusive)
+        :return: an array of keys in order of position
+        """
+
+        counts = np.maximum(np.asarray(ends) - np.asarray(starts) - self.length + 1, 0)
+        offsets = np.cumsum(counts) - counts
+        positions = np.repeat(np.asarray(starts) - offsets, counts) + np.arange(counts.sum())
+        return self.pack(sequence[positions[:, None] + np.arange(self.length)[None, :]])
@@ -0,0 +1,136 @@
+import argparse
+import csv
+import gzip
+import os
+
+import numpy as np
+
+# Prices of the paid games, in cents, as they appear in the Steam data
+PRICES = np.array([199, 299, 349, 369, 499, 999, 1499, 1999, 2670])
+
+
+def history_lengths(rng, num_of_users, mean, distribution='geometric', max_length=None):
+    """
+    Function to draw the number of games bought by each user.
+    :param rng: a numpy Generator
+    :param num_of_users: the number of users
+    :param mean: the average number of games per user
+    :param distribution: 'geometric' (most users own one game, like the Steam data), 'lognormal' (a heavier tail) or
+    'poisson'
+    :param max_length: the largest history allowed
+    :return: an int array with a length of at least 1 for each user
+    """
+
+    if distribution == 'geometric':
+        lengths = rng.geometric(1 / max(mean, 1), num_of_users)
+    elif distribution == 'lognormal':
+        # 1 + floor(x) with x log-normal of mean `mean - 0.5` has about the requested mean
+        lengths = 1 + np.floor(rng.lognormal(np.log(max(mean - 0.5, 0.5)) - 0.5, 1, num_of_users))
+    elif distribution == 'poisson':
+        lengths = 1 + rng.poisson(max(mean - 1, 0), num_of_users)
+    else:
+        raise ValueError("Unknown history length distribution " + str(distribution))
+    return np.minimum(lengths, max_length or np.iinfo(np.int64).max).astype(np.int64)
+
+
+def generate(path, num_of_users=10000, num_of_games=20, mean_history=2.5, distribution='geometric', skew=1.0,
+             play_share=0.8, free_share=0.3, seed=0, compress=False):
+    """
+    Function to write a dataset shaped like the Steam data as users.csv, transactions.csv and games.csv.
+
+    The popularity of the game ranked r is proportional to 1 / r ** skew. Each user buys distinct games drawn by
+    popularity, in a random order, and plays each of them with probability play_share for a log-normal number of
+    hours. A game nobody drew is bought by one random user as the last game of their history, so that every game of
+    the catalog has transactions to average its hours over.
+    :param path: the directory to write to
+    :param num_of_users: the number of users
+    :param num_of_games: the size of the catalog
+    :param mean_history: the average number of games per user
+    :param distribution: the distribution of the history lengths, see history_lengths
+    :param skew: the Zipf exponent of the popularity of the games (0 for uniform)
+    :param play_share: the share of purchases that are followed by a play transaction
+    :param free_share: the share of games that are free
+    :param seed: the random seed
+    :param compress: flag to write transactions.csv.gz instead of transactions.csv
+    :return: the number of transactions written
+    """
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(path, exist_ok=True)
+
+    # The games, with their ids in the same range as the Steam ones
+    game_ids = np.sort(rng.choice(np.arange(10, 10 * num_of_games + 10), num_of_games, replace=False))
+    prices = np.where(rng.random(num_of_games) < free_share, 1, rng.choice(PRICES, num_of_games))
+    with open(os.path.join(path, 'games.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['game-id', 'game-title', 'game-price'])
+        writer.writerows([game_id, 'Game ' + str(game_id), price] for game_id, price in zip(game_ids.tolist(),
+                                                                                           prices.tolist()))
+
+    user_ids = np.sort(rng.choice(np.arange(10 ** 7, 10 ** 7 + 40 * num_of_users), num_of_users, replace=False))
+    with open(os.path.join(path, 'users.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['user-id'])
+        writer.writerows([user_id] for user_id in user_ids.tolist())
+
+    # Popularity by rank, and the typical hours of each game
+    log_popularity = -skew * np.log(np.arange(1, num_of_games + 1))[rng.permutation(num_of_games)]
+    median_hours = np.exp(rng.normal(2, 1, num_of_games))
+    lengths = history_lengths(rng, num_of_users, mean_history, distribution, num_of_games)
+
+    t_path = os.path.join(path, 'transactions.csv' + ('.gz' if compress else ''))
+    written = 0
+    bought = np.zeros(num_of_games, dtype=bool)
+    with (gzip.open(t_path, 'wt', newline='') if compress else open(t_path, 'w', newline='')) as f:
+        writer = csv.writer(f)
+        writer.writerow(['user-id', 'game-title', 'behaviour-name', 'values'])
+
+        # Draw distinct games for a chunk of users at once with the Gumbel top-k trick
+        chunk_size = max(1, 4000000 // num_of_games)
+        for start in range(0, num_of_users, chunk_size):
+            chunk_lengths = lengths[start:start + chunk_size]
+            longest = int(chunk_lengths.max())
+            keys = log_popularity[None, :] + rng.gumbel(size=(len(chunk_lengths), num_of_games))
+            top = np.argpartition(-keys, longest - 1, axis=1)[:, :longest]
+            top = np.take_along_axis(top, rng.random(top.shape).argsort(axis=1), axis=1)
+
+            # Each purchase, followed by a play with the hours played for some of them
+            games = top[np.arange(longest)[None, :] < chunk_lengths[:, None]]
+            bought[games] = True
+            users = np.repeat(user_ids[start:start + chunk_size], chunk_lengths)
+            played = rng.random(len(games)) < play_share
+            hours = np.round(median_hours[games] * rng.lognormal(0, 1.2, len(games)), 1)
+            rows = []
+            for user_id, game_id, play, value in zip(users.tolist(), game_ids[games].tolist(), played.tolist(),
+                                                     hours.tolist()):
+                rows.append((user_id, game_id, 'purchase', 1.0))
+                if play:
+                    rows.append((user_id, game_id, 'play', value))
+            writer.writerows(rows)
+            written += len(rows)
+
+        # The games nobody drew, each bought by a random user after the rest of their games
+        unbought = np.flatnonzero(~bought)
+        buyers = rng.choice(user_ids, len(unbought))
+        writer.writerows((user_id, game_id, 'purchase', 1.0) for user_id, game_id in zip(buyers.tolist(),
+                                                                                         game_ids[unbought].tolist()))
+        written += len(unbought)
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic dataset shaped like the Steam data")
+    parser.add_argument('path')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--games', type=int, default=20)
+    parser.add_argument('--mean-history', type=float, default=2.5)
+    parser.add_argument('--distribution', choices=('geometric', 'lognormal', 'poisson'), default='geometric')
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--play-share', type=float, default=0.8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compress', action='store_true')
+    args = parser.parse_args()
+
+    n = generate(args.path, args.users, args.games, args.mean_history, args.distribution, args.skew,
+                 args.play_share, seed=args.seed, compress=args.compress)
+    print("Wrote " + str(n) + " transactions to " + args.path)
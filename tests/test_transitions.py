@@ -0,0 +1,170 @@
+import csv
+import os
+
+import numpy as np
+import pytest
+
+from mdp import MDP
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data-mini')
+K = 2
+ALPHA = 1
+DISCOUNT = 0.999
+
+
+def baseline_transitions(data_path, k, alpha):
+    """
+    Function to build the transitions the way the original nested-dict MDPInitializer did, from the csv files.
+    :param data_path: path to data
+    :param k: the number of items in each state
+    :param alpha: the proportionality constant when considering transitions
+    :return: the states with their counts and { state: { action: { next_state: (prob, reward), ... }, ... }, ... }
+    """
+
+    transactions = {}
+    with open(data_path + "/users.csv") as f:
+        csv_f = csv.reader(f)
+        next(csv_f)
+        for row in csv_f:
+            transactions[row[0]] = []
+
+    game_data = {}
+    with open(data_path + "/transactions.csv") as f:
+        csv_f = csv.reader(f)
+        next(csv_f)
+        for row in csv_f:
+            if row[1] not in transactions[row[0]]:
+                transactions[row[0]].append(row[1])
+            if row[1] not in game_data:
+                game_data[row[1]] = [0, 0]
+            game_data[row[1]][0] += float(row[3])
+            game_data[row[1]][1] += 1
+    for game in game_data:
+        game_data[game] = game_data[game][0] / game_data[game][1]
+
+    actions = []
+    game_price = {}
+    with open(data_path + "/games.csv") as f:
+        csv_f = csv.reader(f)
+        next(csv_f)
+        for row in csv_f:
+            actions.append(row[0])
+            game_price[row[0]] = int(row[2])
+
+    # States of k items and sequences of k+1 items, the last item of each user is not used in the latter
+    states = {}
+    total_sequences = {}
+    for user in transactions:
+        games = [None] * (k - 1) + transactions[user]
+        for i in range(0, len(games) - k + 1):
+            state = tuple(games[i:i + k])
+            states[state] = states.get(state, 0) + 1
+        for i in range(0, len(games) - k - 1):
+            sequence = tuple(games[i:i + k + 1])
+            total_sequences[sequence] = total_sequences.get(sequence, 0) + 1
+
+    def beta(action, new_state):
+        diff = abs((game_data[action] / game_price[action]) -
+                   (game_data[new_state[k - 1]] / game_price[new_state[k - 1]]))
+        return diff / 120
+
+    transitions = {}
+    for state, state_count in states.items():
+        transitions[state] = {}
+        for action in actions:
+            new_state = state[1:] + (action,)
+            transitions[state][action] = {new_state: (alpha * total_sequences.get(state + (action,), 1) / state_count,
+                                                      1)}
+    for state in transitions:
+        for action in transitions[state]:
+            for a in actions:
+                new_state = state[1:] + (a,)
+                if new_state not in transitions[state][action]:
+                    transitions[state][action][new_state] = (beta(action, new_state) *
+                                                             transitions[state][a][new_state][0], 1)
+    for state in transitions:
+        for action in transitions[state]:
+            total = sum(prob for prob, _ in transitions[state][action].values())
+            for new_state, (prob, reward) in transitions[state][action].items():
+                transitions[state][action][new_state] = (prob / total, reward)
+    return states, transitions
+
+
+def exact_solution(transitions, actions, discount):
+    """
+    Function to solve a nested-dict MDP exactly, with policy iteration and a linear solve for each evaluation.
+    States outside the table are worth 0, as they were to the original solver.
+    :param transitions: { state: { action: { next_state: (prob, reward), ... }, ... }, ... }
+    :param actions: the actions/items that can be chosen
+    :param discount: the discount factor
+    :return: the state list, their optimal values and their action values
+    """
+
+    states = list(transitions)
+    index = {state: ind for ind, state in enumerate(states)}
+    prob = np.zeros((len(states), len(actions), len(states)))
+    reward = np.zeros((len(states), len(actions)))
+    for s, state in enumerate(states):
+        for a, action in enumerate(actions):
+            for new_state, (p, r) in transitions[state][action].items():
+                reward[s, a] += p * r
+                if new_state in index:
+                    prob[s, a, index[new_state]] += p
+
+    policy = np.zeros(len(states), dtype=np.int64)
+    while True:
+        rows = np.arange(len(states))
+        values = np.linalg.solve(np.eye(len(states)) - discount * prob[rows, policy], reward[rows, policy])
+        action_values = reward + discount * prob @ values
+        new_policy = np.argmax(action_values, axis=1)
+        if np.all(action_values[rows, new_policy] <= action_values[rows, policy] + 1e-12):
+            return states, values, action_values
+        policy = new_policy
+
+
+@pytest.fixture(scope='module')
+def baseline():
+    return baseline_transitions(DATA, K, ALPHA)
+
+
+@pytest.fixture(scope='module')
+def model():
+    rs = MDP(path=DATA, alpha=ALPHA, k=K, discount_factor=DISCOUNT, verbose=False)
+    rs.initialise_mdp()
+    return rs
+
+
+def test_states_match_baseline(baseline, model):
+    codec = model.mdp_i.codec
+    assert {codec.decode(key): count for key, count in model.S.items()} == baseline[0]
+
+
+def test_transition_probabilities_match_baseline(baseline, model):
+    codec = model.mdp_i.codec
+    table = {codec.decode(state): {action: {codec.decode(new_state): entry for new_state, entry in row.items()}
+                                   for action, row in rows.items()}
+             for state, rows in model.T.to_dict().items()}
+    assert set(table) == set(baseline[1])
+    for state, rows in baseline[1].items():
+        assert set(table[state]) == set(rows)
+        for action, row in rows.items():
+            # Outcomes of probability 0 are not stored
+            for new_state, (prob, reward) in row.items():
+                assert table[state][action].get(new_state, (0.0, reward)) == pytest.approx((prob, reward), abs=1e-12)
+            assert set(table[state][action]) <= set(row)
+
+
+@pytest.mark.parametrize('method', ['policy_iteration', 'value_iteration', 'gauss_seidel', 'prioritized_sweeping'])
+def test_solution_matches_baseline(baseline, model, method):
+    actions = model.mdp_i.actions
+    states, values, action_values = exact_solution(baseline[1], actions, DISCOUNT)
+    model.solve(method, to_save=False, tol=1e-9, max_iteration=100000)
+
+    codec = model.mdp_i.codec
+    state_keys = [codec.encode(state) for state in states]
+    assert np.array([model.V[key] for key in state_keys]) == pytest.approx(values, abs=1e-4)
+
+    # The chosen action is one of the best, whichever way ties are broken
+    chosen = np.array([actions.index(model.policy[key]) for key in state_keys])
+    best = action_values.max(axis=1)
+    assert np.all(action_values[np.arange(len(states)), chosen] >= best - 1e-6)
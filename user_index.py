@@ -0,0 +1,217 @@
+import json
+import os
+from collections.abc import MutableMapping
+
+import numpy as np
+
+from state_codec import StateCodec
+
+
+class UserIndex(MutableMapping):
+    """
+    Dict-like index of the last games of every user as { user_id: [ game_id, ... ], ... }.
+
+    Only the codes of the last `length` games of each user are kept, in rows sorted by user id that are memory-mapped
+    from the files written by save, so opening an index reads none of the csv files. It has the parts of an
+    MDPInitializer that serving reads (k, codec, actions, games, transactions and recent_codes) and stands in for one
+    in a serve-only MDP. Histories that are assigned are kept aside and take precedence over the rows.
+
+    The rows are the current states of the users: record_purchase shifts a user's row in place, in O(k) whatever the
+    length of the user's history. A mapped file is copied on write and never changed.
+    """
+
+    def __init__(self, codec, actions, games, user_ids, rows, path=None):
+        """
+        The constructor for the UserIndex class.
+        :param codec: the StateCodec of the games, its length is the number of games kept for each user
+        :param actions: the actions/items that can be chosen
+        :param games: the title of each action as { game_id: title, ... }
+        :param user_ids: the sorted array of user ids
+        :param rows: an int32 array of shape (len(user_ids), length) with the codes of each user's last games, padded
+        in front with 0 (None)
+        :param path: the path the arrays were loaded from, if any
+        """
+
+        self.codec = codec
+        self.k = codec.length
+        self.length = codec.length
+        self.actions = list(actions)
+        self.games = games
+        self.user_ids = user_ids
+        self.rows = rows
+        self.path = path
+        self.overrides = {}
+        # The user histories, like MDPInitializer.transactions
+        self.transactions = self
+
+    @classmethod
+    def build(cls, mdp_i, length=None):
+        """
+        Method to index the last games of every user of an MDPInitializer.
+        :param mdp_i: the MDPInitializer
+        :param length: the number of games kept for each user (mdp_i.k if None)
+        :return: a UserIndex
+        """
+
+        length = mdp_i.k if length is None else length
+        user_ids = np.array([str(user) for user in mdp_i.transactions])
+        order = np.argsort(user_ids, kind='stable')
+        rows = mdp_i.recent_codes(list(mdp_i.transactions), length)
+        return cls(mdp_i.codec.with_length(length), mdp_i.actions, {game: mdp_i.games[game] for game in mdp_i.actions},
+                   user_ids[order], rows[order])
+
+    @classmethod
+    def load(cls, path):
+        """
+        Method to memory-map an index written by save.
+        :param path: the path given to save
+        :return: a UserIndex
+        """
+
+        with open(path + '.json') as f:
+            header = json.load(f)
+        codec = StateCodec(header['items'], header['length'])
+        num_of_users = header['users']
+        if not num_of_users:
+            return cls(codec, header['actions'], header['games'], np.empty(0, dtype=header['dtype']),
+                       np.zeros((0, codec.length), dtype=np.int32), path)
+        return cls(codec, header['actions'], header['games'],
+                   np.memmap(path + '.users', dtype=header['dtype'], mode='r', shape=(num_of_users,)),
+                   np.memmap(path + '.rows', dtype=np.int32, mode='c', shape=(num_of_users, codec.length)), path)
+
+    def save(self, path):
+        """
+        Method to write the index as path.json, path.users and path.rows, the header is written last.
+        :param path: the path of the index
+        :return: None
+        """
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        user_ids, rows = self.user_ids, self.rows
+        if self.overrides:
+            # The assigned histories replace the indexed ones
+            assigned = np.array([str(user) for user in self.overrides])
+            kept = ~np.isin(user_ids, assigned)
+            user_ids = np.concatenate([user_ids[kept], assigned])
+            rows = np.concatenate([rows[kept], np.array(list(self.overrides.values()), dtype=np.int32)])
+            order = np.argsort(user_ids, kind='stable')
+            user_ids, rows = user_ids[order], rows[order]
+        np.ascontiguousarray(user_ids).tofile(path + '.users')
+        np.ascontiguousarray(rows, dtype=np.int32).tofile(path + '.rows')
+        with open(path + '.json', 'w') as f:
+            json.dump({'items': self.codec.items, 'length': self.length, 'actions': self.actions,
+                       'games': self.games, 'dtype': np.asarray(user_ids).dtype.str, 'users': len(user_ids)}, f)
+
+    def with_k(self, k, metrics=None):
+        """
+        Method to get the index for states of k games, which must not be more than the games kept.
+        :param k: the number of items in each state
+        :param metrics: unused, an index records no phases
+        :return: a UserIndex
+        """
+
+        if k > self.length:
+            raise ValueError("The index keeps the last " + str(self.length) + " games of each user, " + str(k) +
+                             " were asked for")
+        if k == self.k:
+            return self
+        other = UserIndex(self.codec.with_length(k), self.actions, self.games, self.user_ids, self.rows, self.path)
+        other.length = self.length
+        other.overrides = self.overrides
+        return other
+
+    def _find(self, user_ids):
+        """
+        Method to find users among the indexed ones.
+        :param user_ids: a list of user ids
+        :return: the position of each user and a mask of the users that are indexed
+        """
+
+        if not len(self.user_ids):
+            return np.zeros(len(user_ids), dtype=np.int64), np.zeros(len(user_ids), dtype=bool)
+        user_ids = np.array([str(user) for user in user_ids])
+        pos = np.minimum(np.searchsorted(self.user_ids, user_ids), len(self.user_ids) - 1)
+        return pos, self.user_ids[pos] == user_ids
+
+    def recent_codes(self, user_ids, length):
+        """
+        Method to get the codes of the last games of many users.
+        :param user_ids: the users
+        :param length: the number of games to take from the end of each history
+        :return: an int32 array of shape (len(user_ids), length), padded in front with 0 (None)
+        """
+
+        if length > self.length:
+            raise ValueError("The index keeps the last " + str(self.length) + " games of each user")
+        user_ids = list(user_ids)
+        pos, found = self._find(user_ids)
+        overridden = np.array([user in self.overrides for user in user_ids], dtype=bool)
+        missing = ~found & ~overridden
+        if missing.any():
+            raise KeyError(user_ids[int(np.argmax(missing))])
+
+        rows = np.zeros((len(user_ids), length), dtype=np.int32)
+        rows[found] = self.rows[pos[found], self.length - length:]
+        for ind in np.flatnonzero(overridden).tolist():
+            rows[ind] = self.overrides[user_ids[ind]][self.length - length:]
+        return rows
+
+    def state(self, user):
+        """
+        Method to get the codes of the last games of one user.
+        :param user: the user id
+        :return: an int32 array of the last `length` codes, the index's own row which record_purchase shifts
+        """
+
+        if user in self.overrides:
+            return self.overrides[user]
+        pos, found = self._find([user])
+        if not found[0]:
+            raise KeyError(user)
+        return self.rows[pos[0]]
+
+    def record_purchase(self, user, game):
+        """
+        Method to move a user to the state after buying a game by shifting the user's row in place, a new user starts
+        from the empty state. Only the first purchase of a game is part of a history, but only the last `length` games
+        are known here, so buying one of them again changes nothing and buying an older one again shifts the row.
+        :param user: the user id
+        :param game: the game id
+        :return: an int32 array with the codes of the user's new state
+        """
+
+        if game not in self.codec.item_code:
+            raise ValueError("Unknown game " + str(game))
+        code = self.codec.item_code[game]
+        try:
+            row = self.state(user)
+        except KeyError:
+            row = self.overrides[user] = np.zeros(self.length, dtype=np.int32)
+        if code not in row:
+            row[:-1] = row[1:]
+            row[-1] = code
+        return row
+
+    def __getitem__(self, user):
+        codes = self.state(user).tolist()
+        return [self.codec.decode_item(code) for code in codes if code]
+
+    def __setitem__(self, user, games):
+        history = [0] * self.length + [self.codec.item_code[game] for game in games]
+        self.overrides[user] = np.array(history[len(history) - self.length:], dtype=np.int32)
+
+    def __delitem__(self, user):
+        raise TypeError("Users cannot be removed from the index")
+
+    def __iter__(self):
+        for start in range(0, len(self.user_ids), 1 << 16):
+            yield from self.user_ids[start:start + (1 << 16)].tolist()
+        for user in self.overrides:
+            if not self._find([user])[1][0]:
+                yield user
+
+    def __len__(self):
+        return len(self.user_ids) + sum(1 for user in self.overrides if not self._find([user])[1][0])
+
+    def __contains__(self, user):
+        return user in self.overrides or bool(self._find([user])[1][0])